@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+
+#-------------------------------------------------------------------------------
+# Benchmarks for pyrasol's own scheduling overhead.
+#
+# Each benchmark runs the real MyDaemon loop (without daemonizing) inside a
+# scratch directory, so nothing in the current batch directory is touched.
+#-------------------------------------------------------------------------------
+
+import os, sys, time, gzip, heapq, shutil, resource, subprocess, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyrasol
+from pyraclass import *
+from pyrahist import history, HIST_FILE
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    i = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[i]
+
+def summarize(name, values):
+    if len(values) == 0:
+        return '  %s: no samples' % name
+    mean = sum(values) / len(values)
+    return '  %s: n=%d min=%.4f median=%.4f mean=%.4f p95=%.4f max=%.4f' % \
+           (name, len(values), min(values), percentile(values, 50), mean,
+            percentile(values, 95), max(values))
+
+class benchdaemon(pyrasol.MyDaemon):
+    def __init__(self, poll=False):
+        pyrasol.MyDaemon.__init__(self, '.pyrasol.pid')
+        self.poll = poll
+
+    def setupsignals(self):
+        if not self.poll:
+            pyrasol.MyDaemon.setupsignals(self)
+
+    def postRun(self):
+        pass
+
+def rundaemon(d):
+    # keep the daemon's per-job chatter out of the benchmark report, and hand
+    # the daemon back so callers can inspect its in-memory batch state
+    olderr = sys.stderr
+    sys.stderr = open('err.log', 'a')
+    try:
+        try:
+            d.run()
+        except SystemExit:
+            pass
+    finally:
+        sys.stderr.close()
+        sys.stderr = olderr
+    return d
+
+def setupbatch(cmdbatches, maxjobs):
+    sb = superbatch(cmdbatches=cmdbatches)
+    sb.write()
+
+    p = params()
+    p.setparam("maxjobs", str(maxjobs))
+    p.setparam("maxjobtime", "-1")
+    p.write()
+
+def benchlatency(args):
+    """
+    Exit-to-next-start latency: one slot, a chain of short jobs that each
+    record the moment they exit.  The gap between that moment and the start
+    of the following job is pure scheduler overhead.
+    """
+    njobs    = 20
+    duration = 0.1
+    poll     = False
+    for a in args:
+        if a == '--poll':
+            poll = True
+        elif a.startswith('--jobs='):
+            njobs = int(a.split('=')[1])
+        elif a.startswith('--duration='):
+            duration = float(a.split('=')[1])
+
+    tmpdir = tempfile.mkdtemp(prefix='pyrabench.')
+    cwd = os.getcwd()
+    os.chdir(tmpdir)
+    try:
+        stamp = "%s -c 'import time; print(repr(time.time()))'" % sys.executable
+        cmds = []
+        for i in range(njobs):
+            cmds.append('sleep %g; %s > exit.%d' % (duration, stamp, i))
+        setupbatch([('latency', cmds)], 1)
+
+        t0 = time.time()
+        d = rundaemon(benchdaemon(poll))
+        elapsed = time.time() - t0
+
+        # use the in-memory state, the state file rounds times to 10ms
+        jobs = d.sb.batches[0].jobs
+
+        latency = []
+        for i in range(len(jobs) - 1):
+            exited = float(open('exit.%d' % i).read())
+            latency.append(jobs[i + 1].start - exited)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+    if poll:
+        mode = 'poll'
+    else:
+        mode = 'event'
+    print 'dispatch latency (%s mode, %d jobs of %gs, 1 slot):' % (mode, njobs, duration)
+    print summarize('exit-to-next-start (s)', latency)
+    print '  wall clock: %.2fs (ideal %.2fs)' % (elapsed, njobs * duration)
+
+class legacyjob:
+    # the object-per-job representation pyraclass used before its columnar
+    # store, kept here to compare against
+    def __init__(self, cmd=None, pid=-1, node=-1, start=-1.0, stop=-1.0, status='pending'):
+        self.cmd    = cmd
+        self.pid    = pid
+        self.node   = node
+        self.start  = start
+        self.stop   = stop
+        self.status = status
+
+    def read(self, str):
+        fields = str.split('\t')
+        self.cmd    = fields[0][1:-1]
+        self.pid    = int(fields[1])
+        self.node   = int(fields[2])
+        self.start  = float(fields[3])
+        self.stop   = float(fields[4])
+        self.status = fields[5]
+
+class legacybatch:
+    def __init__(self, name):
+        self.name = name
+        self.jobs = []
+
+    def read(self, joblist):
+        for line in joblist:
+            j = legacyjob()
+            j.read(line)
+            self.jobs.append(j)
+
+def legacyread(fname):
+    batches   = []
+    joblist   = []
+    batchname = None
+
+    inFile = gzip.open(fname, 'rb')
+    for line in inFile:
+        line = line.strip()
+        if line.startswith('>'):
+            if batchname is not None and len(joblist) > 0:
+                b = legacybatch(batchname)
+                b.read(joblist)
+                batches.append(b)
+                joblist = []
+            batchname = line[1:].split()[0]
+        elif batchname is not None:
+            joblist.append(line)
+
+    if batchname is not None and len(joblist) > 0:
+        b = legacybatch(batchname)
+        b.read(joblist)
+        batches.append(b)
+    inFile.close()
+    return batches
+
+def benchmemoryload(args):
+    # child of benchmemory: load one state file, report seconds and KB
+    variant, fname = args
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    if variant == 'legacy':
+        batches = legacyread(fname)
+    else:
+        sb = superbatch(fname=fname)
+        sb.read()
+    elapsed = time.time() - t0
+    print elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+def benchmemory(args):
+    """
+    Memory and load time of a finished superbatch, with the object-per-job
+    classes pyrasol used to have versus the current columnar batches.
+    """
+    njobs = 1000000
+    for a in args:
+        if a.startswith('--jobs='):
+            njobs = int(a.split('=')[1])
+
+    tmpdir = tempfile.mkdtemp(prefix='pyrabench.')
+    fname = os.path.join(tmpdir, 'pybatch.gz')
+    try:
+        outFile = gzip.open(fname, 'wb')
+        outFile.write('>memory\n')
+        t = 1300000000.0
+        lines = []
+        for i in xrange(njobs):
+            lines.append('"nice -n 15 align.sh sample%d.fq"\t%d\t%d\t%.2f\t%.2f\tcompleted\tpgid=%d\n' %
+                         (i, 10000 + i, i % 64, t + i, t + i + 7.5, 10000 + i))
+            if len(lines) == 10000:
+                outFile.write(''.join(lines))
+                lines = []
+        outFile.write(''.join(lines))
+        outFile.close()
+
+        print 'memory and load time of a %d job superbatch:' % njobs
+        results = {}
+        for variant in ['legacy', 'compact']:
+            p = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'memory-load', variant, fname],
+                                 stdout=subprocess.PIPE)
+            elapsed, kb = p.communicate()[0].split()
+            results[variant] = (float(elapsed), int(kb))
+            print '  %-8s load %.2fs, %.1f MB, %.0f bytes/job' % \
+                  (variant, float(elapsed), int(kb) / 1024.0, int(kb) * 1024.0 / njobs)
+        print '  compact uses %.1fx less memory' % (float(results['legacy'][1]) / max(1, results['compact'][1]))
+    finally:
+        shutil.rmtree(tmpdir)
+
+WORKLOADS = {
+    'noop'  : ['true'],
+    'sleep' : ['sleep 0.01'],
+    'mixed' : ['true', 'sleep 0.01', 'sleep 0.05', 'true', 'sleep 0.2'],
+}
+
+def workload(name, njobs):
+    cmds = WORKLOADS[name]
+    for i in xrange(njobs):
+        yield cmds[i % len(cmds)]
+
+def jsonline(d):
+    # one flat record, keys sorted, for diffing runs against each other
+    items = []
+    keys = d.keys()
+    keys.sort()
+    for key in keys:
+        value = d[key]
+        if isinstance(value, str):
+            value = '"%s"' % value
+        elif isinstance(value, float):
+            value = '%.6f' % value
+        items.append('"%s": %s' % (key, value))
+    return '{' + ', '.join(items) + '}'
+
+def cputime():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+class suitedaemon(benchdaemon):
+    # times every pass of the loop, stops after a time budget, and pairs
+    # each job exit with the next start to get the dispatch latency
+    def __init__(self, seconds):
+        benchdaemon.__init__(self)
+        self.seconds  = seconds
+        self.began    = None  # first job started
+        self.ended    = None  # last pass finished
+        self.ticks    = []    # cpu seconds per pass
+        self.exits    = []  # SIGCHLD times not yet followed by a start
+        self.latency  = []
+        self.started  = 0
+
+    def onchild(self, signum, frame):
+        self.exits.append(time.time())
+        benchdaemon.onchild(self, signum, frame)
+
+    def pushjob(self, job, node):
+        benchdaemon.pushjob(self, job, node)
+        if self.began is None:
+            self.began = time.time()
+        self.started += 1
+        if len(self.exits) > 0:
+            self.latency.append(time.time() - self.exits.pop(0))
+
+    def update(self):
+        t = cputime()
+        benchdaemon.update(self)
+        self.ticks.append(cputime() - t)
+        self.ended = time.time()
+
+        if self.began is not None and self.ended - self.began >= self.seconds:
+            self.params.setparam('killjobs', '1')
+
+def benchsuiterun(args):
+    # child of benchsuite: one workload and size in the current directory,
+    # prints one record
+    name, njobs, slots, seconds = args[0], int(args[1]), int(args[2]), float(args[3])
+
+    outFile = open('.config', 'w')
+    outFile.write('localhost\t%d\n' % slots)
+    outFile.close()
+
+    t0 = time.time()
+    sb = superbatch()
+    sb.create([(name, workload(name, njobs), {})])
+    create = time.time() - t0
+
+    t0 = time.time()
+    sb = superbatch()
+    sb.read()
+    read = time.time() - t0
+
+    t0 = time.time()
+    sb.compact()
+    write = time.time() - t0
+    sb = None
+
+    p = params()
+    p.setparam("maxjobs", str(slots))
+    p.setparam("maxjobtime", "-1")
+    p.write()
+
+    d = rundaemon(suitedaemon(seconds))
+    if d.began is None:
+        elapsed = 0.0
+    else:
+        elapsed = d.ended - d.began
+    ticks = d.ticks[1:]  # the first pass loads the batch
+
+    r = {}
+    r['workload']      = name
+    r['jobs']          = njobs
+    r['slots']         = slots
+    r['dispatched']    = d.started
+    r['elapsed_s']     = elapsed
+    r['jobs_per_s']    = d.started / max(elapsed, 1e-9)
+    r['latency_p50_s'] = percentile(d.latency, 50)
+    r['latency_p95_s'] = percentile(d.latency, 95)
+    r['ticks']         = len(ticks)
+    r['tick_cpu_p50_s'] = percentile(ticks, 50)
+    r['tick_cpu_p95_s'] = percentile(ticks, 95)
+    r['tick_cpu_max_s'] = max([0.0] + ticks)
+    r['create_s']      = create
+    r['read_s']        = read
+    r['write_s']       = write
+    r['rss_mb']        = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print jsonline(r)
+
+def benchsuite(args):
+    """
+    Scheduler throughput on synthetic superbatches.  Every workload and size
+    runs the real daemon loop against a local-only .config in a fresh process,
+    and one JSON record per run is printed, so runs can be compared over time.
+    """
+    sizes     = [1000, 10000, 100000]
+    workloads = ['noop', 'sleep', 'mixed']
+    slots     = 16
+    seconds   = 10.0
+    for a in args:
+        if a.startswith('--sizes='):
+            sizes = [int(float(x)) for x in a.split('=')[1].split(',')]
+        elif a.startswith('--workloads='):
+            workloads = a.split('=')[1].split(',')
+        elif a.startswith('--slots='):
+            slots = int(a.split('=')[1])
+        elif a.startswith('--seconds='):
+            seconds = float(a.split('=')[1])
+
+    for name in workloads:
+        if name not in WORKLOADS:
+            print >> sys.stderr, 'unknown workload: %s' % name
+            sys.exit(1)
+
+    script = os.path.abspath(__file__)
+    for name in workloads:
+        for njobs in sizes:
+            tmpdir = tempfile.mkdtemp(prefix='pyrabench.')
+            try:
+                p = subprocess.Popen([sys.executable, script, 'suite-run', name,
+                                      str(njobs), str(slots), str(seconds)],
+                                     cwd=tmpdir, stdout=subprocess.PIPE)
+                sys.stdout.write(p.communicate()[0])
+                sys.stdout.flush()
+            finally:
+                shutil.rmtree(tmpdir)
+
+def listschedule(times, slots):
+    # makespan of running times in this order, each on the slot that frees first
+    heap = [0.0] * slots
+    for t in times:
+        heapq.heapreplace(heap, heap[0] + t)
+    return max(heap)
+
+def peakslots(starts, stops):
+    events = [(t, 1) for t in starts] + [(t, -1) for t in stops]
+    events.sort()
+    n = peak = 0
+    for t, d in events:
+        n += d
+        peak = max(peak, n)
+    return peak
+
+def benchmakespan(args):
+    """
+    Makespan of recorded batches, replayed on the same number of slots in
+    file order and longest-first: by the runtimes the jobs actually had,
+    and by the runtimes .pyrasol.history predicts for them.
+    """
+    fname = 'pybatch.gz'
+    slots = None
+    for a in args:
+        if a.startswith('--slots='):
+            slots = int(a.split('=')[1])
+        else:
+            fname = a
+
+    sb = superbatch(fname=fname)
+    if not sb.exists():
+        print >> sys.stderr, 'no batch data: %s' % fname
+        sys.exit(1)
+    sb.read()
+    hist = history(os.path.join(os.path.dirname(os.path.abspath(fname)), HIST_FILE))
+    hist.load()
+
+    print 'makespan by dispatch order (%s):' % fname
+    for b in sb.batches:
+        cmds, times, starts, stops = [], [], [], []
+        for j in b.jobs:
+            if j.iscompleted() or j.iscrashed():
+                cmds.append(j.cmd)
+                times.append(j.runningtime())
+                starts.append(j.start)
+                stops.append(j.stop)
+        if len(times) == 0:
+            continue
+
+        n = slots or peakslots(starts, stops)
+        bound = max(sum(times) / n, max(times))
+        print '  %s: %d jobs on %d slots, recorded %.1fs, lower bound %.1fs' % \
+              (b.name, len(times), n, max(stops) - min(starts), bound)
+
+        filemk = listschedule(times, n)
+        lptmk  = listschedule(sorted(times, reverse=True), n)
+        print '    file order        %10.1fs' % filemk
+        print '    lpt (actual)      %10.1fs  %+.1f%%' % (lptmk, 100.0 * (lptmk - filemk) / filemk)
+
+        # the daemon's lpt: predicted longest first, unknown jobs first of all
+        keys = []
+        for i in range(len(times)):
+            t = hist.predict(cmds[i])
+            if t is None:
+                t = 1e300
+            keys.append((-t, i))
+        keys.sort()
+        histmk = listschedule([times[i] for t, i in keys], n)
+        print '    lpt (history)     %10.1fs  %+.1f%%' % (histmk, 100.0 * (histmk - filemk) / filemk)
+
+BENCHMARKS = {
+    'latency'     : benchlatency,
+    'memory'      : benchmemory,
+    'memory-load' : benchmemoryload,
+    'suite'       : benchsuite,
+    'suite-run'   : benchsuiterun,
+    'makespan'    : benchmakespan,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print "Usage: "
+        print "  pyrabench.py [benchmark] [options]"
+        print "Benchmarks:"
+        print "  latency [--jobs=N] [--duration=S] [--poll] : exit-to-next-start dispatch latency"
+        print "  memory [--jobs=N]                           : memory and load time of the job store"
+        print "  suite [--sizes=N,..] [--workloads=W,..] [--slots=N] [--seconds=S]"
+        print "                                              : throughput on synthetic batches, JSON lines"
+        print "  makespan [--slots=N] [pybatch.gz]           : recorded batches replayed in file and lpt order"
+        sys.exit(0)
+
+    BENCHMARKS[sys.argv[1]](sys.argv[2:])
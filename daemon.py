@@ -6,7 +6,7 @@
 # by Jurgen Hermann, Noah Spurrier, et al.
 #-------------------------------------------------------------------------------
 
-import sys, os, time, atexit
+import sys, os, time, atexit, errno
 from signal import SIGTERM 
 
 class Daemon:
@@ -67,6 +67,18 @@ class Daemon:
 	def delpid(self):
 		os.remove(self.pidfile)
 
+	def isalive(self, pid):
+		try:
+			os.kill(pid, 0)
+		except OSError, e:
+			return e.errno == errno.EPERM
+		try:
+			# a zombie only waits for init to reap it
+			stat = open('/proc/%d/stat' % pid).read()
+			return stat[stat.rfind(')') + 2] != 'Z'
+		except IOError:
+			return True
+
 	def start(self):
 		"""
 		Start the daemon
@@ -79,6 +91,11 @@ class Daemon:
 		except IOError:
 			pid = None
 	
+		if pid and not self.isalive(pid):
+			# left behind by a daemon that died without cleaning up
+			os.remove(self.pidfile)
+			pid = None
+
 		if pid:
 			message = "pidfile %s already exist. Daemon already running?\n"
 			sys.stderr.write(message % self.pidfile)
@@ -25,8 +25,15 @@
 #-------------------------------------------------------------------------------
 
 
-import os, sys, math, string, shlex, subprocess, datetime
+import os, sys, math, gzip, string, shlex, shutil, subprocess, datetime
 from pyraclass import *
+from pyrachannel import SSH_DIR
+from pyracontrol import request
+from pyramemo import memoprefix
+from pyrawrap import JOBS_DIR
+from pyralog import LOG_DIR, readindex, readlog
+from pyratrace import TRACE_FILE, writetrace, opentrace
+from pyrametrics import METRICS_FILE
 
 MAX_JOB_DEF = 2
 MAX_JOB_TIME_DEF = -1 # -1 means no limit on job time
@@ -45,59 +52,119 @@ def readCmdsFromFile(fname):
     inFile.close()
     return cmds
     
-def readBatchesFromFile(fname):
-    # list of tuples [(name1, cmds1), (name2, cmds2), ...]
+def openJobList(fname):
+    # job lists may be plain, gzipped, or '-' for stdin
+    if fname == '-':
+        return sys.stdin
+    elif fname.endswith('.gz'):
+        return gzip.open(fname, 'rb')
+    return open(fname)
+
+def readBatchesFromFile(fname, stats=None):
+    # generator of tuples (name, cmds, opts), where cmds is itself a generator
+    # over the batch's commands that must be used up before the next batch.
+    # repeats of a memo job are dropped and counted in stats['duplicates'].
+    # a bad line raises ValueError, saying which
     
-    inFile = open(fname)
-    batches = []
+    inFile = openJobList(fname)
+    state = {'header' : '>unnamed', 'line' : 0}  # header of the batch to read next
+    if stats is None:
+        stats = {}
+    stats['duplicates'] = 0
+    seen = set()  # memo jobs read so far
 
     cwd = ''
-    name = 'unnamed'
-    cmds = []
-    for line in inFile:
-        line = line.strip()
-        if line.startswith('>'):
-            if len(cmds) > 0:
-                val = (name, cmds)
-                batches.append(val)
-            name = line[1:].split()[0]
-            cmds = []
-        else:
-            cmd = line
+    def readCmds():
+        for line in inFile:
+            state['line'] += 1
+            line = line.strip()
+            if line.startswith('>'):
+                state['header'] = line
+                return
+            cmd, opts = parseprefix(line)
             if cmd == '':
                 continue
             cmd = 'nice -n %d %s' % (NICE_DEF, os.path.join(cwd, cmd))
-            cmds.append(cmd)
-
-    if len(cmds) > 0:
-        val = (name, cmds)
-        batches.append(val)
-        
-    inFile.close()
-    return batches
+            try:
+                fields = parserequest(opts)
+            except ValueError, err:
+                raise ValueError("line %d: @%s" % (state['line'], err))
+
+            # memo, nospec and dependency options stay with the command, the
+            # daemon strips them
+            prefix = memoprefix(opts)
+            if prefix != '':
+                cmd = prefix + ' ' + cmd
+                if 'array' not in opts:
+                    if cmd in seen:
+                        stats['duplicates'] += 1
+                        continue
+                    seen.add(cmd)
+            if 'nospec' in opts:
+                cmd = '@nospec ' + cmd
+            for key in ['key', 'after']:
+                if opts.get(key, '') != '':
+                    cmd = '@%s=%s %s' % (key, opts[key], cmd)
+            if 'array' in opts:
+                try:
+                    a = cmdarray(cmd, fields)
+                except (ValueError, IOError), err:
+                    raise ValueError("line %d: %s" % (state['line'], err))
+                yield a
+            elif len(fields) > 0:
+                yield cmd, fields
+            else:
+                yield cmd
+        state['header'] = None
+
+    while state['header'] is not None:
+        name, opts = parseheader(state['header'])
+        if checkheader(opts) is not None:
+            raise ValueError("line %d: %s" % (state['line'], checkheader(opts)))
+        state['header'] = None
+        yield name, readCmds(), opts
+
+    if inFile is not sys.stdin:
+        inFile.close()
 
 def pycreate(args):
     if len(args) != 1:
-        print "Usage: pyra.py create jobs.list"
+        print "Usage: pyra.py create jobs.list|jobs.list.gz|-"
         sys.exit(0)
 
-    batches = readBatchesFromFile(args[0])    
-    sb = superbatch(cmdbatches=batches)
-    
+    sb = superbatch()
     if sb.exists():
         print "Warning: Batch data already exists in directory"
         print "  Use 'pyra.py clean' to remove batch data"
         sys.exit(0)
-    sb.write()
+    stats = {}
+    try:
+        created = sb.create(readBatchesFromFile(args[0], stats))
+    except ValueError, err:
+        print "Error: %s %s" % (args[0], err)
+        print "  No batch data was created"
+        sys.exit(1)
 
     p = params()
     p.setparam("maxjobs", str(MAX_JOB_DEF))
     p.setparam("maxjobtime", str(MAX_JOB_TIME_DEF))
     p.write()
 
-    print "  Created %d jobs in %d batches:" % (sb.total(), len(sb.batches))
-    for b in sb.batches:
-        print "\t%s : %d jobs" % (b.name, b.total())
+    total = 0
+    for name, n, opts in created:
+        total += n
+    print "  Created %d jobs in %d batches:" % (total, len(created))
+    names = {}
+    for name, n, opts in created:
+        print "\t%s : %d jobs" % (name, n)
+        names[name] = True
+    if stats['duplicates'] > 0:
+        print "  Dropped %d repeated memo jobs" % stats['duplicates']
+    for name, n, opts in created:
+        b = batch(name, opts=opts)
+        for other in b.after():
+            if other not in names:
+                print "  Warning: batch '%s' waits for unknown batch '%s'" % (name, other)
 
     # default these - sucks that the variable has to live in both notification class and here, but
     # we only want to load the notification class if these exist
@@ -137,38 +204,49 @@ def pyclean():
     sb = superbatch()
     sb.clean()
 
+    for dirname in [SSH_DIR, JOBS_DIR, LOG_DIR]:
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+    if os.path.exists(METRICS_FILE):
+        os.remove(METRICS_FILE)
+
     print "  Cleaned up all batch temporary data."
     
-def pystop():
+def setparam(key, value):
+    # hand the change to the running daemon so it applies at once, or write
+    # the params file for the next push when no daemon is listening
+    reply = request('param %s %s' % (key, value))
+    if reply is not None and reply.startswith('ok'):
+        return
+
     p = params()
     p.read()
-    #p.setparam("maxjobs", str(MAX_JOB_DEF))
-    p.setparam("killjobs", "1")
+    p.setparam(key, str(value))
     p.write()
 
+    if os.path.exists('.pyrasol.pid'):
+        print "  Warning: pyrasol daemon is not answering, change takes effect on its next pass."
+
+def pystop():
+    setparam("killjobs", "1")
+
     print "  Killing all running jobs, stopping pyrasol daemon."
 
 def pymaxjob(maxjob):
-    p = params()
-    p.read()
-    p.setparam("maxjobs", str(maxjob))
-    p.write()
+    setparam("maxjobs", maxjob)
 
     print "  Max job set to %d" % maxjob
 
 def pymaxjobtime(maxjobtime):
-    p = params()
-    p.read()
-    p.setparam("maxjobtime", str(maxjobtime))
-    p.write()
+    setparam("maxjobtime", maxjobtime)
 
     print "  Max job time set to %d seconds" % maxjobtime
 
 def pyparam(param,value):
-    p = params()
-    p.read()
-    p.setparam(param, str(value))
-    p.write()
+    if badparam(param, str(value)):
+        print "  %s" % badparam(param, str(value))
+        return
+    setparam(param, value)
 
     print "  %s set to %s" % (param, str(value))
 
@@ -184,18 +262,30 @@ def pynotification(type):
     p = params()
     p.read()
     if p.getparam(paramName) == "on":
-        p.setparam(paramName, "off")
+        setparam(paramName, "off")
         print "  %s notifications disabled" % (type)
     else:
-        p.setparam(paramName, "on")
+        setparam(paramName, "on")
         print "  %s notifications enabled" % (type)
-        
-    p.write()
 
    
-def pytime():
+def readnodes():
+    # hosts as the daemon has them before any worker connects
+    p = params()
+    p.read()
     n = nodes()
-    n.read()
+    n.read(p.getparam("workerport") in (None, "off"))
+    return n
+
+def pytime():
+    # a running daemon answers from its in-memory totals, otherwise load
+    # and scan the whole batch
+    reply = request('time')
+    if reply is not None and reply.startswith('ok\n'):
+        print reply[3:]
+        return
+
+    n = readnodes()
     sb = superbatch()
     if not sb.exists():
         print "  Batch data for pyrasol does not exist."
@@ -205,6 +295,15 @@ def pytime():
     print sb.info(n)
     
 
+def pymetrics():
+    reply = request('metrics')
+    if reply is None:
+        print "  pyrasol daemon is not running."
+    elif reply.startswith('ok\n'):
+        print reply[3:]
+    else:
+        print "  %s" % reply.strip()
+
 def pycrashed():
     sb = superbatch()
     sb.read()
@@ -215,7 +314,114 @@ def pycrashed():
         print "  Crashed jobs from batch '%s'" % b.name
         for j in b.jobs:
             if j.iscrashed():
-                print '\t', j.cmd
+                print '\t%s:%d\t%s' % (b.name, j.index, j.cmd)
+        if b.blocked() > 0:
+            print "  Blocked jobs from batch '%s'" % b.name
+            for j in b.jobs:
+                if j.isblocked():
+                    print '\t%s:%d\t%s' % (b.name, j.index, j.cmd)
+
+def pylog(jobid):
+    # stdout and stderr of job 'batch:index' (batch by name or number, the
+    # first if left out), straight from its files
+    if jobid.find(':') >= 0:
+        name, i = jobid.rsplit(':', 1)
+        names = readindex()
+        if name in names:
+            bi = names[name]
+        elif name.isdigit():
+            bi = int(name)
+        else:
+            print "  No batch named '%s' has run" % name
+            return
+    else:
+        bi, i = 0, jobid
+    if not i.isdigit():
+        print "  Usage: pyra.py log [batch:]index"
+        return
+
+    out = readlog(bi, int(i), 'out')
+    err = readlog(bi, int(i), 'err')
+    if out is None and err is None:
+        print "  No output from job %s" % jobid
+        return
+    if out is not None:
+        sys.stdout.write(out)
+    if err is not None:
+        sys.stderr.write(err)
+
+def pytrace(fname=TRACE_FILE):
+    # lifecycle of every job started so far as a Chrome trace, - for stdout
+    sb = superbatch()
+    if not sb.exists():
+        print "  Batch data for pyrasol does not exist."
+        return
+    sb.read()
+    n = readnodes()
+
+    if fname == '-':
+        writetrace(sb, n, sys.stdout)
+        return
+    outFile = opentrace(fname)
+    njobs = writetrace(sb, n, outFile)
+    outFile.close()
+    if njobs == 0:
+        os.remove(fname)
+        print "  No jobs have started yet."
+    else:
+        print "  Wrote %d jobs to %s, open it in ui.perfetto.dev or chrome://tracing" % (njobs, fname)
+
+def sizestring(kb):
+    if kb < 1024:
+        return '%dK' % kb
+    elif kb < 1024 * 1024:
+        return '%.1fM' % (kb / 1024.)
+    return '%.1fG' % (kb / 1024. / 1024.)
+
+def usageinfo(b):
+    # resource usage of batch b's finished jobs that have it, as lines of
+    # pyra inspect: cpu efficiency, memory percentiles, i/o and the jobs
+    # that used the most memory and left the most of their cores idle
+    cpu = wall = 0.0
+    rss = []
+    eff = []
+    reqmem = 0
+    ioin = ioout = 0
+    for j in b.jobs:
+        if (not j.iscompleted() and not j.iscrashed()) or j.utime < 0:
+            continue
+        cores, mem = j.request()
+        t = j.stop - max(j.began, j.start)
+        cpu  += j.utime + j.stime
+        wall += t * cores
+        rss.append((j.maxrss, j.index))
+        if t >= 1.0:
+            eff.append(((j.utime + j.stime) / (t * cores), j.index))
+        reqmem = max(reqmem, mem)
+        ioin  += b.get('inblock', j.index)
+        ioout += b.get('oublock', j.index)
+    if len(rss) == 0:
+        return []
+
+    rss.sort()
+    eff.sort()
+    pct = []
+    for p in [50, 90, 99]:
+        pct.append('%d%% %s' % (p, sizestring(rss[int(p / 100. * (len(rss) - 1))][0])))
+    pct.append('max %s' % sizestring(rss[-1][0]))
+
+    lines = []
+    lines.append('\tcpu efficiency : %.0f%% of the cores requested (%d jobs)' % (100. * cpu / max(wall, 1e-9), len(rss)))
+    s = '\tmax rss        : ' + ', '.join(pct)
+    if reqmem > 0:
+        s += ' (requested %s)' % sizestring(reqmem * 1024)
+    lines.append(s)
+    lines.append('\tblock i/o      : %s read, %s written' % (sizestring(ioin / 2), sizestring(ioout / 2)))
+    for kb, i in rss[-1:-4:-1]:
+        lines.append('\t  most memory  : %s\t%s:%d\t%s' % (sizestring(kb), b.name, i, b.cmds[i]))
+    for e, i in eff[:3]:
+        lines.append('\t  least cpu    : %.0f%%\t%s:%d\t%s' % (100. * e, b.name, i, b.cmds[i]))
+    return lines
 
 def pyinspect(batchname=None):
     if batchname is not None:
@@ -231,7 +437,7 @@ def pyinspect(batchname=None):
         starts = []
         stops = []
         for j in b.jobs:
-            if j.ispending():
+            if j.ispending() or j.isblocked():
                 continue
             times.append(j.runningtime())
             starts.append(j.start)
@@ -283,6 +489,8 @@ def pyinspect(batchname=None):
         print '\tavg time (all) : %s +/- %s' % (timestring(avgtall), timestring(stdall))
         print '\ttotal time (95%%) : %s' % (timestring(rtime95))
         print '\tavg time (95%%) : %s +/- %s' % (timestring(avgt), timestring(std))
+        for line in usageinfo(b):
+            print line
         
 def main(cmd, args):
     cmd = cmd.lower()
@@ -306,6 +514,15 @@ def main(cmd, args):
         pynotification(args[0])
     elif cmd == 'crashed':
         pycrashed()
+    elif cmd == 'log':
+        pylog(args[0])
+    elif cmd == 'metrics':
+        pymetrics()
+    elif cmd == 'trace':
+        if len(args) == 1:
+            pytrace(args[0])
+        else:
+            pytrace()
     elif cmd == 'inspect':
         if len(args) == 1:
             pyinspect(args[0])
@@ -319,16 +536,20 @@ if __name__ == '__main__':
         print "Usage: "
         print "  pyra.py [command]"
         print "Commands:"
-        print "  create job.list  : create a batch of jobs from file"
+        print "  create job.list  : create a batch of jobs from file (.gz, or - for stdin)"
         print "  clean            : cleans up tmp files"
         print "  push             : push jobs"
         print "  time             : check time / status of running jobs"
         print "  stop             : kill all running jobs and stop pyrasol"
         print "  maxjob INT       : set max jobs"
         print "  maxjobtime INT   : set max job time in seconds"
+        print "  param NAME VALUE : set a daemon parameter (e.g. schedule concurrent)"
         print "  notification TYPE: enable/disable notification (options: prowl,email)"
 
-        print "  crashed          : list crashed jobs"
+        print "  crashed          : list crashed and blocked jobs"
+        print "  log [BATCH:]JOB  : print a job's output"
+        print "  metrics          : print the daemon's metrics (Prometheus text format)"
+        print "  trace [FILE]     : write the jobs' lifecycle as a Chrome trace (default %s)" % TRACE_FILE
         print "  inspect batch.gz : compute summary of batch"
         sys.exit(0)
 
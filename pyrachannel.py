@@ -0,0 +1,113 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+#
+# Persistent ssh connections to remote nodes. One OpenSSH control master is
+# kept per host, and every job for that host is sent as a multiplexed session
+# over it, so a job no longer pays for its own ssh handshake.
+#
+
+import os, sys, time, signal, subprocess
+from pyralog import log
+from pyrametrics import metrics
+
+SSH_DIR      = '.pyrasol.ssh'  # control sockets, one per host
+PREWARM_TIME = 5               # seconds to wait for masters at startup
+RETRY_TIME   = 30              # seconds between reconnects to a broken host
+
+class channels:
+    def __init__(self, dirname=SSH_DIR):
+        self.dirname = dirname
+        self.masters = {}  # addr -> Popen of the control master
+        self.started = {}  # addr -> time the master was (re)started
+
+    def path(self, addr):
+        return os.path.join(self.dirname, addr)
+
+    def options(self, addr):
+        # a session never becomes a master itself, and falls back to a plain
+        # connection if the master is not up (yet)
+        return '-o ControlMaster=no -o ControlPath=%s' % self.path(addr)
+
+    def connect(self, addr):
+        if not os.path.exists(self.dirname):
+            os.mkdir(self.dirname, 0700)
+        if os.path.exists(self.path(addr)):
+            os.remove(self.path(addr))  # left over from a dead master
+
+        args = ['ssh', '-M', '-N', '-o', 'BatchMode=yes',
+                '-o', 'ServerAliveInterval=15', '-o', 'ServerAliveCountMax=3',
+                '-o', 'ControlPath=%s' % self.path(addr), addr]
+        null = open(os.devnull, 'r+')
+        try:
+            # own session, so killing jobs never takes a master down with them
+            p = subprocess.Popen(args, stdin=null, stdout=null,
+                                 close_fds=True, preexec_fn=os.setsid)
+            metrics.count('pyrasol_spawned_total', kind='ssh')
+        except OSError, err:
+            log.error("unable to start ssh master for %s: %s", addr, err)
+            p = None
+        null.close()
+
+        self.masters[addr] = p
+        self.started[addr] = time.time()
+
+    def open(self, addrs):
+        for addr in addrs:
+            if addr != 'localhost' and addr not in self.masters:
+                self.connect(addr)
+
+        # pre-warm: give the masters a moment so the first jobs use them
+        t = time.time()
+        while time.time() - t < PREWARM_TIME and not self.ready():
+            time.sleep(0.1)
+
+    def ready(self):
+        for addr in self.masters:
+            p = self.masters[addr]
+            if p is not None and p.poll() is None and not os.path.exists(self.path(addr)):
+                return False
+        return True
+
+    def check(self):
+        # reconnect masters that exited, ServerAlive* makes hung ones exit
+        now = time.time()
+        for addr in self.masters.keys():
+            p = self.masters[addr]
+            if p is not None and p.poll() is None:
+                continue
+            if now - self.started[addr] >= RETRY_TIME:
+                log.warning("ssh master for %s is down, reconnecting", addr)
+                self.connect(addr)
+
+    def close(self):
+        for addr in self.masters:
+            p = self.masters[addr]
+            if p is not None and p.poll() is None:
+                try:
+                    os.kill(p.pid, signal.SIGTERM)
+                    p.wait()
+                except OSError:
+                    pass
+        self.masters = {}
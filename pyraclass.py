@@ -1,8 +1,19 @@
-import os, sys, string, time, gzip, math
+import os, sys, string, time, gzip, math, heapq, bisect, re
+from array import array
+from collections import deque
 
 CRASH_CHAR = 'X'
 COMP_CHAR  = '*'
 RUN_CHAR   = 'r'
+BLOCK_CHAR = '-'
+
+JOURNAL_MIN = 10000  # journal records kept before folding them into a snapshot
+GZIP_LEVEL  = 6      # compression of snapshots, 9 costs far more time than it saves space
+WRITE_LINES = 10000  # job records buffered per write
+
+LOCAL_SLOTS   = 1000      # slots on localhost when there is no .config
+PLACEMENT_DEF = 'spread'  # see nodes
+PLACEMENTS    = ['spread', 'leastloaded', 'pack']
 
 def timestring(t):
     h = int(math.floor(t / 60. / 60.))
@@ -24,54 +35,310 @@ def timestring(t):
                 
     return ':'.join([h, m, s])
             
+def parseheader(line):
+    # '>name key=value ...' -> (name, {key : value})
+    fields = line[1:].split()
+    opts = {}
+    for f in fields[1:]:
+        if f.find('=') > 0:
+            key, value = f.split('=', 1)
+            opts[key] = value
+    return fields[0], opts
+
+def parseprefix(line):
+    # '@key=value ... cmd' -> (cmd, {key : value}), options a job line may
+    # start with. '@key' alone gets the value ''
+    opts = {}
+    while line.startswith('@'):
+        fields = line.split(None, 1)
+        if fields[0].find('=') > 0:
+            key, value = fields[0][1:].split('=', 1)
+        else:
+            key, value = fields[0][1:], ''
+        opts[key] = value
+        if len(fields) == 1:
+            line = ''
+        else:
+            line = fields[1]
+    return line, opts
+
+def optshare(opts, key):
+    # opts[key] as a number above 0, None if it is not one
+    try:
+        value = float(opts.get(key, 1.0))
+    except ValueError:
+        return None
+    if not 0 < value < float('inf'):
+        return None
+    return value
+
+def checkheader(opts):
+    # error message for the first bad option of a batch header, or None
+    for key in ['weight', 'maxshare']:
+        if key in opts and optshare(opts, key) is None:
+            return "%s=%s is not a number above 0" % (key, opts[key])
+    try:
+        parserequest(opts)
+    except ValueError, err:
+        return str(err)
+    return None
+
+MEM_UNITS = {'K' : 1.0 / 1024, 'M' : 1, 'G' : 1024, 'T' : 1024 * 1024}
+
+def parsemem(value):
+    # '16G', '512M', '2048' (megabytes) -> megabytes
+    value = value.strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    if len(value) > 0 and value[-1] in MEM_UNITS:
+        return int(math.ceil(float(value[:-1]) * MEM_UNITS[value[-1]]))
+    return int(math.ceil(float(value)))
+
+def parserequest(opts):
+    # cores/mem options of a job line or batch header -> column values,
+    # ValueError naming the option if one is bad
+    fields = {}
+    if 'cores' in opts:
+        try:
+            fields['cores'] = int(opts['cores'])
+        except ValueError:
+            fields['cores'] = 0
+        if fields['cores'] < 1:
+            raise ValueError("cores=%s is not a whole number above 0" % opts['cores'])
+    if 'mem' in opts:
+        try:
+            fields['mem'] = parsemem(opts['mem'])
+        except ValueError:
+            fields['mem'] = -1
+        if fields['mem'] < 0:
+            raise ValueError("mem=%s is not a size, e.g. 512M or 16G" % opts['mem'])
+    return fields
+
 class nodes:
+    """
+    Slots on the hosts listed in .config ('addr<TAB>numcores[<TAB>mem]' per
+    line). Slot ids are contiguous per host; a job reserves one slot per
+    core it asks for, all on one host, plus its memory if the host lists
+    any. Hosts are handed out through a heap of hosts with free slots,
+    ordered by the placement policy:
+      spread      : host running the fewest jobs
+      leastloaded : host with the smallest fraction of its cores or memory in use
+      pack        : fullest host that still fits the job
+    Hosts of workers (see pyraworker.py) also have a credit, the slots the
+    worker has leased and not been sent jobs for yet; None for other hosts.
+    """
     def __init__(self, maxjob=None):
-        self.nodes     = {}
-        self.fname     = '.config'
-        self.available = {}
+        self.fname  = '.config'
+        self.policy = PLACEMENT_DEF
+
+        self.hosts   = []  # addr of each host
+        self.base    = []  # first slot id of each host
+        self.cores   = []  # number of slots of each host
+        self.limit   = []  # slots of each host the daemon may use right now
+        self.active  = []  # slots in use on each host
+        self.free    = []  # released slot ids of each host, reused first
+        self.next    = []  # lowest never used slot id of each host
+        self.memory  = []  # megabytes of each host, 0 if not limited
+        self.used    = []  # megabytes reserved on each host
+        self.credit  = []  # slots a worker host has leased to us, None if not a worker
+        self.version = []  # bumped on every change, older heap entries are stale
+        self.heap    = []  # (key, host, version) of hosts with free slots
+        self.slots   = {}  # first slot id of a job -> (host, other slot ids, mem)
+
+    def addhost(self, addr, numcores, mem=0, credit=None):
+        h = len(self.hosts)
+        if h == 0:
+            base = 0
+        else:
+            base = self.base[h - 1] + self.cores[h - 1]
+
+        self.hosts.append(addr)
+        self.base.append(base)
+        self.cores.append(numcores)
+        self.limit.append(numcores)
+        self.active.append(0)
+        self.free.append([])
+        self.next.append(base)
+        self.memory.append(mem)
+        self.used.append(0)
+        self.credit.append(credit)
+        self.version.append(0)
+        self.push(h)
+        return h
         
-    def read(self):
+    def read(self, local=True):
+        # local: run on localhost when there is no .config, otherwise only
+        # on the workers that connect
         if not os.path.exists(self.fname):
-            for i in range(1000):
-                self.nodes[i] = 'localhost'
-                self.available[i] = True
-            #print >> sys.stderr, ".config file doesn't exist."
+            # maxjobs is the real limit when running locally
+            if local:
+                self.addhost('localhost', LOCAL_SLOTS)
             return
         
         inFile = open(self.fname)
-        n = 0
         for line in inFile:
-            data = line[:-1].split('\t')
+            data = line.strip().split('\t')
+            if len(data) < 2:
+                continue
 
             addr     = data[0]
             numcores = int(data[1])
-
-            for i in range(numcores):
-                self.nodes[n]     = addr
-                self.available[n] = True
-                n += 1
+            mem      = 0
+            if len(data) > 2:
+                mem = parsemem(data[2])
+            if numcores > 0:
+                self.addhost(addr, numcores, mem)
                 
         inFile.close()
+
+    def setpolicy(self, policy):
+        # unknown policies are left to the caller to report
+        if policy is None or policy == self.policy or policy not in PLACEMENTS:
+            return
+        self.policy = policy
+        self.heap = []
+        for h in range(len(self.hosts)):
+            self.push(h)
+
+    def load(self, h):
+        # fraction of the host's cores or memory in use, whichever is higher
+        load = float(self.active[h]) / self.cores[h]
+        if self.memory[h] > 0:
+            load = max(load, float(self.used[h]) / self.memory[h])
+        return load
+
+    def setlimit(self, h, limit):
+        # cap the slots used on host h below its cores, None lifts the cap
+        if limit is None or limit > self.cores[h]:
+            limit = self.cores[h]
+        self.limit[h] = limit
+        self.push(h)
+
+    def setcredit(self, h, credit):
+        self.credit[h] = credit
+        self.push(h)
+
+    def key(self, h):
+        if self.policy == 'pack':
+            return -self.load(h)
+        elif self.policy == 'leastloaded':
+            return self.load(h)
+        return self.active[h]
+
+    def fits(self, h, cores, mem):
+        if self.credit[h] is not None and self.credit[h] < cores:
+            return False
+        limit = self.limit[h]
+        if self.active[h] == 0:
+            limit = self.cores[h]  # a job larger than the limit runs on its own
+        if limit - self.active[h] < cores:
+            return False
+        return self.memory[h] == 0 or self.memory[h] - self.used[h] >= mem
+
+    def canfit(self, cores=1, mem=0):
+        # whether some host could ever run a job of this size
+        for h in range(len(self.hosts)):
+            if self.cores[h] >= cores and (self.memory[h] == 0 or self.memory[h] >= mem):
+                return True
+        return False
+
+    def push(self, h):
+        self.version[h] += 1
+        if self.active[h] < self.limit[h] and (self.credit[h] is None or self.credit[h] > 0):
+            heapq.heappush(self.heap, (self.key(h), h, self.version[h]))
+
+        # drop stale entries before they outnumber live ones
+        if len(self.heap) > 4 * len(self.hosts) + 16:
+            self.heap = [e for e in self.heap if e[2] == self.version[e[1]]]
+            heapq.heapify(self.heap)
+
+    def gethost(self, n):
+        h = bisect.bisect_right(self.base, n) - 1
+        if h < 0 or n >= self.base[h] + self.cores[h]:
+            return None
+        return h
         
     def getaddr(self, n):
-        if n not in self.nodes:
+        h = self.gethost(n)
+        if h is None:
             return None
-        return self.nodes[n]
+        return self.hosts[h]
+
+    def take(self, h, n):
+        free = self.free[h]
+        if len(free) > 0 and free[-1] == n:
+            free.pop()
+        elif n >= self.next[h]:
+            free.extend(range(self.next[h], n))
+            self.next[h] = n + 1
+        else:
+            free.remove(n)
+
+    def slot(self, h):
+        # lowest cost free slot id of host h, not taken yet
+        if len(self.free[h]) > 0:
+            return self.free[h][-1]
+        return self.next[h]
 
-    def setactive(self, n):
-        if n not in self.available:
+    def setactive(self, n, cores=1, mem=0):
+        h = self.gethost(n)
+        if h is None or n in self.slots:
             return
-        self.available[n] = False
+
+        self.take(h, n)
+        others = []
+        for c in range(min(cores, self.cores[h] - self.active[h]) - 1):
+            others.append(self.slot(h))
+            self.take(h, others[-1])
+
+        self.slots[n] = (h, others, mem)
+        self.active[h] += 1 + len(others)
+        self.used[h] += mem
+        if self.credit[h] is not None:
+            self.credit[h] -= 1 + len(others)
+        self.push(h)
 
     def setavailable(self, n):
-        if n not in self.available:
+        if n not in self.slots:
             return
-        self.available[n] = True
+        h, others, mem = self.slots.pop(n)
+        self.free[h].append(n)
+        self.free[h].extend(others)
+        self.active[h] -= 1 + len(others)
+        self.used[h] -= mem
+        self.push(h)
+
+    def getavailable(self, cores=1, mem=0, avoid=None):
+        # peek at the best free slot for a job of this size, it is only
+        # taken by setactive(). host avoid is only used if no other fits
+        while len(self.heap) > 0:
+            key, h, version = self.heap[0]
+            if version == self.version[h]:
+                break
+            heapq.heappop(self.heap)
+        if len(self.heap) == 0:
+            return None
 
-    def getavailable(self):
-        for n in self.available:
-            if self.available[n]:
-                return n
+        h = self.heap[0][1]
+        if h != avoid and self.fits(h, cores, mem):
+            return self.slot(h)
+
+        # the best host is too full for this job, look for the best that fits
+        best = None
+        for h in range(len(self.hosts)):
+            if h != avoid and self.fits(h, cores, mem) and (best is None or self.key(h) < self.key(best)):
+                best = h
+        if best is None and avoid is not None and self.fits(avoid, cores, mem):
+            best = avoid
+        if best is None:
+            return None
+        return self.slot(best)
+
+def badparam(key, value):
+    # why value will not do for param key, or None
+    if key == 'placement' and value not in PLACEMENTS:
+        return 'placement must be one of %s, not %s' % ('|'.join(PLACEMENTS), value)
+    return None
 
 class params:
     def __init__(self, maxjob=None):
@@ -100,6 +367,9 @@ class params:
             outFile.write(s)
         outFile.close()
 
+        # our own write is not news to us
+        self.time = os.stat(self.fname).st_mtime
+
     def isnew(self):
         if self.time == 0:
             return True
@@ -118,89 +388,406 @@ class params:
     def setparam(self, key, value):
         self.params[key] = value
 
-class job:
-    def __init__(self, cmd=None, pid=-1, node=-1, start=-1.0, stop=-1.0, status='pending'):
-        self.cmd    = cmd
-        self.pid    = pid
-        self.node   = node
-        self.start  = start
-        self.stop   = stop
-        self.status = status
+    def delparam(self, key):
+        if key in self.params:
+            del self.params[key]
+
+# job status codes, as kept in a batch's status column. a blocked job never
+# ran, something it was to run after crashed
+STATUS    = ['pending', 'running', 'completed', 'crashed', 'blocked']
+PENDING   = 0
+RUNNING   = 1
+COMPLETED = 2
+CRASHED   = 3
+BLOCKED   = 4
+
+STATUSCODE = {'pending' : PENDING, 'running' : RUNNING, 'completed' : COMPLETED, 'crashed' : CRASHED,
+              'blocked' : BLOCKED}
+
+# per-job columns of a batch: name -> (array typecode, default). The fixed
+# ones make up a job record, optional ones follow it as key=value and only
+# get a column once some job sets them. A job's lifecycle, in order: ready
+# (free to start), start (dispatched), began (its command started, as its
+# wrapper saw it), stop (exited) and reaped (seen by the daemon). USAGE are
+# the resources it used, as its wrapper saw them
+COLUMNS = {
+    'pid'    : ('i', -1),
+    'node'   : ('i', -1),
+    'start'  : ('d', -1.0),
+    'stop'   : ('d', -1.0),
+    'status' : ('b', PENDING),
+    'pgid'   : ('i', -1),
+    'cores'  : ('H', 0),  # 0 takes the batch's request, or 1
+    'mem'    : ('I', 0),  # megabytes, 0 takes the batch's request
+    'ready'  : ('d', -1.0),
+    'began'  : ('d', -1.0),
+    'reaped' : ('d', -1.0),
+    'utime'  : ('d', -1.0),  # cpu seconds, -1 if unknown
+    'stime'  : ('d', -1.0),
+    'maxrss' : ('I', 0),     # KB
+    'inblock': ('L', 0),     # blocks of 512 bytes
+    'oublock': ('L', 0),
+}
+FIXED    = ['pid', 'node', 'start', 'stop', 'status']
+USAGE    = ['utime', 'stime', 'maxrss', 'inblock', 'oublock']
+OPTIONAL = ['pgid', 'cores', 'mem', 'ready', 'began', 'reaped'] + USAGE
+
+PENDING_STATE = '-1\t-1\t-1.0\t-1.0\tpending'  # job.state() of a new job
+
+CMD_CHUNK = 65536  # commands per sealed string of a cmdstore
+
+ARRAY_SLOT = re.compile(r'(?<!\$)\{((?:[^{}\\]|\\.)*)\}')
+ARRAY_RANGE = re.compile(r'^(-?\d+)\.\.(-?\d+)(?:\.\.(\d+))?$')
+ARRAY_REF   = re.compile(r'^=\d+$')
+
+def splitvalues(text):
+    # 'a,b\,c' -> ['a', 'b,c']
+    values = ['']
+    i = 0
+    while i < len(text):
+        if text[i] == '\\' and i + 1 < len(text):
+            values[-1] += text[i + 1]
+            i += 2
+            continue
+        if text[i] == ',':
+            values.append('')
+        else:
+            values[-1] += text[i]
+        i += 1
+    return values
+
+def joinvalues(values):
+    return ','.join([v.replace('\\', '\\\\').replace(',', '\\,') for v in values])
+
+class cmdarray:
+    """
+    A job array: one command template standing for the cross product of its
+    {1..N}, {1..N..step}, {a,b,c} and {<file} slots, the last slot varying
+    fastest. {=K} repeats the value of the K-th slot, e.g. to name an output
+    after it. Commands are only formatted when asked for. The values of a
+    {<file} slot are kept in the template as {@a,b,c}, which only a stored
+    template (parsearray) reads back as a list, however many there are.
+    """
+    def __init__(self, template, fields=None, stored=False):
+        self.parts  = []  # literal text around the slots
+        self.slots  = []  # dim whose value goes after each part
+        self.dims   = []  # values of each slot, an xrange or a list
+        self.widths = []  # zero padding of range slots
+        self.fields = {}  # requests shared by every job, e.g. cores
+        if fields is not None:
+            self.fields.update(fields)
+
+        pos = 0
+        text = []
+        for m in ARRAY_SLOT.finditer(template):
+            slot = m.group(1)
+            r = ARRAY_RANGE.match(slot)
+            if r is not None:
+                lo, hi = int(r.group(1)), int(r.group(2))
+                step = int(r.group(3) or 1)
+                if hi < lo:
+                    values = xrange(lo, hi - 1, -step)
+                else:
+                    values = xrange(lo, hi + 1, step)
+                width = 0
+                if len(r.group(1)) > 1 and r.group(1).startswith('0'):
+                    width = len(r.group(1))
+            elif slot.startswith('<'):
+                inFile = open(slot[1:].strip())
+                values = [line.strip() for line in inFile if line.strip() != '']
+                inFile.close()
+                slot = '@' + joinvalues(values)  # stored inline, the file may change
+                width = 0
+            elif stored and slot.startswith('@'):
+                values = []
+                if slot != '@':
+                    values = splitvalues(slot[1:])
+                width = 0
+            elif slot.find(',') >= 0:
+                values = splitvalues(slot)
+                width = 0
+            elif ARRAY_REF.match(slot):
+                values = None
+            else:
+                continue  # not a slot, e.g. awk '{print $1}'
+
+            self.parts.append(template[pos:m.start()])
+            text.append(template[pos:m.start()] + '{' + slot + '}')
+            if values is None:
+                self.slots.append(int(slot[1:]) - 1)
+            else:
+                self.slots.append(len(self.dims))
+                self.dims.append(values)
+                self.widths.append(width)
+            pos = m.end()
+        self.parts.append(template[pos:])
+        text.append(template[pos:])
+        self.template = ''.join(text)
+
+        for d in self.slots:
+            if d < 0 or d >= len(self.dims):
+                raise ValueError("{=%d} refers to no slot in: %s" % (d + 1, template))
+
+        self.n = 1
+        for values in self.dims:
+            self.n *= len(values)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        values = []
+        for d in range(len(self.dims) - 1, -1, -1):
+            dim = self.dims[d]
+            i, k = divmod(i, len(dim))
+            if self.widths[d] > 0:
+                values.append('%0*d' % (self.widths[d], dim[k]))
+            else:
+                values.append(str(dim[k]))
+        values.reverse()
+
+        s = [self.parts[0]]
+        for k in range(len(self.slots)):
+            s.append(values[self.slots[k]])
+            s.append(self.parts[k + 1])
+        return ''.join(s)
+
+    def record(self):
+        # '@array<TAB>n<TAB>"template"' plus the shared requests
+        s = ['@array', str(self.n), '"' + self.template + '"']
+        for key in self.fields:
+            s.append('%s=%s' % (key, self.fields[key]))
+        return '\t'.join(s)
+
+def parsearray(line):
+    # a record written by cmdarray.record() -> cmdarray
+    fields = line.split('\t')
+    extras = {}
+    for f in fields[3:]:
+        key, value = f.split('=', 1)
+        extras[key] = int(value)
+    a = cmdarray(fields[2][1:-1], extras, True)
+    if len(a) != int(fields[1]):
+        raise ValueError("array of %s jobs expands to %d" % (fields[1], len(a)))
+    return a
+
+class cmdstore:
+    """
+    Commands of a batch, packed end to end into a few large strings with an
+    array of end offsets, instead of one string object per job. Job arrays
+    are kept as their templates and take up a range of indices each.
+    """
+    def __init__(self):
+        self.chunks = []          # sealed strings of CMD_CHUNK commands
+        self.ends   = array('I')  # end of each command within its chunk
+        self.parts  = []          # commands of the chunk being filled
+        self.size   = 0
+
+        self.arrays = []  # cmdarray of each job array
+        self.starts = []  # index of the first job of each array
+        self.before = []  # array jobs before each array
+        self.narray = 0   # jobs in all arrays
+
+    def __len__(self):
+        return len(self.ends) + self.narray
+
+    def appendarray(self, a):
+        self.starts.append(len(self))
+        self.before.append(self.narray)
+        self.arrays.append(a)
+        self.narray += len(a)
+
+    def findarray(self, i):
+        # -> (k, offset of i in array k) or (k, None) for the explicit
+        # command i, with k the last array before it (or -1)
+        k = bisect.bisect_right(self.starts, i) - 1
+        if k >= 0 and i < self.starts[k] + len(self.arrays[k]):
+            return k, i - self.starts[k]
+        return k, None
+
+    def field(self, key, i):
+        # request shared by the jobs of the array holding i, or None
+        if len(self.arrays) == 0:
+            return None
+        k, offset = self.findarray(i)
+        if offset is None:
+            return None
+        return self.arrays[k].fields.get(key)
+
+    def append(self, cmd):
+        self.size += len(cmd)
+        self.parts.append(cmd)
+        self.ends.append(self.size)
+        if len(self.ends) % CMD_CHUNK == 0:
+            self.chunks.append(''.join(self.parts))
+            self.parts = []
+            self.size  = 0
+
+    def __getitem__(self, i):
+        if len(self.arrays) > 0:
+            k, offset = self.findarray(i)
+            if offset is not None:
+                return self.arrays[k][offset]
+            if k >= 0:
+                i -= self.before[k] + len(self.arrays[k])
+
+        c = i // CMD_CHUNK
+        if c == len(self.chunks):
+            return self.parts[i - c * CMD_CHUNK]
+
+        if i % CMD_CHUNK == 0:
+            start = 0
+        else:
+            start = self.ends[i - 1]
+        return self.chunks[c][start:self.ends[i]]
+
+class indexqueue:
+    """
+    FIFO of job indices, stored as runs of consecutive indices so a batch
+    queued in file order costs a handful of entries.
+    """
+    def __init__(self):
+        self.runs = deque()  # [first, last + 1] of each run
+        self.n    = 0
+
+    def __len__(self):
+        return self.n
+
+    def append(self, i):
+        if len(self.runs) > 0 and self.runs[-1][1] == i:
+            self.runs[-1][1] = i + 1
+        else:
+            self.runs.append([i, i + 1])
+        self.n += 1
+
+    def first(self):
+        return self.runs[0][0]
+
+    def extend(self, first, last):
+        # queue first ... last - 1
+        if len(self.runs) > 0 and self.runs[-1][1] == first:
+            self.runs[-1][1] = last
+        else:
+            self.runs.append([first, last])
+        self.n += last - first
+
+    def popleft(self):
+        run = self.runs[0]
+        i = run[0]
+        run[0] += 1
+        if run[0] == run[1]:
+            self.runs.popleft()
+        self.n -= 1
+        return i
+
+class heapqueue:
+    """
+    Job indices in order of key(i), smallest first, file order among equal
+    keys. Same interface as indexqueue.
+    """
+    def __init__(self, key):
+        self.key  = key
+        self.heap = []  # (key, index)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def append(self, i):
+        heapq.heappush(self.heap, (self.key(i), i))
+
+    def first(self):
+        return self.heap[0][1]
+
+    def extend(self, first, last):
+        for i in xrange(first, last):
+            self.heap.append((self.key(i), i))
+        heapq.heapify(self.heap)
+
+    def popleft(self):
+        return heapq.heappop(self.heap)[1]
+
+def timefield(t):
+    # times are kept to the millisecond, str() would round them to 10ms
+    if t < 0:
+        return '-1.0'
+    return '%.3f' % t
+
+def column(key):
+    return property(lambda self: self.owner.get(key, self.index))
+
+class job(object):
+    """
+    Lightweight view of one job in its batch's columns.
+    """
+    __slots__ = ('owner', 'index')
+
+    def __init__(self, owner, index):
+        self.owner = owner
+        self.index = index
+
+    cmd  = property(lambda self: self.owner.cmds[self.index])
+    pid  = column('pid')
+    node = column('node')
+    start  = column('start')
+    stop   = column('stop')
+    pgid   = column('pgid')
+    ready  = column('ready')
+    began  = column('began')
+    reaped = column('reaped')
+    utime  = column('utime')
+    stime  = column('stime')
+    maxrss = column('maxrss')
+    status = property(lambda self: STATUS[self.owner.get('status', self.index)])
         
     def __str__(self):
+        return '"' + self.cmd + '"\t' + self.state()
+
+    def state(self):
         s = []
-        s.append('"' + self.cmd + '"')
         s.append(str(self.pid))
         s.append(str(self.node))
-        s.append(str(self.start))
-        s.append(str(self.stop))
+        s.append(timefield(self.start))
+        s.append(timefield(self.stop))
         s.append(self.status)
 
+        # optional fields follow as key=value
+        for key in OPTIONAL:
+            value = self.owner.get(key, self.index)
+            if value == COLUMNS[key][1]:
+                continue
+            if COLUMNS[key][0] == 'd':
+                value = timefield(value)
+            s.append('%s=%s' % (key, value))
+
         return '\t'.join(s)
 
-    def update(self, cmd=None, pid=None, node=None, start=None, stop=None, status=None):
-        if cmd is not None:
-            self.cmd = cmd
-        if pid is not None:
-            self.pid = pid
-        if node is not None:
-            self.node = node
-        if start is not None:
-            self.start = start
-        if stop is not None:
-            self.stop = stop
-        if status is not None:
-            self.status = status
-            
-    def read(self, str):
-        fields = str.split('\t')
-        if len(fields) != 6 and len(fields) != 5:
-            print "error in job.read: fields != 5 or 6"
-            print str
-            return
-        
-        cmd    = fields[0][1:-1]  # remove leading/trailing quotes
-        pid    = int(fields[1])
-        
-        if len(fields) == 5:
-            node   = -1 
-            start  = float(fields[2])
-            stop   = float(fields[3])
-            status = fields[4]
-        else:
-            node   = int(fields[2])
-            start  = float(fields[3])
-            stop   = float(fields[4])
-            status = fields[5]
-    
-        self.update(cmd=cmd, pid=pid, node=node, start=start, stop=stop, status=status)
+    def update(self, **fields):
+        self.owner.update(self.index, **fields)
 
     def ispending(self):
-        if self.status == 'pending':
-            return True
-        return False
+        return self.owner.get('status', self.index) == PENDING
 
     def isrunning(self):
-        if self.status == 'running':
-            return True
-        return False
+        return self.owner.get('status', self.index) == RUNNING
 
     def iscrashed(self):
-        if self.status == 'crashed':
-            return True
-        return False
+        return self.owner.get('status', self.index) == CRASHED
 
     def iscompleted(self):
-        if self.status == 'completed':
-            return True
-        return False
+        return self.owner.get('status', self.index) == COMPLETED
+
+    def isblocked(self):
+        return self.owner.get('status', self.index) == BLOCKED
 
     def runningtime(self):
+        # stop is only set once the job exits
+        if self.isrunning():
+            return time.time() - self.start
         return self.stop - self.start
     
     def setrunning(self):
-        self.setstart()
-        self.update(status='running')
+        t = time.time()
+        self.update(start=t, stop=t, status='running')
 
     def setcrashed(self):
         self.update(status='crashed')
@@ -212,72 +799,392 @@ class job:
         t = time.time()
         self.update(start=t, stop=t)
 
-    def settime(self):
-        self.update(stop=time.time())
-
     def setpid(self, pid):
         self.update(pid=pid)
 
     def setnode(self, node):
         self.update(node=node)
 
+    def setpgid(self, pgid):
+        self.update(pgid=pgid)
+
+    def request(self):
+        return self.owner.request(self.index)
+
+def parsestate(fields):
+    # fields as written by job.state() -> dict of column values
+    state = {'pid'    : int(fields[0]),
+             'node'   : int(fields[1]),
+             'start'  : float(fields[2]),
+             'stop'   : float(fields[3]),
+             'status' : fields[4]}
+    for f in fields[5:]:
+        key, value = f.split('=', 1)
+        if key in COLUMNS:
+            state[key] = type(COLUMNS[key][1])(value)
+    return state
+
+def parsejob(line):
+    # a job record -> (cmd, dict of column values)
+    fields = line.split('\t')
+    if len(fields) < 5:
+        print "error in parsejob: fields < 5"
+        print line
+        return None, None
+
+    cmd = fields[0][1:-1]  # remove leading/trailing quotes
+    if len(fields) == 5:
+        fields.insert(2, '-1')  # written before jobs had a node
+    return cmd, parsestate(fields[1:])
+
+class joblist(object):
+    """
+    Sequence of job views over a batch.
+    """
+    def __init__(self, owner):
+        self.owner = owner
+
+    def __len__(self):
+        return len(self.owner.cmds)
+
+    def __getitem__(self, i):
+        n = len(self.owner.cmds)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError(i)
+        return job(self.owner, i)
+
+    def __iter__(self):
+        for i in xrange(len(self.owner.cmds)):
+            yield job(self.owner, i)
+
 class batch:
-    def __init__(self, name='unnamed', jobs=[]):
-        self.name = name
-        self.jobs = []
-        for j in jobs:
-            self.jobs.append(job(j))
+    def __init__(self, name='unnamed', jobs=[], opts=None):
+        self.name  = name
+        self.opts  = {}  # header options, e.g. weight, maxshare, after
+        if opts is not None:
+            self.opts.update(opts)
+
+        self.cmds    = cmdstore()
+        self.columns = {}
+        for key in FIXED:
+            self.columns[key] = array(COLUMNS[key][0])
+        self.optional = []  # keys of the optional columns created so far
+        self.cursor   = 0   # next array job a '=state' line applies to
+        self.jobs  = joblist(self)
+        self.dirty = set()  # indices of jobs changed since the last write
+
+        # live indexes kept up to date by touch() on every job transition
+        self.counts = [0] * len(STATUS)
+        self.queue  = indexqueue()  # pending job indices, in dispatch order
+        self.held   = set()        # pending jobs waiting on others, see depgraph
+        self.active = {}       # pid -> index of running jobs
+        self.busy   = 0        # cores reserved by running jobs
+
+        # running totals over jobs that have left pending, so a status
+        # summary never has to walk the jobs
+        self.runtime  = 0.0  # summed running time of finished jobs
+        self.first    = None # earliest start
+        self.last     = None # latest stop
+        self.pernode  = {}   # node -> jobs started there
+
+        for cmd in jobs:
+            self.add(cmd)
             
     def __str__(self):
-        s = '>' + self.name + '\n'
+        s = [self.header()]
         for j in self.jobs:
-            s += str(j) + '\n'
+            s.append(str(j))
+        return '\n'.join(s) + '\n'
+
+    def write(self, outFile):
+        # job arrays are written as their template followed by the state of
+        # the array jobs touched so far, one '=state' line each
+        outFile.write(self.header() + '\n')
+        lines = []
+        hw = len(self.columns['status'])
+        i = 0
+        for k in range(len(self.cmds.arrays) + 1):
+            if k < len(self.cmds.arrays):
+                start = self.cmds.starts[k]
+            else:
+                start = len(self.cmds)
+
+            for j in xrange(i, start):
+                lines.append(str(job(self, j)))
+                if len(lines) == WRITE_LINES:
+                    outFile.write('\n'.join(lines) + '\n')
+                    lines = []
+            if k == len(self.cmds.arrays):
+                break
+
+            a = self.cmds.arrays[k]
+            lines.append(a.record())
+            stop = min(start + len(a), hw)
+            while stop > start and self.get('status', stop - 1) == PENDING and self.get('pid', stop - 1) == -1:
+                stop -= 1  # untouched jobs need no line
+            for j in xrange(start, stop):
+                lines.append('=' + job(self, j).state())
+                if len(lines) == WRITE_LINES:
+                    outFile.write('\n'.join(lines) + '\n')
+                    lines = []
+            i = start + len(a)
+        if len(lines) > 0:
+            outFile.write('\n'.join(lines) + '\n')
+
+    def header(self):
+        s = '>' + self.name
+        keys = self.opts.keys()
+        keys.sort()
+        for key in keys:
+            s += ' %s=%s' % (key, self.opts[key])
         return s
 
+    def weight(self):
+        return optshare(self.opts, 'weight') or 1.0
+
+    def request(self, i):
+        # (cores, megabytes) job i needs, its own or else the batch's
+        cores = self.get('cores', i) or self.cmds.field('cores', i)
+        if not cores:
+            cores = int(self.opts.get('cores', 1))
+        mem = self.get('mem', i) or self.cmds.field('mem', i)
+        if not mem and 'mem' in self.opts:
+            mem = parsemem(self.opts['mem'])
+        return cores, mem or 0
+
+    def maxshare(self):
+        # largest fraction of maxjobs this batch may hold at once
+        return optshare(self.opts, 'maxshare') or 1.0
+
+    def after(self):
+        # names of batches that must be finished before this one starts
+        if 'after' not in self.opts:
+            return []
+        return self.opts['after'].split(',')
+
+    def add(self, cmd, **fields):
+        i = len(self.cmds)
+        self.extend(i)
+        self.cmds.append(cmd)
+        for key in self.columns:
+            self.columns[key].append(COLUMNS[key][1])
+        self.setfields(i, fields)
+        self.index(i)
+
+    def addarray(self, a):
+        # the array's jobs are pending and get no column entries until they
+        # are touched
+        i = len(self.cmds)
+        self.cmds.appendarray(a)
+        self.counts[PENDING] += len(a)
+        self.queue.extend(i, i + len(a))
+        self.cursor = i
+
+    def extend(self, n):
+        # give the columns entries for the first n jobs
+        hw = len(self.columns['status'])
+        if n <= hw:
+            return
+        for key in self.columns:
+            typecode, default = COLUMNS[key]
+            self.columns[key].extend(array(typecode, [default]) * (n - hw))
+
+    def index(self, i):
+        # count and queue a newly added job
+        status = self.columns['status'][i]
+        self.counts[status] += 1
+        if status == PENDING:
+            self.queue.append(i)
+            return
+        elif status == RUNNING:
+            self.active[self.columns['pid'][i]] = i
+            self.busy += self.request(i)[0]
+        self.account(i, 1)
+
+    def account(self, i, sign):
+        # add (sign=1) or remove (sign=-1) a non-pending job's share of the
+        # running totals. first and last only ever widen
+        cols   = self.columns
+        node   = cols['node'][i]
+        start  = cols['start'][i]
+        stop   = cols['stop'][i]
+        if node >= 0:
+            self.pernode[node] = self.pernode.get(node, 0) + sign
+        if cols['status'][i] != RUNNING:
+            self.runtime += sign * (stop - start)
+        if sign > 0:
+            if start > 0 and (self.first is None or start < self.first):
+                self.first = start
+            if stop > 0 and (self.last is None or stop > self.last):
+                self.last = stop
+
+    def get(self, key, i):
+        col = self.columns.get(key)
+        if col is None or i >= len(col):
+            return COLUMNS[key][1]
+        return col[i]
+
+    def setfields(self, i, fields):
+        cols = self.columns
+        for key in fields:
+            value = fields[key]
+            if value is None:
+                continue
+            if key == 'status':
+                value = STATUSCODE[value]
+            if key not in cols:
+                typecode, default = COLUMNS[key]
+                cols[key] = array(typecode, [default]) * len(cols['status'])
+                self.optional.append(key)
+            cols[key][i] = value
+
+    def update(self, i, **fields):
+        self.extend(i + 1)
+        oldstatus = self.columns['status'][i]
+        oldpid    = self.columns['pid'][i]
+        if oldstatus != PENDING:
+            self.account(i, -1)
+        self.setfields(i, fields)
+        self.touch(i, oldstatus, oldpid)
+
+    def touch(self, i, oldstatus, oldpid):
+        self.dirty.add(i)
+        status = self.columns['status'][i]
+        pid    = self.columns['pid'][i]
+        if status != PENDING:
+            self.account(i, 1)
+        if status == oldstatus and pid == oldpid:
+            return
+
+        self.counts[oldstatus] -= 1
+        self.counts[status] += 1
+
+        if oldstatus == RUNNING and oldpid in self.active:
+            del self.active[oldpid]
+            self.busy -= self.request(i)[0]
+        if status == RUNNING:
+            self.active[pid] = i
+            self.busy += self.request(i)[0]
+        elif status == PENDING and oldstatus != PENDING:
+            self.queue.append(i)
+
+    def setorder(self, key=None):
+        # queue pending jobs by key(i), smallest first, or in file order
+        if key is None:
+            q = indexqueue()
+        else:
+            q = heapqueue(key)
+        status = self.columns['status']
+        for i in xrange(len(status)):
+            if status[i] == PENDING:
+                q.append(i)
+        if len(status) < self.total():
+            q.extend(len(status), self.total())  # never touched, all pending
+        self.queue = q
+
+    def peekpending(self):
+        # entries of jobs that left pending some other way, or are held, are
+        # dropped here. held jobs are queued again once released
+        status = self.columns['status']
+        while len(self.queue) > 0:
+            i = self.queue.first()
+            if (i >= len(status) or status[i] == PENDING) and i not in self.held:
+                return job(self, i)
+            self.queue.popleft()
+        return None
+
+    def nextpending(self):
+        j = self.peekpending()
+        if j is not None:
+            self.queue.popleft()
+        return j
+
+    def runningjobs(self):
+        jobs = []
+        for i in self.active.values():
+            jobs.append(job(self, i))
+        return jobs
+
     def read(self, joblist=[]):
         for line in joblist:
-            j = job()
-            j.read(line)
-            self.jobs.append(j)
+            self.readline(line)
+
+    def readline(self, line):
+        # a job record as written by job.__str__, parsed straight into the
+        # columns since this is the bulk of loading a state file
+        if line.startswith('@array'):
+            self.addarray(parsearray(line))
+            return
+        elif line.startswith('='):
+            self.update(self.cursor, **parsestate(line[1:].split('\t')))
+            self.cursor += 1
+            return
+
+        fields = line.split('\t')
+        if len(fields) < 6:
+            cmd, state = parsejob(line)
+            if cmd is not None:
+                self.add(cmd, **state)
+            return
+
+        i = len(self.cmds)
+        cols = self.columns
+        if len(cols['status']) < i:
+            self.extend(i)  # explicit job after an array
+        self.cmds.append(fields[0][1:-1])
+        cols['pid'].append(int(fields[1]))
+        cols['node'].append(int(fields[2]))
+        cols['start'].append(float(fields[3]))
+        cols['stop'].append(float(fields[4]))
+        cols['status'].append(STATUSCODE[fields[5]])
+
+        extras = {}
+        for f in fields[6:]:
+            key, value = f.split('=', 1)
+            if key in COLUMNS:
+                extras[key] = type(COLUMNS[key][1])(value)
+        for key in self.optional:
+            if key in extras:
+                cols[key].append(extras.pop(key))
+            else:
+                cols[key].append(COLUMNS[key][1])
+        if len(extras) > 0:
+            self.setfields(i, extras)  # first job to set these
+        self.index(i)
             
     def running(self):
-        n = 0
-        for job in self.jobs:
-            if job.isrunning():
-                n += 1
-        return n
+        return self.counts[RUNNING]
 
     def pending(self):
-        n = 0
-        for job in self.jobs:
-            if job.ispending():
-                n += 1
-        return n
+        return self.counts[PENDING]
 
     def crashed(self):
-        n = 0
-        for job in self.jobs:
-            if job.iscrashed():
-                n += 1
-        return n
+        return self.counts[CRASHED]
+
+    def blocked(self):
+        return self.counts[BLOCKED]
 
     def total(self):
-        return len(self.jobs)
+        return len(self.cmds)
 
     def status(self):
-        nr  = 0
-        ncr = 0
-        nco = 0
-        nt  = 0
-        for job in self.jobs:
-            nt += 1
-            if job.iscrashed():
-                ncr += 1
-            elif job.isrunning():
-                nr += 1
-            elif job.iscompleted():
-                nco += 1
-        return nt, nco, nr, ncr
+        c = self.counts
+        return len(self.cmds), c[COMPLETED], c[RUNNING], c[CRASHED]
+
+    def times(self):
+        # (running time, earliest start, latest stop) over non-pending jobs,
+        # only the running jobs are looked at. they run until now
+        cols = self.columns
+        tr   = self.runtime
+        last = self.last
+        if len(self.active) > 0:
+            now  = time.time()
+            last = max(last, now)
+            for i in self.active.itervalues():
+                tr += now - cols['start'][i]
+        return tr, self.first, last
 
     def info(self):
         nt, nco, nr, ncr = self.status()
@@ -288,14 +1195,16 @@ class batch:
         else:
             width = nt
 
+        nbl = self.blocked()
         pco = int(round(float(width) * float(nco) / float(nt)))
         pr  = int(round(float(width) * float(nr)  / float(nt)))
         pcr = int(round(float(width) * float(ncr) / float(nt)))
-        np = width - pco - pr - pcr
+        pbl = int(round(float(width) * float(nbl) / float(nt)))
+        np = width - pco - pr - pcr - pbl
 
         s = '  ' + self.name + '\t['
-        s += COMP_CHAR * pco + CRASH_CHAR * pcr + RUN_CHAR * pr + ' ' * np
-        s += '] %d of %d jobs\n' % (nco + ncr, nt)
+        s += COMP_CHAR * pco + CRASH_CHAR * pcr + BLOCK_CHAR * pbl + RUN_CHAR * pr + ' ' * np
+        s += '] %d of %d jobs\n' % (nco + ncr + nbl, nt)
         return s
                                                                 
 
@@ -305,58 +1214,188 @@ class superbatch:
         self.batches = []
         self.fname = fname
 
+        # job state changes are appended to the journal between snapshots,
+        # the generation ties a journal to the snapshot it applies to
+        self.jname      = os.path.splitext(fname)[0] + '.journal'
+        self.generation = 0
+        self.nlogged    = 0
+        self.jvalid     = None  # bytes of the journal read() found valid, until the first write
+
+        # cmdbatches holds (name, cmds) or (name, cmds, opts) tuples
         if cmdbatches is not None:
-            for name, cmds in cmdbatches:
-                self.batches.append(batch(name, cmds))
+            for cb in cmdbatches:
+                self.batches.append(batch(*cb))
 
     def exists(self):
         return os.path.exists(self.fname)
 
     def clean(self):
-        if os.path.exists(self.fname):
-            os.remove(self.fname)
-        if os.path.exists(self.fname + '.bak'):
-            os.remove(self.fname + '.bak')
+        for fname in [self.fname, self.fname + '.bak', self.fname + '.tmp', self.jname]:
+            if os.path.exists(fname):
+                os.remove(fname)
             
     def write(self):
-        if self.exists():
-            os.rename(self.fname, self.fname + '.bak')
+        # append jobs changed since the last write to the journal, only fold
+        # everything into a new snapshot once the journal is as large as
+        # the batch itself, so each write costs O(changes)
+        if not self.exists() or self.nlogged >= max(JOURNAL_MIN, self.total()):
+            self.compact()
+            return
+
+        lines = []
+        for bi in range(len(self.batches)):
+            b = self.batches[bi]
+            for i in b.dirty:
+                lines.append('%d\t%d\t%s\n' % (bi, i, b.jobs[i].state()))
+            b.dirty = set()
+
+        if len(lines) == 0:
+            return
+
+        # the first write drops a journal that replay() skipped, or a torn
+        # record at its end, rather than append to it. readers such as pyra
+        # time leave it alone, the daemon may be writing
+        if self.jvalid is not None and os.path.exists(self.jname):
+            if self.jvalid == 0:
+                os.remove(self.jname)
+            elif self.jvalid < os.path.getsize(self.jname):
+                outFile = open(self.jname, 'r+')
+                outFile.truncate(self.jvalid)
+                outFile.close()
+        self.jvalid = None
+
+        if not os.path.exists(self.jname):
+            lines.insert(0, '#generation %d\n' % self.generation)
+        outFile = open(self.jname, 'a')
+        outFile.write(''.join(lines))
+        outFile.close()
+        self.nlogged += len(lines)
+
+    def compact(self):
+        # write a full snapshot under a new generation, which retires the
+        # current journal even if we die before removing it
+        outFile = self.opensnapshot()
+        for b in self.batches:
+            b.write(outFile)
+        self.closesnapshot(outFile)
 
-        # write jobs
-        outFile = gzip.open(self.fname, 'wb')
+        self.generation += 1
+        self.nlogged = 0
+        self.jvalid = None
         for b in self.batches:
-            outFile.write(str(b))
+            b.dirty = set()
+
+    def opensnapshot(self):
+        outFile = gzip.GzipFile(self.fname + '.tmp', 'wb', GZIP_LEVEL)
+        outFile.write('#generation %d\n' % (self.generation + 1))
+        return outFile
+
+    def closesnapshot(self, outFile):
         outFile.close()
+        if self.exists():
+            os.rename(self.fname, self.fname + '.bak')
+        os.rename(self.fname + '.tmp', self.fname)
+        if os.path.exists(self.jname):
+            os.remove(self.jname)
+
+    def create(self, cmdbatches):
+        # write a new state file straight from (name, cmds, opts) tuples,
+        # where cmds may be any iterable, so only one job is held at a time.
+        # a cmd may also be a (cmd, {column : value}) tuple or a cmdarray.
+        # returns a (name, number of jobs, opts) tuple per batch written
+        created = []
+        outFile = self.opensnapshot()
+        try:
+            self.writebatches(outFile, cmdbatches, created)
+        except:
+            outFile.close()
+            os.remove(self.fname + '.tmp')  # a bad job list leaves nothing behind
+            raise
+        self.closesnapshot(outFile)
+
+        self.generation += 1
+        return created
+
+    def writebatches(self, outFile, cmdbatches, created):
+        for name, cmds, opts in cmdbatches:
+            n = 0
+            lines = [batch(name, opts=opts).header()]
+            for cmd in cmds:
+                if isinstance(cmd, cmdarray):
+                    lines.append(cmd.record())
+                    n += len(cmd)
+                    continue
+                if isinstance(cmd, tuple):
+                    cmd, fields = cmd
+                    extras = ['%s=%s' % (key, fields[key]) for key in fields]
+                    lines.append('"' + cmd + '"\t' + '\t'.join([PENDING_STATE] + extras))
+                else:
+                    lines.append('"' + cmd + '"\t' + PENDING_STATE)
+                n += 1
+                if len(lines) == WRITE_LINES:
+                    outFile.write('\n'.join(lines) + '\n')
+                    lines = []
+            if n > 0 and len(lines) > 0:
+                outFile.write('\n'.join(lines) + '\n')
+            if n > 0:
+                created.append((name, n, opts))
 
     def read(self):
         if not self.exists():
             return
-        joblist   = []
-        batchname = None
+        b = None
 
         inFile = gzip.open(self.fname, 'rb')
         for line in inFile:
             line = line.strip()
-            if line.startswith('>'):
-                if batchname is not None and len(joblist) > 0:
-                    b = batch(batchname)
-                    b.read(joblist)
+            if line.startswith('#generation'):
+                self.generation = int(line.split()[1])
+            elif line.startswith('>'):
+                if b is not None and b.total() > 0:
                     self.batches.append(b)
+                name, opts = parseheader(line)
+                b = batch(name, opts=opts)
+            elif b is not None and line != '':
+                b.readline(line)
 
-                    joblist = []
-                    batchname = None
-                batchname = line[1:].split()[0]
-            else:
-                if batchname is None:
-                    continue
-                joblist.append(line)
-
-        if batchname is not None and len(joblist) > 0:
-            b = batch(batchname)
-            b.read(joblist)
+        if b is not None and b.total() > 0:
             self.batches.append(b)
 
         inFile.close()
+
+        self.replay()
+        for b in self.batches:
+            b.dirty = set()
+
+    def replay(self):
+        # apply journaled job states on top of the snapshot
+        if not os.path.exists(self.jname):
+            return
+
+        inFile = open(self.jname)
+        good = 0  # bytes of whole records of this generation
+        stale = False
+        for line in inFile:
+            if not line.endswith('\n'):
+                break  # torn final record from a crash mid-write
+            if line.startswith('#generation'):
+                if int(line.split()[1]) != self.generation:
+                    stale = True  # journal predates the snapshot, already folded in
+                    break
+                good += len(line)
+                continue
+
+            good += len(line)
+            fields = line[:-1].split('\t')
+            if len(fields) < 7:
+                continue
+            b = self.batches[int(fields[0])]
+            b.update(int(fields[1]), **parsestate(fields[2:]))
+            self.nlogged += 1
+        inFile.close()
+        if stale:
+            good = 0
+        self.jvalid = good
         
     def running(self):
         n = 0
@@ -364,6 +1403,31 @@ class superbatch:
             n += batch.running()
         return n
 
+    def busy(self):
+        n = 0
+        for batch in self.batches:
+            n += batch.busy
+        return n
+
+    def isready(self, b):
+        # True once every batch named in b's 'after' option has finished
+        names = b.after()
+        if len(names) == 0:
+            return True
+        for other in self.batches:
+            if other.name in names and (other.running() > 0 or other.pending() > 0):
+                return False
+        return True
+
+    def isblocked(self, b):
+        # True once a job of a batch named in b's 'after' option crashed or
+        # was blocked, b's jobs can no longer all run after it
+        names = b.after()
+        for other in self.batches:
+            if other.name in names and other.crashed() + other.blocked() > 0:
+                return True
+        return False
+
     def remaining(self):
         n = 0
         for batch in self.batches:
@@ -411,28 +1475,31 @@ class superbatch:
 
         nodes = {}
         for b in self.batches:
-            for j in b.jobs:
-                if j.ispending():
-                    continue
-                tr += j.runningtime()
+            btr, bfirst, blast = b.times()
+            tr += btr
+            if bfirst is not None and (mintime is None or bfirst < mintime):
+                mintime = bfirst
+            if blast is not None and (maxtime is None or blast > maxtime):
+                maxtime = blast
 
+            for n in b.pernode:
+                if b.pernode[n] == 0:
+                    continue
                 if nodeobj is not None:
-                    node = nodeobj.getaddr(j.node)
+                    node = nodeobj.getaddr(n) or str(n)  # a worker's, once the daemon is gone
                 else:
-                    node = str(j.node)
-                if node not in nodes:
-                    nodes[node] = 0
-                nodes[node] += 1
-                
-                if mintime is None or (j.start > 0 and j.start < mintime):
-                    mintime = j.start
-                if maxtime is None or (j.stop > 0 and j.stop > maxtime):
-                    maxtime = j.stop
+                    node = str(n)
+                nodes[node] = nodes.get(node, 0) + b.pernode[n]
 
         s = '  pyrasol superbatch info:\n'
         s += '\t%d running\n' % nrunning
         s += '\t%d of %d completed\n' % (ncomplete, ntotal)
         s += '\t%d of %d crashed\n' % (ncrashed, ntotal)
+        nblocked = 0
+        for b in self.batches:
+            nblocked += b.blocked()
+        if nblocked > 0:
+            s += '\t%d of %d blocked\n' % (nblocked, ntotal)
 
         ts = timestring(tr)
         s += '\trunning time: %s\n' % ts
@@ -457,6 +1524,155 @@ class superbatch:
         for b in self.batches:
             s += b.info()
                         
-        s += "  (complete = '%s', running = '%s', crashed = '%s')" % (COMP_CHAR, RUN_CHAR, CRASH_CHAR)
+        s += "  (complete = '%s', running = '%s', crashed = '%s', blocked = '%s')" % (COMP_CHAR, RUN_CHAR, CRASH_CHAR,
+                                                                                  BLOCK_CHAR)
         return s
             
+
+class depgraph:
+    """
+    Dependencies between jobs. A job line may name its job with @key=NAME,
+    several jobs may share a name, and wait for named jobs with
+    @after=NAME[,NAME...]: it is held out of its batch's queue until every
+    job of each name has completed. A crash blocks the jobs waiting on it,
+    and theirs in turn. Each waiting job counts the names it still waits
+    for, so a job completing only looks at the jobs waiting on its name.
+    """
+    def __init__(self, sb):
+        self.sb        = sb
+        self.remaining = {}     # name -> its jobs not completed yet
+        self.failed    = set()  # names one of whose jobs crashed or was blocked
+        self.waiters   = {}     # name -> (batch, index) of pending jobs waiting on it
+        self.unmet     = {}     # (batch, index) -> names it still waits on
+        self.released  = 0      # jobs queued again since this was last reset
+
+    def prefixed(self, b):
+        # (index, opts) of b's jobs with a key or after option. the jobs of
+        # an array are only looked at if its template has one
+        cmds = b.cmds
+        k = 0
+        i = 0
+        while i < len(cmds):
+            while k < len(cmds.arrays) and cmds.starts[k] + len(cmds.arrays[k]) <= i:
+                k += 1
+            if k < len(cmds.arrays) and cmds.starts[k] <= i:
+                a = cmds.arrays[k]
+                opts = parseprefix(a.template)[1]
+                if 'key' in opts or 'after' in opts:
+                    for offset in xrange(len(a)):
+                        yield i + offset, parseprefix(a[offset])[1]
+                i = cmds.starts[k] + len(a)
+                continue
+            cmd = cmds[i]
+            if cmd.startswith('@'):
+                opts = parseprefix(cmd)[1]
+                if 'key' in opts or 'after' in opts:
+                    yield i, opts
+            i += 1
+
+    def build(self):
+        # index the jobs' dependencies, hold the jobs still waiting and
+        # block those that never can. returns the names waited on that no
+        # job has
+        after = []
+        for b in self.sb.batches:
+            b.held = set()
+            for i, opts in self.prefixed(b):
+                status = b.get('status', i)
+                if 'key' in opts:
+                    key = opts['key']
+                    self.remaining.setdefault(key, 0)
+                    if status != COMPLETED:
+                        self.remaining[key] += 1
+                    if status == CRASHED or status == BLOCKED:
+                        self.failed.add(key)
+                if 'after' in opts and status == PENDING:
+                    after.append((b, i, opts['after'].split(',')))
+
+        unknown = set()
+        for b, i, keys in after:
+            n = 0
+            for key in keys:
+                if key not in self.remaining:
+                    unknown.add(key)
+                    self.remaining[key] = 1
+                    self.failed.add(key)
+                if self.remaining[key] > 0:
+                    self.waiters.setdefault(key, []).append((b, i))
+                    n += 1
+            if n > 0:
+                self.unmet[(b, i)] = n
+                b.held.add(i)
+
+        self.block(list(self.failed))
+        unknown = list(unknown)
+        unknown.sort()
+        return unknown
+
+    def keyof(self, b, i):
+        cmd = b.cmds[i]
+        if not cmd.startswith('@'):
+            return None
+        return parseprefix(cmd)[1].get('key')
+
+    def finished(self, job):
+        # job completed or crashed: release or block the jobs waiting on it
+        key = self.keyof(job.owner, job.index)
+        if key is None or key in self.failed:
+            return
+        if job.iscompleted():
+            self.remaining[key] -= 1
+            if self.remaining[key] == 0:
+                self.release(key)
+        else:
+            self.failed.add(key)
+            self.block([key])
+
+    def release(self, key):
+        for b, i in self.waiters.pop(key, []):
+            if (b, i) not in self.unmet:
+                continue  # blocked meanwhile
+            self.unmet[(b, i)] -= 1
+            if self.unmet[(b, i)] == 0:
+                del self.unmet[(b, i)]
+                b.held.discard(i)
+                b.queue.append(i)
+                self.released += 1
+
+    def blockjob(self, b, i):
+        # block pending job i of b, returns its name if that now fails
+        self.unmet.pop((b, i), None)
+        b.held.discard(i)
+        b.update(i, status='blocked')
+        key = self.keyof(b, i)
+        if key is None or key in self.failed:
+            return None
+        self.failed.add(key)
+        return key
+
+    def block(self, keys):
+        # block the pending jobs waiting on failed names, and on theirs.
+        # returns how many were blocked
+        n = 0
+        while len(keys) > 0:
+            for b, i in self.waiters.pop(keys.pop(), []):
+                if b.get('status', i) != PENDING:
+                    continue
+                key = self.blockjob(b, i)
+                if key is not None:
+                    keys.append(key)
+                n += 1
+        return n
+
+    def blockbatch(self, b):
+        # block every pending job of b, returns how many were blocked
+        keys = []
+        n = 0
+        for i in xrange(b.total()):
+            if b.get('status', i) != PENDING:
+                continue
+            key = self.blockjob(b, i)
+            if key is not None:
+                keys.append(key)
+            n += 1
+        return n + self.block(keys)
@@ -0,0 +1,137 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+#
+# Control channel between the pyra command line and a running pyrasol daemon,
+# over a unix socket in the batch directory. A request is one line of words,
+# e.g. 'param maxjobs 30'. The reply is everything the daemon writes back
+# before closing the connection, starting with 'ok' or 'error'.
+#
+
+import os, sys, socket, errno, traceback
+from pyralog import log
+
+SOCKET_NAME     = '.pyrasol.sock'
+CONTROL_TIMEOUT = 5  # seconds a client waits for the daemon to answer
+
+class controlserver:
+    def __init__(self, fname=SOCKET_NAME):
+        self.fname = fname
+        self.sock  = None
+
+    def open(self):
+        if os.path.exists(self.fname):
+            os.remove(self.fname)  # left behind by a daemon that died
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.fname)
+            os.chmod(self.fname, 0600)
+            sock.listen(16)
+        except socket.error, err:
+            log.error("unable to open control socket %s: %s", self.fname, err)
+            sock.close()
+            return False
+
+        sock.setblocking(0)
+        self.sock = sock
+        return True
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def serve(self, handler):
+        # answer every pending request with handler(words) -> reply. a
+        # request the handler fails on is answered with an error, it does
+        # not take the daemon down
+        while True:
+            try:
+                conn = self.sock.accept()[0]
+            except socket.error, err:
+                if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+
+            try:
+                conn.setblocking(1)
+                conn.settimeout(1.0)
+                words = readline(conn).split()
+                if len(words) == 0:
+                    reply = 'error empty request'
+                else:
+                    reply = call(handler, words)
+                conn.sendall(reply + '\n')
+            except socket.error:
+                pass  # client went away
+            conn.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if os.path.exists(self.fname):
+                os.remove(self.fname)
+
+def call(handler, words):
+    try:
+        return handler(words)
+    except Exception, err:
+        log.error("request '%s' failed: %s\n%s", ' '.join(words), err, traceback.format_exc().rstrip())
+        return 'error %s failed: %s' % (words[0], err)
+
+def readline(conn):
+    data = ''
+    while data.find('\n') < 0:
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data.split('\n')[0]
+
+def request(line, fname=SOCKET_NAME):
+    # send a request to the running daemon, returns its reply, or None if
+    # no daemon is listening
+    if not os.path.exists(fname):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONTROL_TIMEOUT)
+    try:
+        try:
+            sock.connect(fname)
+            sock.sendall(line + '\n')
+            sock.shutdown(socket.SHUT_WR)
+
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except socket.error:
+            return None
+    finally:
+        sock.close()
+
+    return ''.join(chunks).rstrip('\n')
@@ -0,0 +1,120 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+
+#
+# Runtime history. The runtime of every job that completes is folded into a
+# running mean under its command and under its template, the command with its
+# numbers blanked out, in a file that outlives pyra clean. A job's runtime is
+# predicted from its command's mean, or else from its template's.
+#
+
+import os, sys, re
+from pyralog import log
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+HIST_FILE   = '.pyrasol.history'
+HIST_MAXN   = 20   # runs a mean averages over, older ones fade out
+HIST_DIGITS = re.compile(r'\d+')
+
+def template(cmd):
+    # 'align.sh sample17.fq -k 31' -> 'align.sh sample#.fq -k #', job line
+    # options left out
+    while cmd.startswith('@'):
+        fields = cmd.split(None, 1)
+        if len(fields) == 1:
+            return ''
+        cmd = fields[1]
+    return HIST_DIGITS.sub('#', cmd).replace('\t', ' ')
+
+def histkeys(cmd):
+    return 'c:' + sha1(cmd).hexdigest()[:16], 't:' + template(cmd)
+
+class history:
+    def __init__(self, fname=HIST_FILE):
+        self.fname   = fname
+        self.entries = None   # key -> [runs, mean seconds], loaded on first use
+        self.dirty   = set()  # keys changed since the last flush
+
+    def load(self):
+        # a key's last line is its current value, the file is rewritten
+        # once stale lines outnumber live ones
+        self.entries = {}
+        if not os.path.exists(self.fname):
+            return
+        nlines = 0
+        inFile = open(self.fname)
+        for line in inFile:
+            if not line.endswith('\n'):
+                break  # torn final record
+            fields = line[:-1].split('\t')
+            try:
+                self.entries[fields[0]] = [int(fields[1]), float(fields[2])]
+            except (ValueError, IndexError):
+                continue
+            nlines += 1
+        inFile.close()
+
+        if nlines > 2 * len(self.entries) + 1000:
+            outFile = open(self.fname + '.tmp', 'w')
+            for key in self.entries:
+                outFile.write('%s\t%d\t%.3f\n' % (key, self.entries[key][0], self.entries[key][1]))
+            outFile.close()
+            os.rename(self.fname + '.tmp', self.fname)
+
+    def predict(self, cmd):
+        # expected runtime of cmd in seconds, or None if nothing like it ran
+        if self.entries is None:
+            self.load()
+        for key in histkeys(cmd):
+            if key in self.entries:
+                return self.entries[key][1]
+        return None
+
+    def record(self, cmd, seconds):
+        if self.entries is None:
+            self.load()
+        for key in histkeys(cmd):
+            entry = self.entries.setdefault(key, [0, 0.0])
+            entry[0] = min(entry[0] + 1, HIST_MAXN)
+            entry[1] += (seconds - entry[1]) / entry[0]
+            self.dirty.add(key)
+
+    def flush(self):
+        if len(self.dirty) == 0:
+            return
+        lines = []
+        for key in self.dirty:
+            lines.append('%s\t%d\t%.3f\n' % (key, self.entries[key][0], self.entries[key][1]))
+        self.dirty = set()
+        try:
+            outFile = open(self.fname, 'a')
+            outFile.write(''.join(lines))
+            outFile.close()
+        except IOError, err:
+            log.error("unable to write %s: %s", self.fname, err)
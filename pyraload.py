@@ -0,0 +1,208 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+#
+# Adaptive job limits. Each host's load average, available memory and, on
+# kernels that have it, pressure stall information are sampled, and the
+# number of slots the daemon may use on the host follows them AIMD-style:
+# one more slot while the host is busy and below target, half as many once
+# it is overloaded.
+#
+
+import os, sys, time, subprocess
+from pyralog import log
+from pyrametrics import metrics
+
+PROBE_FILES = ['/proc/loadavg', '/proc/meminfo',
+               '/proc/pressure/cpu', '/proc/pressure/memory', '/proc/pressure/io']
+PROBE_SCRIPT = 'for f in %s; do echo "==$f"; cat $f 2>/dev/null; done; ' \
+               'echo "==nproc"; getconf _NPROCESSORS_ONLN' % ' '.join(PROBE_FILES)
+
+TARGET_DEF   = 0.9   # load average per cpu to ramp up to
+SAMPLE_TIME  = 5     # seconds between readings of a host
+ADJUST_TIME  = 10    # seconds between changes to a host's limit
+MEM_FLOOR    = 0.1   # back off below this fraction of memory available
+PRESSURE_MAX = {'cpu' : 50.0, 'memory' : 10.0, 'io' : 25.0}  # % stalled, avg10
+
+def parsereading(text):
+    # output of PROBE_SCRIPT -> {'load1', 'ncpu', 'memfree', 'cpu', 'memory', 'io'},
+    # keys whose source is missing are left out
+    sections = {}
+    name = None
+    for line in text.split('\n'):
+        if line.startswith('=='):
+            name = line[2:].strip()
+            sections[name] = []
+        elif name is not None and line.strip() != '':
+            sections[name].append(line)
+
+    r = {}
+    try:
+        if len(sections.get('/proc/loadavg', [])) > 0:
+            r['load1'] = float(sections['/proc/loadavg'][0].split()[0])
+        if len(sections.get('nproc', [])) > 0:
+            r['ncpu'] = int(sections['nproc'][0])
+
+        mem = {}
+        for line in sections.get('/proc/meminfo', []):
+            fields = line.split()
+            mem[fields[0].rstrip(':')] = int(fields[1])
+        if 'MemTotal' in mem and 'MemAvailable' in mem:
+            r['memfree'] = float(mem['MemAvailable']) / mem['MemTotal']
+
+        for key in PRESSURE_MAX:
+            for line in sections.get('/proc/pressure/' + key, []):
+                if line.startswith('some'):
+                    r[key] = float(line.split()[1].split('=')[1])
+    except (ValueError, IndexError):
+        pass  # partial reading, use what parsed
+    return r
+
+def localreading():
+    s = []
+    for fname in PROBE_FILES:
+        s.append('==' + fname)
+        try:
+            inFile = open(fname)
+            s.append(inFile.read())
+            inFile.close()
+        except IOError:
+            pass
+    s.append('==nproc')
+    s.append(str(os.sysconf('SC_NPROCESSORS_ONLN')))
+    return parsereading('\n'.join(s))
+
+def overloaded(r, target):
+    # reason the host should shed jobs, or None
+    if r.get('memfree', 1.0) < MEM_FLOOR:
+        return 'memory %.0f%% available' % (100 * r['memfree'])
+    for key in PRESSURE_MAX:
+        if r.get(key, 0.0) > PRESSURE_MAX[key]:
+            return '%s pressure %.1f%%' % (key, r[key])
+    if 'load1' in r and r.get('ncpu', 0) > 0 and r['load1'] / r['ncpu'] > target:
+        return 'load %.2f on %d cpus' % (r['load1'], r['ncpu'])
+    return None
+
+class loadcontrol:
+    def __init__(self, target=TARGET_DEF):
+        self.target   = target
+        self.limits   = []  # slots the daemon may use on each host
+        self.readings = []  # latest reading of each host
+        self.sampled  = []  # time of that reading
+        self.changed  = []  # time each limit last changed
+        self.probes   = {}  # host -> Popen of a remote reading in progress
+
+    def setup(self, nodeobj):
+        # start every host at its cores, or the cpus of an unlisted localhost
+        now = time.time()
+        for h in range(len(self.limits), len(nodeobj.hosts)):
+            limit = nodeobj.cores[h]
+            if nodeobj.hosts[h] == 'localhost':
+                limit = min(limit, os.sysconf('SC_NPROCESSORS_ONLN'))
+            self.limits.append(limit)
+            self.readings.append(None)
+            self.sampled.append(0)
+            self.changed.append(now)
+            nodeobj.setlimit(h, limit)
+
+    def sample(self, nodeobj, chans=None):
+        # local readings are taken in place, remote ones over ssh in the
+        # background and collected on a later pass
+        now = time.time()
+        for h in range(len(nodeobj.hosts)):
+            addr = nodeobj.hosts[h]
+            if h in self.probes:
+                p = self.probes[h]
+                if p.poll() is None:
+                    continue
+                del self.probes[h]
+                if p.returncode == 0:
+                    self.readings[h] = parsereading(p.stdout.read())
+                    self.sampled[h] = now
+                p.stdout.close()
+            elif nodeobj.credit[h] is not None:
+                continue  # a worker, it asks for as many jobs as it takes
+            elif now - self.sampled[h] < SAMPLE_TIME:
+                continue
+            elif addr == 'localhost':
+                self.readings[h] = localreading()
+                self.sampled[h] = now
+            else:
+                args = ['ssh', '-o', 'BatchMode=yes']
+                if chans is not None:
+                    args += chans.options(addr).split()
+                args += [addr, PROBE_SCRIPT]
+                try:
+                    null = open(os.devnull, 'r+')
+                    self.probes[h] = subprocess.Popen(args, stdin=null, stdout=subprocess.PIPE,
+                                                      stderr=null, close_fds=True)
+                    null.close()
+                    metrics.count('pyrasol_spawned_total', kind='probe')
+                except OSError, err:
+                    log.warning("unable to read load of %s: %s", addr, err)
+                self.sampled[h] = now  # retry after SAMPLE_TIME either way
+
+    def adjust(self, nodeobj, maxjobs):
+        # additive increase while a host uses all it may and is below
+        # target, up to its cores or maxjobs, multiplicative decrease once
+        # it is overloaded
+        now = time.time()
+        for h in range(len(nodeobj.hosts)):
+            r = self.readings[h]
+            if r is None or now - self.changed[h] < ADJUST_TIME or self.sampled[h] < self.changed[h]:
+                continue
+
+            limit  = self.limits[h]
+            reason = overloaded(r, self.target)
+            if reason is not None and limit > 1:
+                limit = max(1, limit / 2)
+                log.info("%s: %s, limit %d -> %d", nodeobj.hosts[h], reason, self.limits[h], limit)
+            elif reason is None and nodeobj.active[h] >= limit and limit < min(nodeobj.cores[h], maxjobs):
+                limit += 1
+            else:
+                continue
+
+            self.limits[h]  = limit
+            self.changed[h] = now
+            nodeobj.setlimit(h, limit)
+
+    def update(self, nodeobj, maxjobs, chans=None):
+        self.setup(nodeobj)
+        self.sample(nodeobj, chans)
+        self.adjust(nodeobj, maxjobs)
+
+    def total(self):
+        return sum(self.limits)
+
+    def close(self, nodeobj=None):
+        for h in self.probes:
+            try:
+                os.kill(self.probes[h].pid, 9)
+                self.probes[h].wait()
+            except OSError:
+                pass
+        self.probes = {}
+        if nodeobj is not None:
+            for h in range(len(nodeobj.hosts)):
+                nodeobj.setlimit(h, None)
@@ -0,0 +1,239 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+
+#
+# Job output and daemon messages. Each job's stdout and stderr go straight to
+# files of their own under .pyrasol.logs/<batch>/<job / 1000>/, opened by the
+# daemon and handed to the job, so no output passes through the daemon. Once
+# the job ends, empty files are removed and large ones compressed. The
+# daemon's own messages are leveled, and each kind of message is limited to a
+# burst per window, the rest only counted.
+#
+
+import os, sys, time, gzip, subprocess
+
+LOG_DIR        = '.pyrasol.logs'
+LOG_INDEX      = 'index'  # batch number<TAB>name per line
+LOG_GZIP_MIN   = 65536    # bytes of output from which a finished job's file is compressed
+LOG_GZIP_LEVEL = 1
+LOG_GZIP_FILES = 1000     # files compressed per child process
+LOG_DONE       = '.done'  # suffix of a finished job's output waiting to be compressed
+STREAMS        = ['out', 'err']
+
+LEVELS     = {'debug' : 0, 'info' : 1, 'warning' : 2, 'error' : 3}
+LOG_WINDOW = 60  # seconds over which messages of one kind are counted
+LOG_BURST  = 10  # messages of one kind written per window
+
+def logpath(bi, i, stream, dirname=LOG_DIR):
+    return os.path.join(dirname, str(bi), str(i / 1000), '%d.%s' % (i, stream))
+
+def writeindex(names, dirname=LOG_DIR):
+    if not os.path.isdir(dirname):
+        os.mkdir(dirname)
+    outFile = open(os.path.join(dirname, LOG_INDEX), 'w')
+    for bi in range(len(names)):
+        outFile.write('%d\t%s\n' % (bi, names[bi]))
+    outFile.close()
+
+def readindex(dirname=LOG_DIR):
+    # batch name -> number
+    names = {}
+    fname = os.path.join(dirname, LOG_INDEX)
+    if os.path.exists(fname):
+        inFile = open(fname)
+        for line in inFile:
+            fields = line[:-1].split('\t')
+            names[fields[1]] = int(fields[0])
+        inFile.close()
+    return names
+
+def openlogs(bi, i, suffix=''):
+    # [stdout, stderr] files for job i of batch bi, a rerun starts afresh
+    outdir = os.path.dirname(logpath(bi, i, 'out'))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    files = []
+    for stream in STREAMS:
+        fname = logpath(bi, i, stream) + suffix
+        for old in [fname + '.gz', fname + LOG_DONE]:
+            if os.path.exists(old):
+                os.remove(old)
+        files.append(open(fname, 'w'))
+    return files
+
+def finishlogs(bi, i):
+    # drop a finished job's empty files, returns those to compress, set
+    # aside so a rerun of the job does not write into them
+    done = []
+    for stream in STREAMS:
+        fname = logpath(bi, i, stream)
+        try:
+            size = os.path.getsize(fname)
+        except OSError:
+            continue
+        if size == 0:
+            os.remove(fname)
+        elif size >= LOG_GZIP_MIN:
+            os.rename(fname, fname + LOG_DONE)
+            done.append(fname + LOG_DONE)
+    return done
+
+def gziplog(done):
+    # NAME.done -> NAME.gz, skipped if a rerun removed it meanwhile
+    fname = done[:-len(LOG_DONE)]
+    try:
+        inFile = open(done, 'rb')
+    except IOError:
+        return
+    outFile = gzip.GzipFile(fname + '.gz.tmp', 'wb', LOG_GZIP_LEVEL)
+    while True:
+        data = inFile.read(1 << 20)
+        if not data:
+            break
+        outFile.write(data)
+    outFile.close()
+    inFile.close()
+    if os.path.exists(done):
+        os.rename(fname + '.gz.tmp', fname + '.gz')
+        os.remove(done)
+    else:
+        os.remove(fname + '.gz.tmp')
+
+class logzipper:
+    # compresses what finishlogs() set aside in a child process, a batch of
+    # files at a time, so reaping a job never waits on gzip
+    def __init__(self):
+        self.files = []
+        self.child = None
+
+    def add(self, files):
+        self.files.extend(files)
+
+    def poll(self):
+        # start on the next batch once the last one is done
+        if self.child is not None and self.child.poll() is None:
+            return
+        self.child = None
+        if len(self.files) > 0:
+            files = self.files[:LOG_GZIP_FILES]
+            del self.files[:LOG_GZIP_FILES]
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pyralog.py')
+            self.child = subprocess.Popen([sys.executable, '-S', script] + files)
+
+    def finish(self):
+        # on the way out, the rest is compressed here
+        if self.child is not None:
+            self.child.wait()
+            self.child = None
+        for fname in self.files:
+            gziplog(fname)
+        self.files = []
+
+def movelogs(bi, i, suffix):
+    # the files of a job's copy become the job's own
+    for stream in STREAMS:
+        fname = logpath(bi, i, stream)
+        if os.path.exists(fname + suffix):
+            os.rename(fname + suffix, fname)
+
+def droplogs(bi, i, suffix):
+    for stream in STREAMS:
+        fname = logpath(bi, i, stream) + suffix
+        if os.path.exists(fname):
+            os.remove(fname)
+
+def readlog(bi, i, stream):
+    # a job's output so far, or None if it has none
+    fname = logpath(bi, i, stream)
+    if os.path.exists(fname):
+        inFile = open(fname, 'rb')
+    elif os.path.exists(fname + LOG_DONE):
+        inFile = open(fname + LOG_DONE, 'rb')
+    elif os.path.exists(fname + '.gz'):
+        inFile = gzip.open(fname + '.gz', 'rb')
+    else:
+        return None
+    data = inFile.read()
+    inFile.close()
+    return data
+
+class daemonlog:
+    def __init__(self, level='info'):
+        self.level = LEVELS[level]
+        self.kinds = {}  # (level, format) -> [window start, written, suppressed]
+
+    def setlevel(self, level):
+        if level in LEVELS:
+            self.level = LEVELS[level]
+
+    def emit(self, t, level, msg):
+        # sys.stderr is looked up on every write, daemonizing replaces it
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+        sys.stderr.write('%s %-7s %s\n' % (stamp, level, msg))
+
+    def write(self, level, fmt, args):
+        if LEVELS[level] < self.level:
+            return
+        now = time.time()
+        kind = self.kinds.get((level, fmt))
+        if kind is None or now - kind[0] >= LOG_WINDOW:
+            if kind is not None and kind[2] > 0:
+                self.emit(now, level, '%d more suppressed: %s' % (kind[2], fmt))
+            kind = [now, 0, 0]
+            self.kinds[(level, fmt)] = kind
+        if kind[1] >= LOG_BURST:
+            kind[2] += 1
+            return
+        kind[1] += 1
+        if len(args) > 0:
+            fmt = fmt % args
+        self.emit(now, level, fmt)
+
+    def flush(self, final=False):
+        # report what ended windows suppressed, or all of it at exit
+        now = time.time()
+        for (level, fmt), kind in self.kinds.items():
+            if kind[2] > 0 and (final or now - kind[0] >= LOG_WINDOW):
+                self.emit(now, level, '%d more suppressed: %s' % (kind[2], fmt))
+                del self.kinds[(level, fmt)]
+
+    def debug(self, fmt, *args):
+        self.write('debug', fmt, args)
+
+    def info(self, fmt, *args):
+        self.write('info', fmt, args)
+
+    def warning(self, fmt, *args):
+        self.write('warning', fmt, args)
+
+    def error(self, fmt, *args):
+        self.write('error', fmt, args)
+
+log = daemonlog()  # shared by the daemon and its modules
+
+if __name__ == '__main__':
+    # run by logzipper
+    for fname in sys.argv[1:]:
+        gziplog(fname)
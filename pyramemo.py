@@ -0,0 +1,134 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+#
+# Result memoization. A job that declares its inputs and outputs with
+# @in=a,b @out=c (or just @memo) is keyed by its command and the size and
+# mtime, or content, of its inputs. Successful runs are recorded in a cache
+# that outlives pyra clean, and a job whose key is in the cache and whose
+# outputs all still exist is marked completed without running.
+#
+
+import os, sys, time
+from pyralog import log
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+MEMO_FILE = '.pyrasol.memo'
+MEMO_OPTS = ['in', 'out', 'memo']  # job line options kept with the command
+HASH_BLOCK = 1 << 20
+
+def memoprefix(opts):
+    # the memo options of a job line, as the prefix they are stored with
+    s = []
+    for key in MEMO_OPTS:
+        if key in opts:
+            if opts[key] == '':
+                s.append('@' + key)
+            else:
+                s.append('@%s=%s' % (key, opts[key]))
+    return ' '.join(s)
+
+def memofiles(opts, key):
+    if opts.get(key, '') == '':
+        return []
+    return opts[key].split(',')
+
+def filehash(fname):
+    h = sha1()
+    inFile = open(fname, 'rb')
+    while True:
+        data = inFile.read(HASH_BLOCK)
+        if not data:
+            break
+        h.update(data)
+    inFile.close()
+    return h.hexdigest()
+
+def memokey(cmd, inputs, content=False):
+    # hex key of a command and the current state of its inputs, None if
+    # an input is missing
+    h = sha1(cmd)
+    for fname in inputs:
+        try:
+            st = os.stat(fname)
+            if content:
+                stamp = filehash(fname)
+            else:
+                stamp = '%d:%d' % (st.st_size, int(st.st_mtime))
+        except (OSError, IOError):
+            return None
+        h.update('\0%s\0%s' % (fname, stamp))
+    return h.hexdigest()
+
+class memocache:
+    def __init__(self, fname=MEMO_FILE):
+        self.fname   = fname
+        self.entries = None  # key -> outputs, loaded on first use
+
+    def load(self):
+        self.entries = {}
+        if not os.path.exists(self.fname):
+            return
+        inFile = open(self.fname)
+        for line in inFile:
+            if not line.endswith('\n'):
+                break  # torn final record
+            fields = line[:-1].split('\t')
+            if len(fields) < 3:
+                continue
+            if fields[2] == '':
+                self.entries[fields[0]] = []
+            else:
+                self.entries[fields[0]] = fields[2].split(',')
+        inFile.close()
+
+    def hit(self, key):
+        # True if key completed before and its outputs are all still there
+        if key is None:
+            return False
+        if self.entries is None:
+            self.load()
+        if key not in self.entries:
+            return False
+        for fname in self.entries[key]:
+            if not os.path.exists(fname):
+                return False
+        return True
+
+    def record(self, key, outputs):
+        if key is None:
+            return
+        if self.entries is None:
+            self.load()
+        self.entries[key] = outputs
+        try:
+            outFile = open(self.fname, 'a')
+            outFile.write('%s\t%.2f\t%s\n' % (key, time.time(), ','.join(outputs)))
+            outFile.close()
+        except IOError, err:
+            log.error("unable to write %s: %s", self.fname, err)
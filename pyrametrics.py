@@ -0,0 +1,132 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+
+#
+# Daemon metrics in the Prometheus text format. Counters and histograms are
+# kept as the daemon runs, gauges are set from its state just before each
+# export. The text goes to .pyrasol.prom every METRICS_TIME seconds (for a
+# node_exporter textfile collector, which reads *.prom files) and to 'pyra
+# metrics' over the control socket. Disabled, every call returns at once.
+#
+
+import os, bisect
+
+METRICS_FILE = '.pyrasol.prom'
+METRICS_TIME = 10  # seconds between writes of the metrics file
+
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0]  # seconds
+
+# name -> (type, help)
+METRICS = {
+    'pyrasol_tick_seconds'       : ('histogram', 'Duration of one pass of the daemon loop.'),
+    'pyrasol_checkpoint_seconds' : ('histogram', 'Duration of a journal write or snapshot of the batch state.'),
+    'pyrasol_wakeups_total'      : ('counter', 'Wakeups of the daemon loop, by what woke it.'),
+    'pyrasol_spawned_total'      : ('counter', 'Processes started by the daemon, by kind.'),
+    'pyrasol_dispatched_total'   : ('counter', 'Jobs started.'),
+    'pyrasol_reaped_total'       : ('counter', 'Jobs that ended, by status.'),
+    'pyrasol_memo_hits_total'    : ('counter', 'Jobs completed from the memo cache without running.'),
+    'pyrasol_requests_total'     : ('counter', 'Control socket requests, by request.'),
+    'pyrasol_jobs'               : ('gauge', 'Jobs of each batch, by status.'),
+    'pyrasol_queue_depth'        : ('gauge', 'Pending jobs of each batch.'),
+    'pyrasol_node_running'       : ('gauge', 'Slots in use on each host.'),
+    'pyrasol_node_limit'         : ('gauge', 'Slots the daemon may use on each host.'),
+    'pyrasol_busy_cores'         : ('gauge', 'Cores held by running jobs and their copies.'),
+    'pyrasol_job_limit'          : ('gauge', 'Job limit in effect.'),
+    'pyrasol_workers'            : ('gauge', 'Worker agents connected.'),
+}
+
+def labelstring(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in labels])
+
+class registry:
+    def __init__(self):
+        self.enabled    = True
+        self.counters   = {}  # (name, labels) -> value
+        self.gauges     = {}
+        self.histograms = {}  # name -> [bucket counts, sum, count]
+
+    def count(self, name, n=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        h = self.histograms.get(name)
+        if h is None:
+            h = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            self.histograms[name] = h
+        h[0][bisect.bisect_left(BUCKETS, value)] += 1
+        h[1] += value
+        h[2] += 1
+
+    def cleargauges(self):
+        self.gauges = {}
+
+    def render(self):
+        series = {}  # name -> lines
+        for (name, labels), value in self.counters.items() + self.gauges.items():
+            series.setdefault(name, []).append('%s%s %s' % (name, labelstring(labels), value))
+        for name in self.histograms:
+            counts, total, n = self.histograms[name]
+            lines = []
+            cumulative = 0
+            for b in range(len(BUCKETS)):
+                cumulative += counts[b]
+                lines.append('%s_bucket{le="%g"} %d' % (name, BUCKETS[b], cumulative))
+            lines.append('%s_bucket{le="+Inf"} %d' % (name, n))
+            lines.append('%s_sum %f' % (name, total))
+            lines.append('%s_count %d' % (name, n))
+            series[name] = lines
+
+        s = []
+        for name in sorted(series.keys()):
+            kind, text = METRICS.get(name, ('untyped', ''))
+            s.append('# HELP %s %s' % (name, text))
+            s.append('# TYPE %s %s' % (name, kind))
+            if kind == 'histogram':
+                s.extend(series[name])  # buckets stay in order
+            else:
+                s.extend(sorted(series[name]))
+        return '\n'.join(s) + '\n'
+
+    def write(self, fname=METRICS_FILE):
+        # replace atomically, a scraper never sees half a file
+        outFile = open(fname + '.tmp', 'w')
+        outFile.write(self.render())
+        outFile.close()
+        os.rename(fname + '.tmp', fname)
+
+metrics = registry()  # shared by the daemon and its modules
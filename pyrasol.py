@@ -24,207 +24,1153 @@
 #    THE SOFTWARE.
 #-------------------------------------------------------------------------------
 
-import sys, time, shlex, subprocess, signal
+import sys, time, math, shlex, subprocess, signal, select, errno, fcntl, bisect
+from array import array
 from daemon import Daemon
 from pyraclass import *
+from pyrachannel import channels
+from pyracontrol import controlserver
+from pyraload import loadcontrol, TARGET_DEF
+from pyramemo import memocache, memokey, memofiles, MEMO_OPTS
+from pyrawrap import JOBS_DIR, jobfile, readjobfile, isalive, localcmd, remotecmd
+from pyrahist import history
+from pyralog import log, openlogs, finishlogs, movelogs, droplogs, writeindex, logzipper
+from pyrametrics import metrics, METRICS_FILE, METRICS_TIME
+from pyraworker import workerserver, parseaddr, readleasemark, writeleasemark, \
+     LEASE_BASE, LEASE_BLOCK, LEASE_GRACE, main as workermain
 
-def getSpawned(pids):
-    pidlist = []
-    for pid in pids:
-        pidlist.append(str(pid))
-    pidlist = ','.join(pidlist)
-
-    args = ["ps --ppid %s -o pid=" % pidlist]
-    p = subprocess.Popen(args, shell=True,
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE, close_fds=True)
-
-    spawned = []
-    lines = p.stdout.readlines()
-    for l in lines:
-        spawned.append(int(l.strip()))
-
-    # append any spawning process pids to clean up (if necessary) 
-    for pid in pids:
-        spawned.append(pid)
-        
-    return spawned
+TICK_TIME       = 5   # seconds between housekeeping passes when no job exits
+CHECKPOINT_TIME = 30  # seconds between journal writes of the batch state
+KILL_GRACE      = 5   # seconds between SIGTERM and SIGKILL when killing jobs
+
+SPEC_PCT    = 90    # percentile of a batch's completed runtimes a job must outrun to be copied
+SPEC_MIN    = 10    # completed jobs a batch needs before any of its jobs are copied
+SPEC_SUFFIX = '.s'  # job file of a speculative copy
+
+LPT_MAX = 250000  # pending jobs of a batch beyond which it keeps file order
+
+CLOCK_SLACK = 0.001  # workers send their times to the millisecond
+
+WRAPPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pyrawrap.py')
+
+def signalgroup(pgid, sig):
+    # signal a job's whole process group, returns False once it is gone
+    try:
+        os.killpg(pgid, sig)
+    except OSError, err:
+        if err.errno != errno.ESRCH:
+            log.error("unable to signal group %d: %s", pgid, err)
+        return False
+    return True
+
+def exitfields(usage, ended):
+    # column values of an exited job from its wrapper's record or its
+    # rusage entry, ended is its exit time if the record has none
+    fields = {'began' : usage.get('began', -1.0), 'stop' : usage.get('ended', ended)}
+    for key in USAGE:
+        if key in usage:
+            fields[key] = usage[key]
+    return fields
 
 class MyDaemon(Daemon):
     def __init__(self, *args, **kwargs):
         self.sb = None
         self.params = None
         self.nodes = None
+        self.channels = None
+        self.control = None
+        self.load = None     # adaptive job limits, when autojobs is on
+        self.limit = None    # maxjobs in effect on the last pass
         self.processes = {}
+        self.rusage = {}  # pid -> times and usage of a local job, taken as it is reaped
+        self.memo = memocache()
+        self.memowait = {}  # pid -> (memo key, outputs) of running memo jobs
+        self.killed = {}  # pgid -> time SIGTERM was sent
+        self.adopted = {}  # pid -> job file of jobs started by an earlier daemon
+        self.copies = {}  # pid of a job -> (pid, node, cores) of its speculative copy
+        self.runtimes = {}  # batch -> sorted runtimes of its completed jobs, once needed
+        self.ready = {}  # batch -> time it was first free to start jobs
+        self.deps = None  # dependencies between jobs, see depgraph
+        self.history = history()
+        self.order = 'file'  # dispatch order the batches' queues are in
+        self.logindex = False  # batch names written for pyra log
+        self.done = []  # job files to remove once the state file has caught up
+        self.zipper = logzipper()  # compresses large job outputs off the reap path
+        self.workers = None  # server of the worker agents, when workerport is set
+        self.workerhosts = {}  # worker name -> its host in nodes
+        self.leased = {}  # lease id -> job handed to a worker
+        self.results = {}  # lease id -> record of how it ended, as jobrecord() has it
+        self.orphans = {}  # lease id -> time its job runs again unless its worker claims it
+        self.nextlease = LEASE_BASE
+        self.leasemark = LEASE_BASE  # ids from here on are not reserved yet
         self.running = True
+        self.wakeup = None
         Daemon.__init__(self, *args, **kwargs)
 
+    def onchild(self, signum, frame):
+        # only wake up the main loop, children are reaped in update()
+        try:
+            os.write(self.wakeup[1], '.')
+        except OSError:
+            pass  # pipe is full, a wakeup is already pending
+
+    def setupsignals(self):
+        r, w = os.pipe()
+        for fd in (r, w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.wakeup = (r, w)
+
+        signal.signal(signal.SIGCHLD, self.onchild)
+        if hasattr(signal, 'siginterrupt'):
+            signal.siginterrupt(signal.SIGCHLD, False)
+
+    def wait(self, timeout):
+        fds = []
+        if self.wakeup is not None:
+            fds.append(self.wakeup[0])
+        if self.control is not None:
+            fds.append(self.control.fileno())
+        wfds = []
+        if self.workers is not None:
+            wfds = self.workers.writefds()
+            workerfds = self.workers.readfds()
+            fds.extend(workerfds)
+        if len(fds) == 0:
+            time.sleep(timeout)
+            return
+
+        try:
+            ready, writable = select.select(fds, wfds, [], timeout)[:2]
+        except select.error, err:
+            if err[0] != errno.EINTR:
+                raise
+            return
+        if len(ready) == 0 and len(writable) == 0:
+            metrics.count('pyrasol_wakeups_total', reason='tick')
+
+        if self.control is not None and self.control.fileno() in ready:
+            metrics.count('pyrasol_wakeups_total', reason='control')
+            self.control.serve(self.oncontrol)
+
+        if self.workers is not None:
+            if len([fd for fd in ready if fd in workerfds]) > 0:
+                metrics.count('pyrasol_wakeups_total', reason='worker')
+                self.workers.serve(ready, self.onworker)
+            self.workers.flush(self.onworker)
+
+        if self.wakeup is None or self.wakeup[0] not in ready:
+            return
+        metrics.count('pyrasol_wakeups_total', reason='child')
+        try:
+            while os.read(self.wakeup[0], 4096):
+                pass
+        except OSError:
+            pass  # drained
+
+    def oncontrol(self, words):
+        # requests from pyra over the control socket
+        cmd = words[0]
+        metrics.count('pyrasol_requests_total', request=cmd)
+        if cmd == 'ping':
+            return 'ok'
+        elif cmd == 'param' and len(words) == 3:
+            if badparam(words[1], words[2]):
+                return 'error %s' % badparam(words[1], words[2])
+            self.setparam(words[1], words[2])
+            return 'ok %s set to %s' % (words[1], words[2])
+        elif cmd == 'stop':
+            self.setparam('killjobs', '1')
+            return 'ok stopping'
+        elif cmd == 'time' and self.sb is not None:
+            s = 'ok\n' + self.sb.info(self.nodes)
+            if self.load is not None:
+                s += '\n  job limit: %d (auto, maxjobs %s)' % (self.limit, self.params.getparam("maxjobs"))
+            elif self.limit is not None:
+                s += '\n  job limit: %d' % self.limit
+            eta = self.eta()
+            if eta is not None:
+                s += '\n  estimated time left: %s' % timestring(eta)
+            return s
+        elif cmd == 'metrics':
+            if not metrics.enabled:
+                return 'error metrics are off'
+            self.setgauges()
+            return 'ok\n' + metrics.render()
+        return 'error unknown request: %s' % ' '.join(words)
+
+    def setparam(self, key, value):
+        # takes effect on the pass that follows this wakeup, and is written
+        # through to the params file so it survives a restart
+        self.updateparams()
+        self.params.setparam(key, value)
+        self.params.write()
+
+    def onworker(self, conn, words):
+        # messages from the worker agents, see pyraworker.py. reports are
+        # only taken down here, checkjob() settles the jobs on the next pass
+        cmd = words[0]
+        try:
+            if cmd == 'hello':
+                slots = int(words[2])
+                h = self.workerhosts.get(conn.name)
+                if h is None:
+                    h = self.nodes.addhost(conn.name, slots, credit=0)
+                    self.workerhosts[conn.name] = h
+                conn.h = h
+                log.info("worker %s connected from %s with %d slots", conn.name, conn.addr[0], slots)
+            elif cmd == 'lease' and len(words) == 2:
+                self.nodes.setcredit(conn.h, self.nodes.credit[conn.h] + int(words[1]))
+            elif cmd == 'running' and len(words) == 2:
+                self.claim(conn, int(words[1]))
+            elif cmd == 'done' and len(words) == 10:
+                lease = int(words[1])
+                conn.unacked.append(lease)
+                job = self.leased.get(lease)
+                if job is None or (job.node >= 0 and self.nodes.gethost(job.node) != conn.h):
+                    return  # run again meanwhile, or settled before a restart
+                began, ended, utime, stime = [float(w) for w in words[3:7]]
+                usage = {'utime' : utime, 'stime' : stime, 'maxrss' : int(words[7]),
+                         'inblock' : int(words[8]), 'oublock' : int(words[9])}
+                if job.start - CLOCK_SLACK <= began <= ended <= time.time() + CLOCK_SLACK:
+                    usage['began'] = began  # the worker's clock agrees with ours
+                    usage['ended'] = ended
+                self.results[lease] = (lease, job.node, int(words[2]), usage)
+            elif cmd == 'drop' and len(words) == 2:
+                job = self.leased.get(int(words[1]))
+                if job is not None:
+                    self.popjob(job)
+                    self.requeue(job)
+            elif cmd == 'lost':
+                self.nodes.setcredit(conn.h, 0)
+                n = 0
+                for lease, job in self.leased.items():
+                    if self.nodes.gethost(job.node) == conn.h and lease not in self.orphans:
+                        self.orphans[lease] = time.time() + LEASE_GRACE
+                        n += 1
+                log.warning("worker %s is gone, its %d jobs run again unless it is back within %ds",
+                            conn.name, n, LEASE_GRACE)
+            else:
+                log.warning("unknown message from worker %s: %s", conn.name, ' '.join(words))
+        except ValueError:
+            log.warning("bad message from worker %s: %s", conn.name, ' '.join(words))
+
+    def claim(self, conn, lease):
+        # a worker that reconnected still runs the job, it keeps it. one
+        # that already runs again elsewhere is killed
+        job = self.leased.get(lease)
+        if job is None:
+            conn.send('kill %d %d' % (lease, signal.SIGKILL))
+            return
+        if lease in self.orphans:
+            del self.orphans[lease]
+        if self.nodes.gethost(job.node) != conn.h:
+            # placed anew after a restart, without using up the worker's lease
+            credit = self.nodes.credit[conn.h]
+            node = self.nodes.slot(conn.h)
+            self.nodes.setactive(node, *job.request())
+            self.nodes.setcredit(conn.h, credit)
+            job.update(node=node)
+
+    def expireleases(self):
+        # jobs whose worker did not come back go back to pending
+        now = time.time()
+        for lease, deadline in self.orphans.items():
+            if now >= deadline:
+                job = self.leased[lease]
+                log.warning("worker of job %d did not come back, running it again", lease)
+                self.popjob(job)
+                self.requeue(job)
+
     def run(self):
-        count = 0
+        self.setupsignals()
+        self.control = controlserver()
+        if not self.control.open():
+            self.control = None
+
+        # a stop ends only the run it was given to
+        self.updateparams()
+        if self.params.getparam("killjobs") is not None:
+            self.params.delparam("killjobs")
+            self.params.write()
+
+        lastwrite = lastmetrics = time.time()
         while self.running:
+            t = time.time()
             self.update()
-            count += 1            
-            if count == 6:
-                self.sb.write()  # only write 30 seconds
-                count = 0
+            metrics.observe('pyrasol_tick_seconds', time.time() - t)
+            self.zipper.poll()
+            if self.workers is not None:
+                self.workers.flush(self.onworker)  # the jobs leased on this pass
+            if time.time() - lastwrite >= CHECKPOINT_TIME:
+                t = time.time()
+                self.sb.write()
+                metrics.observe('pyrasol_checkpoint_seconds', time.time() - t)
+                if self.workers is not None:
+                    self.workers.ack()
+                self.cleardone()
+                self.history.flush()
+                log.flush()
+                lastwrite = time.time()
+            if metrics.enabled and time.time() - lastmetrics >= METRICS_TIME:
+                self.writemetrics()
+                lastmetrics = time.time()
 
             if self.params.getparam("killjobs") is not None:
                 self.killjobs()
                 self.running = False
                 break
-            
-            time.sleep(5)
+
+            if self.running:
+                # sleep until a job exits or the next housekeeping tick
+                self.wait(TICK_TIME)
         
+        if self.control is not None:
+            self.control.close()
+        if self.load is not None:
+            self.load.close()
         self.postRun()
 
-        self.sb.write()
+        if self.channels is not None:
+            self.channels.close()
+        self.sb.compact()  # leave a self-contained state file behind
+        if self.workers is not None:
+            self.workers.ack()
+            self.workers.close()
+        self.cleardone()
+        self.zipper.finish()
+        self.history.flush()
+        log.flush(True)
+        if metrics.enabled:
+            self.writemetrics()
         sys.exit(0)
 
-    def killjobs(self):
-        pids = []
+    def pollchild(self, p):
+        # p.poll(), keeping when a local job ended and what its whole process
+        # tree used
+        if p.returncode is None and p.pid in self.rusage:
+            ru = None
+            try:
+                if hasattr(os, 'wait4'):
+                    pid, status, ru = os.wait4(p.pid, os.WNOHANG)
+                else:
+                    pid, status = os.waitpid(p.pid, os.WNOHANG)
+            except OSError, err:
+                if err.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if pid == p.pid:
+                if os.WIFSIGNALED(status):
+                    p.returncode = -os.WTERMSIG(status)
+                else:
+                    p.returncode = os.WEXITSTATUS(status)
+                self.rusage[pid]['ended'] = time.time()
+                if ru is not None:
+                    self.rusage[pid].update(utime=ru.ru_utime, stime=ru.ru_stime,
+                                            maxrss=ru.ru_maxrss, inblock=ru.ru_inblock,
+                                            oublock=ru.ru_oublock)
+        return p.poll()
+
+    def reap(self):
         for pid in self.processes:
-            if pid <= 0:
-                continue
-            pids.append(pid)
+            self.pollchild(self.processes[pid])
 
-        spawned = getSpawned(pids)
-        sys.stderr.write("killing %d running jobs.\n" % len(spawned))
+    def jobalive(self, pgid):
+        # True until our own job's group leader exits, or an adopted job's
+        # whole group is gone
+        if pgid in self.processes:
+            return self.processes[pgid].returncode is None
+        return signalgroup(pgid, 0)
 
-        # kill spawned processes, which will also kill shells which spawned them.
-        for pid in spawned:
-            count     = 0
-            killedpid = 0
-            try:
-                while killedpid == 0 and count < 10:
-                    count += 1                    
-                    os.kill(pid, signal.SIGKILL)
-                    sys.stderr.write("  killing pid %d, attempt number %d\n" % (pid, count))
-                    killedpid, stat = os.waitpid(pid, os.WNOHANG)
-                    time.sleep(0.1)
-                    
-            except OSError, err:
-                err = str(err)
-                if err.find("No such process") <= 0:
-                    sys.stderr.write(err)
+    def killjobs(self):
+        # each job leads its own process group, pid == pgid. workers kill
+        # theirs, and are not waited for
+        pgids = self.processes.keys() + list(self.adopted)
+        log.info("killing %d running jobs", len(pgids) + len(self.leased))
+
+        for pgid in pgids:
+            signalgroup(pgid, signal.SIGTERM)
+        for job in self.leased.values():
+            self.terminate(job, signal.SIGTERM)
+        if self.workers is not None:
+            self.workers.flush(self.onworker)
+
+        # give the jobs a chance to exit cleanly, then kill what is left of
+        # their groups. group members that already exited may linger as
+        # zombies until init reaps them, so only the leaders are waited on
+        deadline = time.time() + KILL_GRACE
+        alive = pgids
+        while len(alive) > 0 and time.time() < deadline:
+            time.sleep(0.1)
+            self.reap()
+            alive = [pgid for pgid in alive if self.jobalive(pgid)]
+
+        for pgid in pgids:
+            signalgroup(pgid, signal.SIGKILL)
+        for pid in self.processes:
+            self.processes[pid].wait()
+
+        # killed jobs go back to pending, the next push runs them again
+        for batch in self.sb.batches:
+            for job in batch.runningjobs():
+                self.popjob(job)
+                self.requeue(job)
                 
     def stop(self):
         Daemon.stop(self)
 
-    def jobfornode(self, cmd, node):
+    def jobfornode(self, cmd, node, usage=False):
+        # usage: have the remote host report the command's resource usage
         if node == -1:
             return cmd
 
         addr = self.nodes.getaddr(node)
         if addr == 'localhost':
             return cmd
+        if usage:
+            cmd = remotecmd(cmd)
+        if self.channels is not None:
+            return 'ssh %s %s "%s"' % (self.channels.options(addr), addr, cmd.replace('"', '\"'))
         else:
             return 'ssh %s "%s"' % (addr, cmd.replace('"', '\"'))
         
+    def joblogs(self):
+        # whether jobs write files of their own, the first time with the
+        # batch names pyra log goes by
+        if self.params.getparam("joblogs") == "off":
+            return False
+        if not self.logindex:
+            writeindex([b.name for b in self.sb.batches])
+            self.logindex = True
+        return True
+
+    def launch(self, job, node, suffix=''):
+        # suffix tells the files of a speculative copy from the job's own
+        wrap = self.params.getparam("jobwrap") != "off"
+        remote = node != -1 and self.nodes.getaddr(node) != 'localhost'
+        cmd = self.jobfornode(parseprefix(job.cmd)[0], node, wrap)
+        log.debug("node = %d, new cmd = %s", node, cmd)
+        bi = self.sb.batches.index(job.owner)
+
+        # output goes to files of the job's own, opened here and inherited
+        logs = [None, None]
+        if self.joblogs():
+            logs = openlogs(bi, job.index, suffix)
+        
+        # will execute through shell, in its own session and process group.
+        # the wrapper records the job's pid and exit status for a daemon
+        # restarted while the job runs, pyrawrap.py also the usage of a
+        # remote job
+        try:
+            if wrap:
+                if not os.path.exists(JOBS_DIR):
+                    os.mkdir(JOBS_DIR)
+                fname = jobfile(bi, job.index) + suffix
+                if remote:
+                    args = [sys.executable, '-S', WRAPPER, '-r', fname, str(node), cmd]
+                else:
+                    args = localcmd(fname, node, cmd)
+                p = subprocess.Popen(args, stdout=logs[0], stderr=logs[1], preexec_fn=os.setsid)
+            else:
+                p = subprocess.Popen(cmd, shell=True, stdout=logs[0], stderr=logs[1],
+                                     preexec_fn=os.setsid)
+        finally:
+            for f in logs:
+                if f is not None:
+                    f.close()
+
+        self.processes[p.pid] = p
+        if not remote:
+            self.rusage[p.pid] = {'began' : time.time()}
+        cores, mem = job.request()
+        self.nodes.setactive(node, cores, mem)
+        metrics.count('pyrasol_spawned_total', kind=suffix and 'copy' or 'job')
+        return p
+
+    def lease(self, job, node):
+        # hand the job to the worker of node's host, returns its lease id,
+        # which stands in for its pid
+        h = self.nodes.gethost(node)
+        if self.nextlease >= self.leasemark:
+            self.leasemark = self.nextlease + LEASE_BLOCK
+            writeleasemark(self.leasemark)
+        lease = self.nextlease
+        self.nextlease += 1
+        cores, mem = job.request()
+        logs = int(self.joblogs())
+        self.workers.get(self.nodes.hosts[h]).send('job %d %d %d %d %d %s' % (lease,
+            self.sb.batches.index(job.owner), job.index, cores, logs, parseprefix(job.cmd)[0]))
+        self.leased[lease] = job
+        self.nodes.setactive(node, cores, mem)
+        return lease
+
     def pushjob(self, job, node):
         if job.cmd is None:
             return
 
-        cmd = self.jobfornode(job.cmd, node)
-        print >> sys.stderr, "node = %d, new cmd = %s" % (node, cmd)
-        
-        p = subprocess.Popen(cmd, shell=True)  # will execute through shell
-        job.setpid(p.pid)
-        job.setnode(node)
-        job.setrunning()
+        t = time.time()
+        ready = max(job.ready, self.ready.get(job.owner, t))  # requeued jobs are ready later
+        if self.nodes.credit[self.nodes.gethost(node)] is not None:
+            pid = self.lease(job, node)
+        else:
+            pid = self.launch(job, node).pid
+        job.update(pid=pid, pgid=pid, node=node, start=t, stop=t, status='running',
+                   ready=ready, began=-1.0, reaped=-1.0)
+        metrics.count('pyrasol_dispatched_total')
 
-        self.processes[p.pid] = p
-        self.nodes.setactive(node)
+    def copyjob(self, job, node):
+        # start a speculative copy of a running job, the first of the two
+        # to succeed completes it
+        log.info("job %d has run %ds, starting a copy", job.pid, job.runningtime())
+        p = self.launch(job, node, SPEC_SUFFIX)
+        self.copies[job.pid] = (p.pid, node, job.request()[0])
+
+    def dropcopy(self, job):
+        cpid, node, cores = self.copies.pop(job.pid)
+        p = self.processes.pop(cpid)
+        self.rusage.pop(cpid, None)
+        if self.pollchild(p) is None:
+            signalgroup(cpid, signal.SIGKILL)
+            p.wait()
+        self.nodes.setavailable(node)
+        droplogs(self.sb.batches.index(job.owner), job.index, SPEC_SUFFIX)
+
+    def checkcopy(self, job, retcode):
+        # settle a job that has a copy running: the first of the two to
+        # succeed wins and the other is killed. a copy that fails just ends,
+        # an original that fails hands the job over to its copy. returns
+        # the job's exit status, None while it runs
+        cpid, node, cores = self.copies[job.pid]
+        copycode = self.pollchild(self.processes[cpid])
+        if retcode == 0 or (copycode is not None and copycode != 0):
+            self.dropcopy(job)
+            return retcode
+        elif retcode is None and copycode is None:
+            return None
+
+        if retcode is None:
+            log.info("copy of job %d finished first", job.pid)
+            signalgroup(job.pgid, signal.SIGKILL)
+            self.processes[job.pid].wait()
+        movelogs(self.sb.batches.index(job.owner), job.index, SPEC_SUFFIX)
+        del self.copies[job.pid]
+        del self.processes[job.pid]
+        self.rusage.pop(job.pid, None)
+        if job.pid in self.memowait:
+            self.memowait[cpid] = self.memowait.pop(job.pid)
+        if job.pgid in self.killed:
+            del self.killed[job.pgid]
+        self.nodes.setavailable(job.node)
+        job.update(pid=cpid, pgid=cpid, node=node)
+        return copycode
+
+    def jobpath(self, job):
+        return jobfile(self.sb.batches.index(job.owner), job.index)
+
+    def jobrecord(self, job):
+        # record of the wrapper running job, its own or its copy's, or the
+        # report of its worker
+        if job.pid in self.results:
+            return self.results[job.pid]
+        path = self.jobpath(job)
+        for fname in [path, path + SPEC_SUFFIX]:
+            rec = readjobfile(fname)
+            if rec is not None and rec[0] == job.pid:
+                return rec
+        return None
+
+    def setexit(self, job):
+        # a job that just exited began, ended and used what we saw of it
+        # locally, or what its wrapper says, without either it ended when
+        # we noticed
+        t = time.time()
+        usage = self.rusage.get(job.pid, {})
+        if 'ended' in usage:
+            job.update(reaped=t, **exitfields(usage, t))
+            return
+        rec = self.jobrecord(job)
+        if rec is None:
+            job.update(stop=t, reaped=t)
+        else:
+            job.update(reaped=t, **exitfields(rec[3], t))
 
     def popjob(self, job):
         if job.pid in self.processes:
             del self.processes[job.pid]
+        self.rusage.pop(job.pid, None)
+        if job.pid in self.copies:
+            self.dropcopy(job)
+        if job.pid in self.adopted:
+            del self.adopted[job.pid]
+        if job.pgid in self.killed:
+            self.terminate(job, signal.SIGKILL)  # leftovers that ignored SIGTERM
+            del self.killed[job.pgid]
+        if job.pid in self.leased:
+            # its worker has seen to its files
+            del self.leased[job.pid]
+            self.results.pop(job.pid, None)
+            self.orphans.pop(job.pid, None)
+        else:
+            self.done.append(self.jobpath(job))
+            self.zipper.add(finishlogs(self.sb.batches.index(job.owner), job.index))
+        if job.pid in self.memowait:
+            del self.memowait[job.pid]
         self.nodes.setavailable(job.node)
         
     def checkjob(self, job, maxjobtime=-1):
-        if job.pid not in self.processes:
-            return
+        # returns True once the job has finished and its slot is free
+        if job.pid in self.processes:
+            retcode = self.pollchild(self.processes[job.pid])
+        elif job.pid in self.adopted:
+            retcode = self.polladopted(job)
+        elif job.pid in self.leased:
+            retcode = None
+            if job.pid in self.results:
+                retcode = self.results[job.pid][2]
+        else:
+            return False
+        if job.pid in self.copies:
+            retcode = self.checkcopy(job, retcode)
 
-        p = self.processes[job.pid]
-        retcode = p.poll()
-        job.settime()
-
-        # check if job has exceeded maxtime
-        if maxjobtime > 0 and job.runningtime() > maxjobtime:
-            spawned = getSpawned([job.pid])
-    
-            # kill spawned processes, also kills shells that spawned them.
-            for pid in spawned:
-                sys.stderr.write("killing spawned: %d\n" % pid)
-                try:
-                    os.kill(pid, signal.SIGKILL)
-                except OSError, err:
-                    err = str(err)
-                    if err.find("No such process") <= 0:
-                        sys.stderr.write(err)
+        # check if job has exceeded maxtime, kill its whole process group
+        if retcode is None and maxjobtime > 0 and job.runningtime() > maxjobtime:
+            if job.pgid not in self.killed:
+                log.warning("job %d exceeded max job time, terminating", job.pid)
+                self.terminate(job, signal.SIGTERM)
+                self.killed[job.pgid] = time.time()
+            elif time.time() - self.killed[job.pgid] >= KILL_GRACE:
+                self.terminate(job, signal.SIGKILL)
 
         if retcode is None:
-            return
+            return False
 
         # otherwise finished in some way, check for crash
+        self.setexit(job)
         if retcode == 0:
             job.setcompleted()
+            if job.pid in self.memowait:
+                self.memo.record(*self.memowait[job.pid])
+            if job.owner in self.runtimes:
+                bisect.insort(self.runtimes[job.owner], job.runningtime())
+            self.history.record(job.cmd, job.runningtime())
         else:
             job.setcrashed()
+        self.deps.finished(job)
 
+        metrics.count('pyrasol_reaped_total', status=job.status)
         self.popjob(job)
+        return True
+
+    def terminate(self, job, sig):
+        # signal a job's whole process group, through its worker if it has one
+        if job.pid not in self.leased:
+            return signalgroup(job.pgid, sig)
+        h = self.nodes.gethost(job.node)
+        if self.workers is None or h is None or self.workers.get(self.nodes.hosts[h]) is None:
+            return False
+        self.workers.get(self.nodes.hosts[h]).send('kill %d %d' % (job.pid, sig))
+        return True
+
+    def polladopted(self, job):
+        # exit status of a job an earlier daemon started, None while it runs.
+        # the record is read again after the liveness check, so a status
+        # written as the job exits is not missed. one that left no status
+        # counts as crashed
+        fname = self.adopted[job.pid] or self.jobpath(job)
+        rec = readjobfile(fname)
+        if rec is None:
+            alive = signalgroup(job.pgid, 0)
+        else:
+            alive = isalive(rec[0], fname)
+        rec = readjobfile(fname)
+        if rec is not None and rec[2] is not None:
+            return rec[2]
+        elif alive:
+            return None
+        log.warning("job %d exited without a status", job.pid)
+        return -1
+
+    def requeue(self, job):
+        job.update(pid=-1, pgid=-1, node=-1, start=-1.0, stop=-1.0, status='pending',
+                   ready=time.time(), began=-1.0, reaped=-1.0)
+
+    def recover(self):
+        # pick up after a daemon that died with jobs running: a job whose
+        # wrapper, or that of its copy, recorded a success is completed, one
+        # still running is adopted and watched until it exits, one that
+        # recorded a failure is crashed and any other goes back to pending.
+        # a pending job with a job file was started just before the last
+        # journal write
+        files = {}
+        if os.path.isdir(JOBS_DIR):
+            for name in os.listdir(JOBS_DIR):
+                fields = name.split('.')
+                if len(fields) == 3 and '.' + fields[2] == SPEC_SUFFIX:
+                    fields = fields[:2]
+                try:
+                    bi, i = [int(x) for x in fields]
+                except ValueError:
+                    continue  # a record being written
+                files.setdefault((bi, i), []).append(os.path.join(JOBS_DIR, name))
+
+        # jobs run by workers wait for them to reconnect. lease ids go on
+        # past any given out before
+        batches = self.sb.batches
+        top = readleasemark() - 1
+        for bi in range(len(batches)):
+            if len(batches[bi].columns['pid']) > 0:  # none for array jobs never started
+                top = max(top, max(batches[bi].columns['pid']))
+            for job in batches[bi].runningjobs():
+                if job.pid >= LEASE_BASE:
+                    self.leased[job.pid] = job
+                    self.orphans[job.pid] = time.time() + LEASE_GRACE
+                    job.update(node=-1)  # worker hosts are numbered as they connect
+                    memo = self.memoinfo(job)
+                    if memo is not None:
+                        self.memowait[job.pid] = memo
+                    continue
+                files.setdefault((bi, job.index), [])  # no wrapper, or it never got going
+        self.nextlease = top + 1
+
+        counts = {'adopted' : 0, 'finished' : 0, 'requeued' : 0}
+        for (bi, i), fnames in sorted(files.items()):
+            if bi >= len(batches) or i >= batches[bi].total() \
+                    or batches[bi].jobs[i].iscompleted() or batches[bi].jobs[i].iscrashed():
+                for fname in fnames:
+                    os.remove(fname)  # the state file already has the outcome
+                continue
+            job = batches[bi].jobs[i]
+
+            # (record, alive, fname) of each wrapper the job had
+            recs = []
+            for fname in fnames:
+                rec = readjobfile(fname)
+                alive = rec is not None and isalive(rec[0], fname)
+                rec = readjobfile(fname)  # may have exited while we looked
+                if rec is not None:
+                    recs.append((rec, alive, fname))
+            won   = [r for r in recs if r[0][2] == 0]
+            live  = [r for r in recs if r[0][2] is None and r[1]]
+            ended = [r for r in recs if r[0][2] is not None]
+
+            pick = (won + live + ended + [None])[0]
+            for r in live:
+                if r is not pick:
+                    signalgroup(r[0][0], signal.SIGKILL)  # the loser of a job and its copy
+            if pick is not None:
+                rec, alive, fname = pick
+                t = os.path.getmtime(fname)
+                if job.ispending():
+                    began = rec[3].get('began', t)
+                    job.update(start=began, stop=began, status='running')
+                job.update(pid=rec[0], pgid=rec[0], node=rec[1])
+
+            if pick is not None and rec[2] is not None:
+                job.update(reaped=time.time(), **exitfields(rec[3], t))
+                if rec[2] == 0:
+                    job.setcompleted()
+                    memo = self.memoinfo(job)
+                    if memo is not None:
+                        self.memo.record(*memo)
+                else:
+                    job.setcrashed()
+                self.done.extend(fnames)
+                self.zipper.add(finishlogs(bi, i))
+                counts['finished'] += 1
+            elif pick is not None or (len(fnames) == 0 and self.isjob(job)):
+                if pick is None:
+                    self.adopted[job.pid] = None
+                else:
+                    self.adopted[job.pid] = pick[2]
+                    for fname in fnames:
+                        if fname != pick[2]:
+                            os.remove(fname)
+                self.nodes.setactive(job.node, *job.request())
+                memo = self.memoinfo(job)
+                if memo is not None:
+                    self.memowait[job.pid] = memo
+                counts['adopted'] += 1
+            else:
+                # the wrappers are gone. what is left of their groups is
+                # not ours to kill for sure, a pid may be reused by now
+                if job.isrunning():
+                    if self.isjob(job):
+                        signalgroup(job.pgid, signal.SIGKILL)
+                    self.requeue(job)
+                for fname in fnames:
+                    os.remove(fname)
+                counts['requeued'] += 1
+
+        if len(files) > 0:
+            log.info("recovered jobs: %d adopted, %d finished, %d requeued",
+                     counts['adopted'], counts['finished'], counts['requeued'])
+        if len(self.leased) > 0:
+            log.info("%d jobs were leased to workers, waiting %ds for them", len(self.leased), LEASE_GRACE)
+
+    def isjob(self, job):
+        # True while the state file's pgid of job still leads it, started
+        # with or without a wrapper
+        if job.pgid <= 0:
+            return False
+        return isalive(job.pgid, self.jobpath(job), parseprefix(job.cmd)[0])
+
+    def cleardone(self):
+        # job files and those of their copies
+        for fname in self.done:
+            for path in [fname, fname + SPEC_SUFFIX]:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.done = []
         
     def updateparams(self):
         p = params()
         if self.params is None or self.params.isnew():
             p.read()
             self.params = p
+            log.setlevel(p.getparam("loglevel") or 'info')
+            metrics.enabled = p.getparam("metrics") != "off"
+            placement = p.getparam("placement")
+            if placement is not None and badparam("placement", placement):
+                log.warning("%s, keeping the placement in effect", badparam("placement", placement))
+            if not metrics.enabled and os.path.exists(METRICS_FILE):
+                os.remove(METRICS_FILE)
 
     def updatenodes(self):
         if self.nodes is None:
             n = nodes()
-            n.read()
+            n.read(self.params.getparam("workerport") in (None, "off"))
             self.nodes = n
+
+            # keep one multiplexed ssh connection open per remote host
+            if self.params.getparam("sshmux") != "off":
+                self.channels = channels()
+                self.channels.open(n.hosts)
+        elif self.channels is not None:
+            self.channels.check()
         
+    def updateworkers(self):
+        # start listening once workerport is set, it stays open for the run
+        value = self.params.getparam("workerport")
+        if self.workers is not None or value is None or value == "off":
+            return
+        try:
+            host, port = parseaddr(value)
+        except ValueError:
+            log.error("workerport should be PORT or HOST:PORT, not %s", value)
+            return
+        workers = workerserver(port, host)
+        if workers.open():
+            self.workers = workers
+
+    def updateload(self, maxjobs):
+        # with autojobs on, maxjobs is only the ceiling of the job limit
+        target = float(self.params.getparam("autotarget") or TARGET_DEF)
+        if self.params.getparam("autojobs") == "on":
+            if self.load is None:
+                self.load = loadcontrol(target)
+            self.load.target = target
+            self.load.update(self.nodes, maxjobs, self.channels)
+            maxjobs = min(maxjobs, self.load.total())
+        elif self.load is not None:
+            self.load.close(self.nodes)
+            self.load = None
+
+        self.limit = maxjobs
+        return maxjobs
+
     def updatebatch(self):
         if self.sb is None:
             self.sb = superbatch()
             self.sb.read()
+            self.recover()
+            self.deps = depgraph(self.sb)
+            unknown = self.deps.build()
+            if len(unknown) > 0:
+                log.error("no job has key %s, the jobs after it are blocked", ','.join(unknown))
 
     def update(self):
-        self.updatenodes()
-        
         self.updateparams()
+        self.updatenodes()
+        self.updateworkers()
+        self.nodes.setpolicy(self.params.getparam("placement"))
         maxjobs = int(self.params.getparam("maxjobs"))
         maxjobtime = int(self.params.getparam("maxjobtime"))
+        maxjobs = self.updateload(maxjobs)
 
         self.updatebatch()
-        totr = self.sb.running()
-        totp = self.sb.pending()
+        self.expireleases()
+        self.setorder(self.params.getparam("order"))
+
+        # reap finished jobs in every batch, stragglers included, so their
+        # slots can be refilled in this same pass. maxjobs counts cores
+        for batch in self.sb.batches:
+            for job in batch.runningjobs():
+                self.checkjob(job,maxjobtime)
+        totr = self.sb.busy()
+        for cpid, node, cores in self.copies.values():
+            totr += cores
 
-        if totp == 0 and totr == 0:  # all jobs done
+        if self.sb.pending() == 0 and self.sb.running() == 0:  # all jobs done
             self.running = False
             return
 
+        # jobs released by memo hits can start in this same pass
+        while True:
+            self.deps.released = 0
+            if self.params.getparam("schedule") == 'concurrent':
+                totr = self.dispatchconcurrent(totr, maxjobs)
+            else:
+                totr = self.dispatchserial(totr, maxjobs)
+            if self.deps.released == 0:
+                break
+
+        # with nothing running, jobs still pending that wait on other jobs
+        # can only be waiting on each other
+        if self.sb.running() == 0 and self.sb.pending() > 0 and self.stuck():
+            n = 0
+            for batch in self.sb.batches:
+                n += self.deps.blockbatch(batch)
+            log.error("%d jobs wait on each other through after options, blocked", n)
+
+        # slots nothing is waiting for go to copies of stragglers
+        if self.params.getparam("speculate") == "on":
+            self.speculate(totr, maxjobs)
+
+    def stuck(self):
+        # whether every pending job waits on other jobs, rather than on a
+        # host to run on
+        concurrent = self.params.getparam("schedule") == 'concurrent'
+        for batch in self.sb.batches:
+            if batch.pending() > len(batch.held) and (not concurrent or self.sb.isready(batch)):
+                return False
+        return True
+
+    def setgauges(self):
+        metrics.cleargauges()
+        for batch in self.sb.batches:
+            for status in STATUS:
+                metrics.set('pyrasol_jobs', batch.counts[STATUSCODE[status]], batch=batch.name, status=status)
+            metrics.set('pyrasol_queue_depth', batch.pending(), batch=batch.name)
+        for h in range(len(self.nodes.hosts)):
+            metrics.set('pyrasol_node_running', self.nodes.active[h], host=self.nodes.hosts[h])
+            metrics.set('pyrasol_node_limit', self.nodes.limit[h], host=self.nodes.hosts[h])
+        busy = self.sb.busy()
+        for cpid, node, cores in self.copies.values():
+            busy += cores
+        metrics.set('pyrasol_busy_cores', busy)
+        if self.limit is not None:
+            metrics.set('pyrasol_job_limit', self.limit)
+        if self.workers is not None:
+            metrics.set('pyrasol_workers', len(self.workers.names))
+
+    def writemetrics(self):
+        self.setgauges()
+        try:
+            metrics.write()
+        except (IOError, OSError), err:
+            log.error("unable to write %s: %s", METRICS_FILE, err)
+
+    def setorder(self, order):
+        # lpt starts each batch's longest jobs first, by their predicted
+        # runtime. jobs nothing is known about go first of all, they may be
+        # long and their runtimes sharpen later predictions
+        if order != 'lpt':
+            order = 'file'
+        if order == self.order:
+            return
+
+        for batch in self.sb.batches:
+            if order == 'lpt' and batch.pending() <= LPT_MAX:
+                batch.setorder(self.lptkey(batch))
+            else:
+                batch.setorder()
+        self.order = order
+
+    def lptkey(self, batch):
+        def key(i):
+            t = self.history.predict(batch.cmds[i])
+            if t is None:
+                return -1e300
+            return -t
+        return key
+
+    def eta(self):
+        # seconds until the jobs left are done at the current job limit,
+        # from each batch's mean runtime so far or else the history of its
+        # next job. None when there is nothing to go on
+        if self.limit is None:
+            return None
+        work = 0.0
+        for batch in self.sb.batches:
+            if batch.pending() == 0 and batch.running() == 0:
+                continue
+            finished = batch.counts[COMPLETED] + batch.counts[CRASHED]
+            if finished > 0:
+                mean = batch.runtime / finished
+            else:
+                job = batch.peekpending() or (batch.runningjobs() + [None])[0]
+                if job is None and len(batch.held) > 0:
+                    job = batch.jobs[min(batch.held)]  # all it has left waits on others
+                if job is None:
+                    return None
+                mean = self.history.predict(job.cmd)
+                if mean is None:
+                    return None
+
+            work += batch.pending() * mean
+            for job in batch.runningjobs():
+                t = self.history.predict(job.cmd)
+                if t is None:
+                    t = mean
+                work += max(0.0, t - job.runningtime())
+        return work / max(1, self.limit)
+
+    def dispatch(self, batch, totr, maxjobs):
+        # start batch's next pending job if its cores fit under maxjobs and
+        # on some host, returns the cores it took or 0. jobs start in order,
+        # a big job waits for room rather than being overtaken
+        while True:
+            job = batch.peekpending()
+            if job is None:
+                return 0
+            cores, mem = job.request()
+            if not self.nodes.canfit(cores, mem):
+                if self.workers is not None:
+                    return 0  # a worker that fits it may yet connect
+                log.error("job needs %d cores and %d MB, more than any host has: %s",
+                          cores, mem, job.cmd)
+                batch.nextpending().setcrashed()
+                self.deps.finished(job)
+                continue
+
+            if totr + cores > maxjobs and totr > 0:
+                return 0  # a job larger than maxjobs runs on its own
+            node = self.nodes.getavailable(cores, mem)
+            if node is None:
+                return 0
+            batch.nextpending()
+
+            memo = self.memoinfo(job)
+            if memo is not None and self.memo.hit(memo[0]):
+                log.info("memo hit, not running: %s", job.cmd)
+                metrics.count('pyrasol_memo_hits_total')
+                t = time.time()
+                job.update(start=t, stop=t, status='completed')
+                self.deps.finished(job)
+                continue
+
+            self.pushjob(job, node)
+            if memo is not None and (job.pid in self.processes or job.pid in self.leased):
+                self.memowait[job.pid] = memo
+            return cores
+
+    def memoinfo(self, job):
+        # (key, outputs) of a job that declared @in/@out/@memo, or None
+        if not job.cmd.startswith('@'):
+            return None
+        cmd, opts = parseprefix(job.cmd)
+        if len([key for key in MEMO_OPTS if key in opts]) == 0:
+            return None
+        content = self.params.getparam("memokey") == "content"
+        return memokey(cmd, memofiles(opts, 'in'), content), memofiles(opts, 'out')
+
+    def dispatchserial(self, totr, maxjobs):
         for batch in self.sb.batches:
             nr = batch.running()
             np = batch.pending()
-            if nr == 0 and np == 0:
-                continue  # done with batch, go to next
+            if nr == 0 and np == len(batch.held):
+                continue  # done with batch, or all it has left waits on later ones
 
-            for job in batch.jobs:
-                if job.isrunning():
-                    self.checkjob(job,maxjobtime)
-                elif job.ispending() and totr < maxjobs:
-                    node = self.nodes.getavailable()
-                    if node is None:
-                        break
-                    self.pushjob(job, node)
-                    totr += 1
-
-                    if totr == maxjobs:
-                        break
+            if np > 0:
+                self.ready.setdefault(batch, time.time())
+            while totr < maxjobs:
+                cores = self.dispatch(batch, totr, maxjobs)
+                if cores == 0:
+                    break
+                totr += cores
             break  # can only do a batch at a time
-        
+        return totr
+
+    def dispatchconcurrent(self, totr, maxjobs):
+        # every batch whose 'after' barriers are met competes for free slots,
+        # each slot goes to the batch furthest below its weighted share
+        eligible = []
+        for batch in self.sb.batches:
+            if batch.pending() > 0 and self.sb.isblocked(batch):
+                log.warning("batch %s is blocked, a batch it is after has crashed jobs", batch.name)
+                self.deps.blockbatch(batch)
+            if batch.pending() > 0 and self.sb.isready(batch):
+                eligible.append(batch)
+                self.ready.setdefault(batch, time.time())
+
+        while totr < maxjobs and len(eligible) > 0:
+            best = None
+            for batch in eligible:
+                if best is None or batch.busy / batch.weight() < best.busy / best.weight():
+                    best = batch
+
+            cap = max(1, int(math.ceil(best.maxshare() * maxjobs)))
+            if best.busy >= cap or best.pending() == 0:
+                eligible.remove(best)
+                continue
+
+            cores = self.dispatch(best, totr, maxjobs)
+            if cores == 0:
+                eligible.remove(best)  # its next job does not fit yet
+                continue
+            totr += cores
+        return totr
+
+    def speculate(self, totr, maxjobs):
+        # once a batch has nothing left to start, copy its running jobs that
+        # have outrun most of its completed ones onto free slots, on another
+        # host where one has room
+        pct = float(self.params.getparam("specpct") or SPEC_PCT)
+        for batch in self.sb.batches:
+            if batch.pending() > 0 or batch.running() == 0 or batch.opts.get('speculate') == 'off':
+                continue
+            cut = self.runtimecut(batch, pct)
+            if cut is None:
+                continue
+
+            for job in batch.runningjobs():
+                if totr >= maxjobs:
+                    return
+                if job.pid not in self.processes or job.pid in self.copies or job.pgid in self.killed:
+                    continue  # adopted, already copied, or being killed
+                if job.runningtime() <= cut or 'nospec' in parseprefix(job.cmd)[1]:
+                    continue
+                cores, mem = job.request()
+                if totr + cores > maxjobs:
+                    continue
+                node = self.nodes.getavailable(cores, mem, self.nodes.gethost(job.node))
+                if node is None:
+                    return
+                if self.nodes.credit[self.nodes.gethost(node)] is not None:
+                    continue  # copies only run on hosts in .config
+                self.copyjob(job, node)
+                totr += cores
+
+    def runtimecut(self, batch, pct):
+        # pct-th percentile of the runtimes of batch's completed jobs, None
+        # while it has too few. built once, then kept up by checkjob
+        if batch not in self.runtimes:
+            if batch.counts[COMPLETED] < SPEC_MIN:
+                return None
+            cols   = batch.columns
+            status = cols['status']
+            start  = cols['start']
+            stop   = cols['stop']
+            times = [stop[i] - start[i] for i in xrange(len(status))
+                     if status[i] == COMPLETED and stop[i] > start[i]]  # not memo hits
+            times.sort()
+            self.runtimes[batch] = array('d', times)
+
+        times = self.runtimes[batch]
+        if len(times) < SPEC_MIN:
+            return None
+        return times[min(len(times) - 1, int(len(times) * pct / 100.0))]
+
     def postRun(self):
         p = params()
         p.read()
@@ -258,6 +1204,8 @@ if __name__ == "__main__":
             daemon.stop()
         elif 'restart' == sys.argv[1]:
             daemon.restart()
+        elif 'worker' == sys.argv[1]:
+            sys.exit(workermain(sys.argv[2:]))
         else:
             print "Unknown command"
             sys.exit(2)
@@ -268,6 +1216,7 @@ if __name__ == "__main__":
         print "  start        : start daemon"
         print "  stop         : stop daemon"
         print "  restart      : restart daemon"
+        print "  worker HOST:PORT [SLOTS [NAME]] : run jobs for the daemon at HOST:PORT (see workerport)"
         print "  submit fname : submit batch file"
         
         sys.exit(2)
@@ -0,0 +1,189 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+
+#
+# Export of the jobs' lifecycle times as a Chrome trace (JSON, opens in
+# chrome://tracing or ui.perfetto.dev). Each host is a process and each of
+# its slots a thread, a job shows on the first slot it held as its dispatch
+# (start to began), its run (began to stop) and its reap (stop to reaped).
+# Counters of the jobs queued and running show where slots sat idle.
+# Timestamps are microseconds since the earliest time in the trace.
+#
+
+import gzip, time
+from pyraclass import STATUS, PENDING, RUNNING
+
+TRACE_FILE = 'pyrasol.trace.json'
+
+def jsonstr(s):
+    s = s.replace('\\', '\\\\').replace('"', '\\"')
+    chars = []
+    for c in s:
+        if c < ' ':
+            c = '\\u%04x' % ord(c)
+        chars.append(c)
+    return '"%s"' % ''.join(chars)
+
+def steps(ups, downs):
+    # (time, count) each time the number of open intervals changes
+    ups.sort()
+    downs.sort()
+    n = i = j = 0
+    last = None
+    while i < len(ups) or j < len(downs):
+        if j == len(downs) or (i < len(ups) and ups[i] < downs[j]):
+            t = ups[i]
+        else:
+            t = downs[j]
+        while i < len(ups) and ups[i] == t:
+            n += 1
+            i += 1
+        while j < len(downs) and downs[j] == t:
+            n -= 1
+            j += 1
+        if n != last:
+            yield t, n
+        last = n
+
+class tracefile:
+    def __init__(self, outFile, origin):
+        self.outFile = outFile
+        self.origin  = origin
+        self.first   = True
+        outFile.write('{"displayTimeUnit": "ms", "otherData": {"origin": %.3f},\n' % origin)
+        outFile.write(' "traceEvents": [\n')
+
+    def ts(self, t):
+        return '%.0f' % ((t - self.origin) * 1e6)
+
+    def event(self, s):
+        if not self.first:
+            self.outFile.write(',\n')
+        self.first = False
+        self.outFile.write(s)
+
+    def name(self, kind, pid, tid, name):
+        # process_name or thread_name
+        self.event('{"name": "%s_name", "ph": "M", "pid": %d, "tid": %d, "args": {"name": %s}}'
+                   % (kind, pid, tid, jsonstr(name)))
+
+    def slice(self, name, cat, pid, tid, t0, t1, args=''):
+        self.event('{"name": %s, "cat": "%s", "ph": "X", "pid": %d, "tid": %d, "ts": %s, "dur": %.0f%s}'
+                   % (jsonstr(name), cat, pid, tid, self.ts(t0), (t1 - t0) * 1e6, args))
+
+    def counter(self, name, pid, t, n):
+        self.event('{"name": "%s", "ph": "C", "pid": %d, "ts": %s, "args": {"jobs": %d}}'
+                   % (name, pid, self.ts(t), n))
+
+    def close(self):
+        self.outFile.write('\n]}\n')
+
+def writetrace(sb, hosts, outFile, now=None):
+    # trace of every job of superbatch sb that was started, on the slots of
+    # nodes object hosts. returns the number of jobs written
+    if now is None:
+        now = time.time()
+
+    # first pass: the queued and running intervals, and the earliest time
+    qin, qout, rin, rout = [], [], [], []
+    for b in sb.batches:
+        cols = b.columns
+        for i in xrange(len(cols['status'])):
+            start = cols['start'][i]
+            if start <= 0 or cols['node'][i] < 0 or cols['status'][i] == PENDING:
+                continue
+            ready = b.get('ready', i)
+            if ready > 0:
+                qin.append(ready)
+                qout.append(start)
+            rin.append(start)
+            end = b.get('reaped', i)
+            if cols['status'][i] == RUNNING:
+                end = now
+            elif end <= 0:
+                end = cols['stop'][i]
+            rout.append(end)
+    if len(rin) == 0:
+        return 0
+
+    t = tracefile(outFile, min(qin + rin))
+    t.name('process', 0, 0, 'pyrasol')
+    for h in range(len(hosts.hosts)):
+        t.name('process', h + 1, 0, hosts.hosts[h])
+    other = len(hosts.hosts) + 1  # slots of hosts no longer in .config
+
+    named = set()
+    for b in sb.batches:
+        cols = b.columns
+        for i in xrange(len(cols['status'])):
+            start = cols['start'][i]
+            node  = cols['node'][i]
+            if start <= 0 or node < 0 or cols['status'][i] == PENDING:
+                continue
+
+            h = hosts.gethost(node)
+            if h is None:
+                pid, tid = other, node
+            else:
+                pid, tid = h + 1, node - hosts.base[h]
+            if (pid, tid) not in named:
+                if pid == other and other not in named:
+                    t.name('process', other, 0, 'other')
+                    named.add(other)
+                t.name('thread', pid, tid, 'slot %d' % tid)
+                named.add((pid, tid))
+
+            status = STATUS[cols['status'][i]]
+            ready  = b.get('ready', i)
+            began  = b.get('began', i)
+            stop   = cols['stop'][i]
+            reaped = b.get('reaped', i)
+            if status == 'running':
+                stop = reaped = now
+            if began < start:
+                began = start
+            if reaped < stop:
+                reaped = stop
+
+            args = ', "args": {"cmd": %s, "status": "%s", "cores": %d' % (jsonstr(b.cmds[i]), status, b.request(i)[0])
+            if ready > 0:
+                args += ', "queued": %.3f' % (start - ready)
+            args += '}'
+            if began > start:
+                t.slice('dispatch', 'dispatch', pid, tid, start, began)
+            t.slice('%s:%d' % (b.name, i), status, pid, tid, began, stop, args)
+            if reaped > stop:
+                t.slice('reap', 'reap', pid, tid, stop, reaped)
+
+    for name, ups, downs in [('queued', qin, qout), ('running', rin, rout)]:
+        for when, n in steps(ups, downs):
+            t.counter(name, 0, when, n)
+    t.close()
+    return len(rin)
+
+def opentrace(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'wb')
+    return open(fname, 'w')
@@ -0,0 +1,552 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+#
+# Pull-based worker agents. A worker runs in the batch directory of each node,
+# 'pyrasol.py worker HOST:PORT [SLOTS [NAME]]', connects to the daemon over
+# TCP and asks for jobs by granting it slots, a lease. The daemon sends up to
+# that many jobs at once, the worker runs them locally and reports each one
+# that ends with its exit status, times and resource usage. A report is kept
+# until the daemon acknowledges it, which it does in bulk once the report is
+# in the state file, so none is lost if either side goes away meanwhile.
+#
+# The protocol is one line of words per message. Worker to daemon:
+#   hello NAME SLOTS KEY  first, KEY as in .pyrasol.workerkey
+#   running ID            a job still running from before a reconnect
+#   lease N               N more slots may be filled
+#   done ID CODE BEGAN ENDED UTIME STIME MAXRSS INBLOCK OUBLOCK
+#   drop ID               a job killed by the worker's own stop, to run again
+# Daemon to worker:
+#   job ID BATCH JOB CORES LOGS CMD   run CMD, its output in its own files if LOGS is 1
+#   kill ID SIG                       signal the job's process group
+#   ack ID ...                        reports that need not be kept
+#   bye                               the daemon is done, exit once idle
+#   error MSG                         the hello was refused
+#
+
+import os, sys, time, socket, select, signal, errno, fcntl
+from pyralog import log, openlogs, finishlogs, logzipper
+
+WORKER_KEY  = '.pyrasol.workerkey'
+LEASE_FILE  = '.pyrasol.lease'  # lease ids below this are taken, even if the state file has not seen them
+LEASE_BASE  = 1 << 30  # ids of leased jobs start here, above any pid
+LEASE_BLOCK = 10000    # lease ids taken at a time
+LEASE_GRACE = 60       # seconds the worker of a job has to come back before it runs again
+RETRY_TIME  = 5        # seconds between attempts to reach the daemon
+CONNECT_TIMEOUT = 2    # seconds an attempt to reach the daemon may take
+KILL_GRACE  = 5        # seconds between SIGTERM and SIGKILL of a job being killed
+
+def parseaddr(value, host=''):
+    # 'PORT' or 'HOST:PORT' -> (host, port)
+    if ':' in value:
+        host, value = value.rsplit(':', 1)
+    return host, int(value)
+
+def readkey(fname=WORKER_KEY):
+    try:
+        inFile = open(fname)
+        key = inFile.read().strip()
+        inFile.close()
+    except IOError:
+        return None
+    return key
+
+def makekey(fname=WORKER_KEY):
+    # the key is kept across restarts, so workers can reconnect
+    key = readkey(fname)
+    if key is None:
+        key = ''.join(['%02x' % ord(c) for c in os.urandom(16)])
+        fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        os.write(fd, key + '\n')
+        os.close(fd)
+    return key
+
+def readleasemark(fname=LEASE_FILE):
+    try:
+        inFile = open(fname)
+        mark = int(inFile.read())
+        inFile.close()
+    except (IOError, ValueError):
+        return LEASE_BASE
+    return mark
+
+def writeleasemark(mark, fname=LEASE_FILE):
+    # a worker may still hold reports of ids given out before the daemon
+    # went away, those are never given out again
+    tmp = fname + '.tmp'
+    outFile = open(tmp, 'w')
+    outFile.write('%d\n' % mark)
+    outFile.close()
+    os.rename(tmp, fname)
+
+def nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+# a socket carrying lines both ways without blocking: lines to send are
+# buffered until the socket takes them, received ones until complete.
+class connection:
+    def __init__(self, sock, addr=None):
+        self.sock    = sock
+        self.addr    = addr
+        self.inbuf   = ''
+        self.outbuf  = ''
+        self.name    = None  # worker name, once it said hello
+        self.h       = None  # its host in nodes
+        self.unacked = []    # ids of the reports it sent since the last ack
+        self.shut    = False  # we have nothing more to send
+        self.eof     = False  # nor has the peer
+        sock.setblocking(0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, line):
+        self.outbuf += line + '\n'
+
+    def flush(self):
+        # send what the socket takes, False once it is broken
+        while len(self.outbuf) > 0:
+            try:
+                n = self.sock.send(self.outbuf[:65536])
+            except socket.error, err:
+                if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return True
+                return False
+            self.outbuf = self.outbuf[n:]
+        return True
+
+    def lines(self):
+        # complete lines received so far, setting eof once the peer is gone
+        while not self.eof:
+            try:
+                chunk = self.sock.recv(65536)
+            except socket.error, err:
+                if err[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self.eof = True
+                break
+            if not chunk:
+                self.eof = True
+                break
+            self.inbuf += chunk
+        lines = self.inbuf.split('\n')
+        self.inbuf = lines.pop()
+        return lines
+
+    def close(self):
+        self.sock.close()
+
+# the daemon's end: a listening TCP socket and a connection per worker.
+# serve() hands each message of a worker that said hello with the right
+# key to handler(conn, words), and ['lost'] once the worker is gone.
+class workerserver:
+    def __init__(self, port, host=''):
+        self.host  = host
+        self.port  = port
+        self.key   = None
+        self.sock  = None
+        self.conns = []
+        self.names = {}  # worker name -> its connection
+
+    def open(self):
+        self.key = makekey()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((self.host, self.port))
+            sock.listen(64)
+        except socket.error, err:
+            log.error("unable to listen for workers on port %d: %s", self.port, err)
+            sock.close()
+            return False
+        sock.setblocking(0)
+        self.sock = sock
+        log.info("listening for workers on port %d", self.port)
+        return True
+
+    def readfds(self):
+        return [self.sock.fileno()] + [c.fileno() for c in self.conns]
+
+    def writefds(self):
+        return [c.fileno() for c in self.conns if len(c.outbuf) > 0]
+
+    def get(self, name):
+        return self.names.get(name)
+
+    def serve(self, ready, handler):
+        if self.sock.fileno() in ready:
+            self.accept()
+        for conn in self.conns[:]:
+            if conn not in self.conns or conn.fileno() not in ready:
+                continue  # replaced by a reconnect, or quiet
+            for line in conn.lines():
+                words = line.split()
+                if len(words) == 0:
+                    continue
+                if conn.name is None and not self.hello(conn, words, handler):
+                    conn.eof = True
+                    break
+                handler(conn, words)
+            if conn.eof:
+                self.drop(conn, handler)
+
+    def accept(self):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error, err:
+                if err[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR, errno.ECONNABORTED):
+                    return
+                raise
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.conns.append(connection(sock, addr))
+
+    def hello(self, conn, words, handler):
+        if len(words) != 4 or words[0] != 'hello' or not words[2].isdigit() or int(words[2]) < 1:
+            reason = 'expected hello NAME SLOTS KEY'
+        elif words[3] != self.key:
+            reason = 'wrong key, see %s' % WORKER_KEY
+        else:
+            old = self.names.get(words[1])
+            if old is not None:
+                # the same worker come back before we noticed it had gone
+                log.warning("worker %s reconnected from %s", words[1], conn.addr[0])
+                self.drop(old, handler)
+            conn.name = words[1]
+            self.names[conn.name] = conn
+            return True
+        log.warning("worker at %s refused: %s", conn.addr[0], reason)
+        conn.send('error ' + reason)
+        conn.flush()
+        return False
+
+    def drop(self, conn, handler):
+        self.conns.remove(conn)
+        conn.close()
+        if conn.name is not None:
+            del self.names[conn.name]
+            handler(conn, ['lost'])
+
+    def flush(self, handler):
+        for conn in self.conns[:]:
+            if not conn.flush():
+                self.drop(conn, handler)
+
+    def ack(self):
+        # the reports received so far are in the state file
+        for conn in self.conns:
+            if len(conn.unacked) > 0:
+                conn.send('ack ' + ' '.join([str(i) for i in conn.unacked]))
+                conn.unacked = []
+
+    def close(self):
+        # tell the workers we are done and wait a moment for them to hang
+        # up, closing first with their messages unread would reset the
+        # connection and could lose the bye
+        for conn in self.conns:
+            conn.send('bye')
+        deadline = time.time() + 1
+        waiting = self.conns[:]
+        while time.time() < deadline and len(waiting) > 0:
+            for conn in waiting[:]:
+                if not conn.flush():
+                    waiting.remove(conn)
+                elif len(conn.outbuf) == 0:
+                    conn.lines()
+                    if conn.eof:
+                        waiting.remove(conn)
+                    elif not conn.shut:
+                        try:
+                            conn.sock.shutdown(socket.SHUT_WR)
+                        except socket.error:
+                            waiting.remove(conn)
+                        conn.shut = True
+            time.sleep(0.01)
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
+        self.names = {}
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+def spawn(cmd, logs):
+    # start cmd through the shell in its own session, output to logs
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            null = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null, 0)
+            for fd in range(2):
+                if logs[fd] is not None:
+                    os.dup2(logs[fd].fileno(), fd + 1)
+            os.execv('/bin/sh', ['/bin/sh', '-c', cmd])
+        finally:
+            os._exit(127)
+    return pid
+
+# a node's agent, see the top of this file. Jobs keep running while the
+# daemon is out of reach, their reports wait for it to come back.
+class worker:
+    def __init__(self, addr, slots, name, key):
+        self.addr     = addr
+        self.slots    = slots
+        self.name     = name
+        self.key      = key
+        self.conn     = None
+        self.retry    = 0         # time of the next attempt to connect
+        self.jobs     = {}        # pid -> [lease id, cores, began, batch, job, time SIGTERM was sent]
+        self.pids     = {}        # lease id -> pid
+        self.unacked  = {}        # lease id -> its done line, until acknowledged
+        self.stopping = False     # the daemon said bye, or we were told to stop
+        self.refused  = False
+        self.wakeup   = None
+        self.zipper   = logzipper()  # compresses large job outputs off the reap path
+
+    def onsignal(self, signum, frame):
+        if signum != signal.SIGCHLD:
+            self.stopping = True
+        try:
+            os.write(self.wakeup[1], '.')
+        except OSError:
+            pass
+
+    def used(self):
+        return sum([j[1] for j in self.jobs.values()])
+
+    def send(self, line):
+        if self.conn is not None:
+            self.conn.send(line)
+
+    def connect(self):
+        # a daemon host that drops packets must not hold up reaping our jobs
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(self.addr)
+        except (socket.error, socket.timeout), err:
+            log.warning("unable to reach %s:%d: %s", self.addr[0], self.addr[1], err)
+            sock.close()
+            self.retry = time.time() + RETRY_TIME
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.conn = connection(sock, self.addr)
+        self.send('hello %s %d %s' % (self.name, self.slots, self.key))
+        for pid in self.jobs:
+            self.send('running %d' % self.jobs[pid][0])
+        for line in self.unacked.values():
+            self.send(line)
+        free = self.slots - self.used()
+        if free > 0:
+            self.send('lease %d' % free)
+        log.info("connected to %s:%d as %s, %d jobs running", self.addr[0], self.addr[1],
+                 self.name, len(self.jobs))
+
+    def disconnect(self):
+        log.warning("lost the daemon, retrying every %ds", RETRY_TIME)
+        self.conn.close()
+        self.conn = None
+        self.retry = time.time() + RETRY_TIME
+
+    def start(self, words):
+        # job ID BATCH JOB CORES LOGS CMD...
+        lease, bi, i, cores = [int(w) for w in words[1:5]]
+        cmd = words[6]
+        logs = [None, None]
+        if words[5] == '1':
+            try:
+                logs = openlogs(bi, i)
+            except (IOError, OSError), err:
+                log.warning("job %d writes to our stderr, unable to open its files: %s", lease, err)
+        try:
+            began = time.time()
+            pid = spawn(cmd, logs)
+        finally:
+            for f in logs:
+                if f is not None:
+                    f.close()
+        self.jobs[pid] = [lease, cores, began, bi, i, None]
+        self.pids[lease] = pid
+        log.debug("started job %d: %s", lease, cmd)
+
+    def kill(self, lease, sig):
+        pid = self.pids.get(lease)
+        if pid is None:
+            return
+        try:
+            os.killpg(pid, sig)
+        except OSError:
+            pass
+        if sig == signal.SIGTERM and self.jobs[pid][5] is None:
+            self.jobs[pid][5] = time.time()
+
+    def escalate(self):
+        # SIGKILL what is left of jobs that ignored SIGTERM
+        now = time.time()
+        for pid in self.jobs:
+            if self.jobs[pid][5] is not None and now - self.jobs[pid][5] >= KILL_GRACE:
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    def reap(self):
+        freed = 0
+        while len(self.jobs) > 0:
+            try:
+                pid, status, usage = os.wait4(-1, os.WNOHANG)
+            except OSError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                break
+            if pid == 0:
+                break
+            if pid not in self.jobs:
+                continue
+            ended = time.time()
+            lease, cores, began, bi, i, killed = self.jobs.pop(pid)
+            del self.pids[lease]
+            self.zipper.add(finishlogs(bi, i))
+            freed += cores
+            if os.WIFSIGNALED(status):
+                code = 128 + os.WTERMSIG(status)
+            else:
+                code = os.WEXITSTATUS(status)
+            if self.stopping and killed is not None:
+                self.send('drop %d' % lease)
+                continue
+            line = 'done %d %d %.3f %.3f %.3f %.3f %d %d %d' % (lease, code, began, ended,
+                usage.ru_utime, usage.ru_stime, usage.ru_maxrss, usage.ru_inblock, usage.ru_oublock)
+            self.unacked[lease] = line
+            self.send(line)
+        if freed > 0 and not self.stopping:
+            self.send('lease %d' % freed)
+
+    def receive(self):
+        for line in self.conn.lines():
+            words = line.split()
+            if len(words) == 0:
+                continue
+            if words[0] == 'job' and len(words) >= 7:
+                self.start(line.split(None, 6))
+            elif words[0] == 'kill' and len(words) == 3:
+                self.kill(int(words[1]), int(words[2]))
+            elif words[0] == 'ack':
+                for w in words[1:]:
+                    self.unacked.pop(int(w), None)
+            elif words[0] == 'bye':
+                log.info("the daemon is done")
+                self.stopping = True
+                self.conn.close()
+                self.conn = None
+                return
+            elif words[0] == 'error':
+                log.error("refused: %s", ' '.join(words[1:]))
+                self.refused = True
+                self.stopping = True
+                self.conn.close()
+                self.conn = None
+                return
+        if self.conn.eof:
+            self.disconnect()
+
+    def stop(self):
+        # killed jobs are dropped, the daemon runs them again
+        if len(self.jobs) > 0:
+            log.info("stopping, killing %d jobs", len(self.jobs))
+        for lease in self.pids.keys():
+            self.kill(lease, signal.SIGTERM)
+
+    def run(self):
+        r, w = os.pipe()
+        nonblocking(r)
+        nonblocking(w)
+        self.wakeup = (r, w)
+        for sig in [signal.SIGCHLD, signal.SIGTERM, signal.SIGINT]:
+            signal.signal(sig, self.onsignal)
+            if hasattr(signal, 'siginterrupt'):
+                signal.siginterrupt(sig, False)
+
+        stopped = False
+        while not (self.stopping and len(self.jobs) == 0):
+            if self.stopping and not stopped:
+                self.stop()
+                stopped = True
+            if self.conn is None and not self.stopping and time.time() >= self.retry:
+                self.connect()
+
+            rfds = [r]
+            wfds = []
+            if self.conn is not None:
+                rfds.append(self.conn.fileno())
+                if len(self.conn.outbuf) > 0:
+                    wfds.append(self.conn.fileno())
+            try:
+                ready = select.select(rfds, wfds, [], 1.0)[0]
+            except select.error, err:
+                if err[0] != errno.EINTR:
+                    raise
+                ready = []
+            if r in ready:
+                try:
+                    while os.read(r, 4096):
+                        pass
+                except OSError:
+                    pass
+
+            self.reap()
+            self.escalate()
+            self.zipper.poll()
+            if self.conn is not None and self.conn.fileno() in ready:
+                self.receive()
+            if self.conn is not None and not self.conn.flush():
+                self.disconnect()
+
+        if self.conn is not None:
+            self.conn.flush()
+            self.conn.close()
+        self.zipper.finish()
+
+def main(args):
+    # pyrasol.py worker HOST:PORT [SLOTS [NAME]]
+    if len(args) < 1 or len(args) > 3:
+        print "usage: pyrasol.py worker HOST:PORT [SLOTS [NAME]]"
+        return 2
+    addr = parseaddr(args[0], 'localhost')
+    slots = os.sysconf('SC_NPROCESSORS_ONLN')
+    if len(args) > 1:
+        slots = int(args[1])
+    name = socket.gethostname().split('.')[0]
+    if len(args) > 2:
+        name = args[2]
+    key = readkey()
+    if key is None:
+        print "no %s here, run the worker in the batch directory of a daemon with workerport set" % WORKER_KEY
+        return 2
+    w = worker(addr, slots, name, key)
+    w.run()
+    if w.refused:
+        return 1
+    return 0
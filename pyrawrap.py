@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+
+#
+# Job wrapper, run by the daemon as the leader of each remote job's process
+# group:
+#   pyrawrap.py [-r] JOBFILE NODE CMD
+# JOBFILE holds the wrapper's pid, the job's node and the time CMD started
+# while it runs, followed by CMD's exit status, resource usage and exit time
+# once it has exited. A restarted daemon uses it to find the jobs that
+# outlived the previous one and how the others ended.
+#
+# The usage of a remote job is that of its command on the remote host: with
+# -r, CMD is an ssh command built around remotecmd(), which reports it in a
+# last line on stderr that is taken out of the job's output here.
+#
+# Local jobs run under LOCAL_SCRIPT instead, a few lines of sh that start ten
+# times faster. It records the same pid and exit status, but neither times
+# nor usage: the daemon, whose child it is, takes those as it reaps the job.
+#
+
+import os, sys, time, signal, errno
+
+JOBS_DIR = '.pyrasol.jobs'
+
+USAGE_MARK = '#pyrawrap'  # starts the usage line of a remote job
+USAGE_HOLD = 256          # bytes of stderr held back in case they are that line
+
+# run on the remote host as: python -c REMOTE_SCRIPT USAGE_MARK sh -c CMD. it
+# travels inside the double quotes of an ssh command line, so it has no
+# quotes, dollars or backslashes of its own, and runs under python 2 or 3
+REMOTE_SCRIPT = '''import os,sys,time
+b=time.time()
+p=os.fork()
+if p==0: os.execvp(sys.argv[2],sys.argv[2:])
+s,r=os.wait4(p,0)[1:]
+u=[r.ru_utime,r.ru_stime,r.ru_maxrss,r.ru_inblock,r.ru_oublock]
+sys.stderr.write(chr(32).join([sys.argv[1]]+[str(x) for x in u]+[repr(b)])+chr(10))
+sys.stderr.flush()
+os._exit(os.WIFSIGNALED(s) and 128+os.WTERMSIG(s) or os.WEXITSTATUS(s))'''
+
+# run as: /bin/sh -c LOCAL_SCRIPT pyrawrap JOBFILE NODE CMD. the exit record
+# is appended, a reader sees the last whole line
+LOCAL_SCRIPT = 'trap : TERM INT HUP; echo "$$ $2" > "$1"; /bin/sh -c "$3"; c=$?; ' \
+               'echo "$$ $2 $c -1 -1 0" >> "$1"; exit $c'
+
+def localcmd(fname, node, cmd):
+    # arguments of the shell wrapper of a local job
+    return ['/bin/sh', '-c', LOCAL_SCRIPT, 'pyrawrap', fname, str(node), cmd]
+
+def remotecmd(cmd):
+    # cmd for the remote shell, reporting its usage where python is found
+    q = "'" + cmd.replace("'", "'\\''") + "'"
+    return "if command -v python >/dev/null 2>&1; then python -c '%s' '%s' sh -c %s; else sh -c %s; fi" \
+        % (REMOTE_SCRIPT, USAGE_MARK, q, q)
+
+def jobfile(bi, i, dirname=JOBS_DIR):
+    return os.path.join(dirname, '%d.%d' % (bi, i))
+
+def writejobfile(fname, fields):
+    # replace atomically, a reader sees the old or the new record
+    tmp = '%s.%d.tmp' % (fname, os.getpid())
+    outFile = open(tmp, 'w')
+    outFile.write('\t'.join([str(f) for f in fields]) + '\n')
+    outFile.close()
+    os.rename(tmp, fname)
+
+def readjobfile(fname):
+    # -> (pid, node, exit status or None while running, {usage}), or None.
+    # usage has 'began' and, once exited, 'ended', utime and stime (cpu
+    # seconds, -1 if unknown), maxrss (KB), inblock and oublock (blocks of
+    # 512 bytes read and written)
+    try:
+        inFile = open(fname)
+        lines = inFile.read().split('\n')[:-1]
+        inFile.close()
+    except IOError:
+        return None
+    if len(lines) == 0:
+        return None
+    fields = lines[-1].split()
+    try:
+        pid, node = int(fields[0]), int(fields[1])
+        if len(fields) < 6:
+            if len(fields) > 2:
+                return pid, node, None, {'began' : float(fields[2])}
+            return pid, node, None, {}
+        usage = {'utime'  : float(fields[3]),
+                 'stime'  : float(fields[4]),
+                 'maxrss' : int(fields[5])}
+        if len(fields) > 7:
+            usage['began'] = float(fields[6])
+            usage['ended'] = float(fields[7])
+        if len(fields) > 9:
+            usage['inblock'] = int(fields[8])
+            usage['oublock'] = int(fields[9])
+        return pid, node, int(fields[2]), usage
+    except (ValueError, IndexError):
+        return None
+
+def isalive(pid, fname, cmd=None):
+    # True while pid is the wrapper writing fname in this directory, or
+    # else a shell running cmd, as far as we can tell. a pid that another
+    # user's process, or an unrelated one of ours, took over after a
+    # reboot or wraparound is not
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False  # gone, or another user's
+    try:
+        inFile = open('/proc/%d/stat' % pid)
+        stat = inFile.read()
+        inFile.close()
+        inFile = open('/proc/%d/cmdline' % pid)
+        args = inFile.read().split('\0')
+        inFile.close()
+        cwd = os.path.realpath('/proc/%d/cwd' % pid)
+    except (IOError, OSError):
+        return True  # no /proc here, trust the pid
+    if stat[stat.rfind(')') + 2] == 'Z':
+        return False  # only waits for its parent to reap it
+    if cmd is not None and len([a for a in args if cmd in a]) > 0:
+        return True
+    return '\0'.join(args).find('pyrawrap') >= 0 and fname in args \
+        and cwd == os.path.realpath(os.getcwd())
+
+def wait4(pid):
+    while True:
+        try:
+            if hasattr(os, 'wait4'):
+                return os.wait4(pid, 0)[1:]
+            return os.waitpid(pid, 0)[1], None
+        except OSError, err:
+            if err.errno != errno.EINTR:
+                raise
+
+def writeall(fd, data):
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
+
+def relay(fd):
+    # copy fd to stderr up to EOF, all but a usage line at its end, which
+    # is returned split into its fields, or None
+    held = ''
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except OSError, err:
+            if err.errno == errno.EINTR:
+                continue
+            raise
+        if chunk == '':
+            break
+        held += chunk
+        if len(held) > USAGE_HOLD:
+            writeall(2, held[:-USAGE_HOLD])
+            held = held[-USAGE_HOLD:]
+    os.close(fd)
+
+    i = held.rfind(USAGE_MARK + ' ')
+    fields = None
+    if i >= 0 and held.endswith('\n'):
+        fields = held[i:].split()[1:]
+        if len(fields) == 6:
+            held = held[:i]
+        else:
+            fields = None
+    writeall(2, held)
+    return fields
+
+def main(fname, node, cmd, remote=False):
+    began = '%.3f' % time.time()
+    writejobfile(fname, [os.getpid(), node, began])
+
+    # the daemon signals the whole group: let the job decide how to die and
+    # stay around to record it
+    catch = [signal.SIGTERM, signal.SIGINT, signal.SIGHUP]
+    for sig in catch:
+        signal.signal(sig, signal.SIG_IGN)
+
+    if remote:
+        r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        for sig in catch:
+            signal.signal(sig, signal.SIG_DFL)
+        try:
+            if remote:
+                os.dup2(w, 2)
+                os.close(r)
+                os.close(w)
+            os.execv('/bin/sh', ['/bin/sh', '-c', cmd])
+        finally:
+            os._exit(127)
+
+    if remote:
+        os.close(w)
+        remoteusage = relay(r)
+    status, usage = wait4(pid)
+    ended = '%.3f' % time.time()
+    if os.WIFSIGNALED(status):
+        code = 128 + os.WTERMSIG(status)
+    else:
+        code = os.WEXITSTATUS(status)
+
+    if remote and remoteusage is not None:
+        # the remote clock is trusted for when the command began if it
+        # agrees with ours, the rest of the wait was ssh's
+        utime, stime, maxrss, inblock, oublock, rbegan = remoteusage
+        if float(began) <= float(rbegan) <= float(ended):
+            began = '%.3f' % float(rbegan)
+        fields = [os.getpid(), node, code, '%.3f' % float(utime), '%.3f' % float(stime),
+                  maxrss, began, ended, inblock, oublock]
+    elif remote or usage is None:
+        fields = [os.getpid(), node, code, -1, -1, 0, began, ended, 0, 0]  # ssh's usage is no use
+    else:
+        fields = [os.getpid(), node, code, '%.3f' % usage.ru_utime, '%.3f' % usage.ru_stime,
+                  usage.ru_maxrss, began, ended, usage.ru_inblock, usage.ru_oublock]
+    writejobfile(fname, fields)
+    return code
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    remote = len(args) > 0 and args[0] == '-r'
+    if remote:
+        args = args[1:]
+    if len(args) != 3:
+        print "Usage: pyrawrap.py [-r] JOBFILE NODE CMD"
+        sys.exit(2)
+    sys.exit(main(args[0], int(args[1]), args[2], remote))
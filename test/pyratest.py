@@ -0,0 +1,97 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# Shared by the tests: each runs in a scratch directory of its own, with pyra
+# and pyrasol run as the user would, under the interpreter running the tests.
+#   python -m unittest discover test
+#
+
+import os, sys, time, shutil, tempfile, subprocess, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DAEMON_WAIT = 60  # seconds a daemon gets to run its batch
+
+class scratchcase(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp(prefix='pyratest')
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        if os.path.exists('.pyrasol.pid'):
+            self.pyra('stop')
+            self.waitdaemon()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir, True)
+
+    def write(self, fname, text):
+        outFile = open(fname, 'w')
+        outFile.write(text)
+        outFile.close()
+
+    def read(self, fname):
+        inFile = open(fname)
+        text = inFile.read()
+        inFile.close()
+        return text
+
+    def call(self, script, args, env=None):
+        # -> (exit status, stdout and stderr) of one of the repo's scripts
+        p = subprocess.Popen([sys.executable, os.path.join(ROOT, script)] + list(args),
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+        out = p.communicate()[0]
+        return p.returncode, out
+
+    def pyra(self, *args):
+        return self.call('pyra.py', args)
+
+    def create(self, joblist, maxjobs=2):
+        self.write('jobs.list', joblist)
+        code, out = self.pyra('create', 'jobs.list')
+        self.assertEqual(code, 0, out)
+        self.pyra('maxjob', str(maxjobs))
+
+    def startdaemon(self, env=None):
+        code, out = self.call('pyrasol.py', ['start'], env)
+        self.assertEqual(code, 0, out)
+
+    def waitdaemon(self):
+        # until the daemon has finished the batch and exited
+        deadline = time.time() + DAEMON_WAIT
+        while os.path.exists('.pyrasol.pid'):
+            self.failIf(time.time() > deadline, 'daemon still running')
+            time.sleep(0.1)
+
+    def states(self):
+        # [(cmd, status)] of every job in the state file, in order
+        from pyraclass import superbatch
+        sb = superbatch()
+        sb.read()
+        jobs = []
+        for b in sb.batches:
+            for j in b.jobs:
+                jobs.append((j.cmd, j.status))
+        return jobs
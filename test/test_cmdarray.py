@@ -0,0 +1,69 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# job arrays, and their round trip through the state file
+#
+
+import unittest
+from pyratest import scratchcase
+from pyraclass import cmdarray, parsearray, superbatch
+
+class cmdarraytest(scratchcase):
+    def roundtrip(self, a):
+        # a, as a daemon reading the state file sees it
+        sb = superbatch()
+        sb.create([('b', [a], {})])
+        sb = superbatch()
+        sb.read()
+        return [j.cmd for j in sb.batches[0].jobs]
+
+    def check(self, template, cmds):
+        a = cmdarray(template)
+        self.assertEqual([a[i] for i in range(len(a))], cmds)
+        b = parsearray(a.record())
+        self.assertEqual([b[i] for i in range(len(b))], cmds)
+        self.assertEqual(self.roundtrip(a), cmds)
+
+    def testslots(self):
+        self.check('x {1..3} {a,b}', ['x 1 a', 'x 1 b', 'x 2 a', 'x 2 b', 'x 3 a', 'x 3 b'])
+        self.check('x {08..10..2} {=1}', ['x 08 08', 'x 10 10'])
+        self.check("awk '{print $1}' {a\\,b,c}", ["awk '{print $1}' a,b", "awk '{print $1}' c"])
+
+    def testfileslot(self):
+        self.write('one.txt', 'only\n')
+        self.check('X{<one.txt}Y', ['XonlyY'])
+        self.write('many.txt', 'a,b\n\n1..3\n<c\n')
+        self.check('X{<many.txt}Y', ['Xa,bY', 'X1..3Y', 'X<cY'])
+        self.write('range.txt', '1..3\n')
+        self.check('X{<range.txt}', ['X1..3'])
+
+    def testrun(self):
+        # a batch of nothing but array jobs, none of them started yet
+        self.create('@array echo {1..3}\n')
+        self.startdaemon()
+        self.waitdaemon()
+        self.assertEqual(self.states(), [('nice -n 15 echo %d' % i, 'completed') for i in [1, 2, 3]])
+
+if __name__ == '__main__':
+    unittest.main()
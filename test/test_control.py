@@ -0,0 +1,64 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# the control socket between pyra and the daemon
+#
+
+import select, threading, unittest
+from pyratest import scratchcase
+from pyracontrol import controlserver, request
+from pyralog import log
+
+class controltest(scratchcase):
+    def ask(self, server, handler, line):
+        # request line from another thread while serving it here
+        replies = []
+        t = threading.Thread(target=lambda: replies.append(request(line)))
+        t.start()
+        while t.isAlive():
+            if len(select.select([server.fileno()], [], [], 0.1)[0]) > 0:
+                server.serve(handler)
+        t.join()
+        return replies[0]
+
+    def testfailedrequest(self):
+        def handler(words):
+            if words[0] == 'time':
+                return None.cmd
+            return 'ok'
+        logged = []
+        log.emit = lambda t, level, msg: logged.append((level, msg))
+        server = controlserver()
+        self.assert_(server.open())
+        try:
+            self.assert_(self.ask(server, handler, 'time').startswith('error time failed'))
+            self.assertEqual(self.ask(server, handler, 'ping'), 'ok')
+        finally:
+            server.close()
+            del log.emit
+        self.assertEqual(logged[0][0], 'error')
+        self.assert_('AttributeError' in logged[0][1])
+
+if __name__ == '__main__':
+    unittest.main()
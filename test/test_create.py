@@ -0,0 +1,59 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# pyra create: job lists to state files, and the lines it refuses
+#
+
+import os, unittest
+from pyratest import scratchcase
+from pyraclass import batch
+
+class createtest(scratchcase):
+    def refused(self, joblist, message):
+        self.write('jobs.list', joblist)
+        code, out = self.pyra('create', 'jobs.list')
+        self.assertEqual(code, 1, out)
+        self.assert_(message in out, out)
+        self.assertEqual(sorted(os.listdir('.')), ['jobs.list'])
+
+    def testbadweight(self):
+        self.refused('echo a\n>b weight=0\necho b\n', 'line 2: weight=0')
+        self.refused('>b maxshare=half\necho b\n', 'line 1: maxshare=half')
+
+    def testbadrequest(self):
+        self.refused('echo a\n@cores=x echo b\n', 'line 2: @cores=x')
+        self.refused('@mem=lots echo a\n', 'line 1: @mem=lots')
+        self.refused('>b cores=0\necho b\n', 'line 1: cores=0')
+
+    def testweightdefaults(self):
+        # a state file written before the options were checked
+        b = batch('b', opts={'weight' : '0', 'maxshare' : 'x'})
+        self.assertEqual(b.weight(), 1.0)
+        self.assertEqual(b.maxshare(), 1.0)
+        b = batch('b', opts={'weight' : '2.5', 'maxshare' : '0.5'})
+        self.assertEqual(b.weight(), 2.5)
+        self.assertEqual(b.maxshare(), 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# jobs that wait on others through @key and @after, see depgraph
+#
+
+import time, unittest
+from pyratest import scratchcase
+
+class depstest(scratchcase):
+    def testheldbatch(self):
+        # pyra time while every job of a batch is held and none runs
+        self.create('true\n@key=k sleep 2\n>b\n@after=k echo b\n', maxjobs=1)
+        self.startdaemon()
+        time.sleep(1)
+        code, out = self.pyra('time')
+        self.assert_('job limit: 1' in out, out)
+        self.waitdaemon()
+        self.failIf('failed' in self.read('err.log'), self.read('err.log'))
+        self.assertEqual([s for c, s in self.states()], ['completed'] * 3)
+
+    def testblocked(self):
+        self.create('@key=k false\n@after=k echo a\necho b\n')
+        self.startdaemon()
+        self.waitdaemon()
+        self.assertEqual([s for c, s in self.states()], ['crashed', 'blocked', 'completed'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# job output files, see pyralog.py
+#
+
+import os, time, unittest
+from pyratest import scratchcase
+from pyralog import logpath, openlogs, finishlogs, readlog, logzipper, LOG_DONE
+
+class logstest(scratchcase):
+    def finish(self, out):
+        files = openlogs(0, 0)
+        files[0].write(out)
+        for f in files:
+            f.close()
+        return finishlogs(0, 0)
+
+    def testzipper(self):
+        out = 'x' * 100000
+        done = self.finish(out)
+        self.assertEqual(done, [logpath(0, 0, 'out') + LOG_DONE])
+        self.failIf(os.path.exists(logpath(0, 0, 'err')))
+        self.assertEqual(readlog(0, 0, 'out'), out)
+
+        zipper = logzipper()
+        zipper.add(done)
+        zipper.poll()
+        self.assert_(zipper.child is not None)
+        deadline = time.time() + 10
+        while zipper.child is not None and time.time() < deadline:
+            time.sleep(0.05)
+            zipper.poll()
+        self.assert_(os.path.exists(logpath(0, 0, 'out') + '.gz'))
+        self.assertEqual(readlog(0, 0, 'out'), out)
+
+    def testrerun(self):
+        # a rerun started before the output of the last run was compressed
+        zipper = logzipper()
+        zipper.add(self.finish('x' * 100000))
+        self.finish('rerun')
+        zipper.finish()
+        self.assertEqual(readlog(0, 0, 'out'), 'rerun')
+
+    def testdaemon(self):
+        self.create("head -c 100000 /dev/zero | tr '\\0' y\necho small\n")
+        self.startdaemon()
+        self.waitdaemon()
+        self.assertEqual(self.pyra('log', 'unnamed:0')[1].count('y'), 100000)
+        names = os.listdir(os.path.dirname(logpath(0, 0, 'out')))
+        self.assertEqual(sorted(names), ['0.out.gz', '1.out'])
+
+if __name__ == '__main__':
+    unittest.main()
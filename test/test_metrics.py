@@ -0,0 +1,45 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# the metrics file the daemon leaves for node_exporter
+#
+
+import os, unittest
+from pyratest import scratchcase
+from pyrametrics import METRICS_FILE
+
+class metricstest(scratchcase):
+    def testtextfile(self):
+        self.assert_(METRICS_FILE.endswith('.prom'))  # all node_exporter reads
+        self.create('true\ntrue\nfalse\n')
+        self.startdaemon()
+        self.waitdaemon()
+        text = self.read(METRICS_FILE)
+        self.assert_('pyrasol_dispatched_total 3' in text, text)
+        self.assert_('pyrasol_reaped_total{status="crashed"} 1' in text, text)
+        self.pyra('clean')
+        self.failIf(os.path.exists(METRICS_FILE))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# a daemon restarted while its jobs run, see recover() in pyrasol.py
+#
+
+import os, time, signal, subprocess, unittest
+from pyratest import scratchcase
+from daemon import Daemon
+from pyraclass import superbatch
+from pyrawrap import JOBS_DIR, jobfile
+
+class recovertest(scratchcase):
+    def killdaemon(self):
+        pid = int(self.read('.pyrasol.pid'))
+        os.kill(pid, signal.SIGKILL)
+        while Daemon('.pyrasol.pid').isalive(pid):
+            time.sleep(0.05)
+
+    def testrestart(self):
+        # jobs that outlive the daemon are adopted, those that exit while
+        # no daemon runs are settled from their job files
+        self.create('sleep 0.5\nsleep 3\nsh -c "sleep 3; exit 3"\necho a\n', maxjobs=3)
+        self.startdaemon()
+        time.sleep(1.5)
+        self.killdaemon()
+        self.startdaemon()
+        self.waitdaemon()
+        self.assertEqual([s for c, s in self.states()], ['completed', 'completed', 'crashed', 'completed'])
+        self.assert_('2 adopted, 2 finished' in self.read('err.log'), self.read('err.log'))
+
+    def teststalepid(self):
+        # a state file and job file naming a pid that is not our job's any
+        # more: it is neither adopted nor killed, the job runs again
+        self.create('echo a\n')
+        other = subprocess.Popen(['sleep', '30'], preexec_fn=os.setsid)
+        try:
+            sb = superbatch()
+            sb.read()
+            sb.batches[0].jobs[0].update(pid=other.pid, pgid=other.pid, node=0, start=time.time(),
+                                         status='running')
+            sb.compact()
+            os.mkdir(JOBS_DIR)
+            self.write(jobfile(0, 0), '%d\t0\n' % other.pid)
+
+            self.startdaemon()
+            self.waitdaemon()
+            self.assertEqual(self.states()[0][1], 'completed')
+            self.assertEqual(other.poll(), None)
+            self.assert_('1 requeued' in self.read('err.log'))
+        finally:
+            os.kill(other.pid, signal.SIGKILL)
+            other.wait()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# jobs on remote nodes, with test/bin/ssh standing in for ssh
+#
+
+import os, unittest
+from pyratest import scratchcase, ROOT
+from pyraclass import superbatch
+
+class remotetest(scratchcase):
+    def testremote(self):
+        self.write('.config', 'nodea\t2\nnodeb\t1\n')
+        self.create('echo out1\necho err1 >&2\nexit 3\nsleep 0.2\n@cores=2 echo big\n', maxjobs=3)
+        env = dict(os.environ)
+        env['PATH'] = os.path.join(ROOT, 'test', 'bin') + os.pathsep + env['PATH']
+        env['FAKESSH_LOG'] = os.path.join(self.dir, 'ssh.log')
+        self.startdaemon(env)
+        self.waitdaemon()
+
+        self.assertEqual([s for c, s in self.states()], ['completed', 'completed', 'crashed',
+                                                         'completed', 'completed'])
+        self.assertEqual(self.pyra('log', 'unnamed:0')[1].strip(), 'out1')
+        self.assert_('err1' in self.pyra('log', 'unnamed:1')[1])
+        self.failIf('#pyrawrap' in self.pyra('log', 'unnamed:1')[1])  # usage line taken out
+
+        calls = self.read('ssh.log').splitlines()
+        masters = [c for c in calls if c.startswith('master')]
+        sessions = [c for c in calls if c.startswith('session')]
+        self.assertEqual(sorted(masters), ['master nodea .pyrasol.ssh/nodea',
+                                           'master nodeb .pyrasol.ssh/nodeb'])
+        self.assertEqual(len(sessions), 5)
+        for c in sessions:
+            host = c.split()[1]
+            self.assertEqual(c, 'session %s .pyrasol.ssh/%s' % (host, host))  # over the master
+        self.failIf(os.path.exists('.pyrasol.ssh/nodea'))  # masters closed
+
+        sb = superbatch()
+        sb.read()
+        b = sb.batches[0]
+        self.assertEqual(b.jobs[4].node, 0)  # the only host with 2 cores
+        for j in b.jobs:
+            # usage reported from the remote side
+            self.assert_(j.utime >= 0 and j.maxrss > 0, (j.cmd, j.utime, j.maxrss))
+
+if __name__ == '__main__':
+    unittest.main()
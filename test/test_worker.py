@@ -0,0 +1,73 @@
+#-------------------------------------------------------------------------------
+# The MIT License
+#
+# Copyright (C) 2010 by Zack Sanborn, University of California, Santa Cruz, CA
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included in
+#    all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#    THE SOFTWARE.
+#-------------------------------------------------------------------------------
+#
+# worker agents on localhost, see pyraworker.py
+#
+
+import os, sys, socket, subprocess, unittest
+from pyratest import scratchcase, ROOT
+from pyraclass import superbatch
+
+def freeport():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class workertest(scratchcase):
+    def testworkers(self):
+        self.write('.config', '')  # no hosts of its own, jobs run on workers only
+        jobs = ['sleep 0.%d; echo out%d' % (i % 3, i) for i in range(20)]
+        self.create('\n'.join(jobs) + '\nfalse\n>two\n@cores=2 echo big\n', maxjobs=100)
+        port = freeport()
+        self.pyra('param', 'workerport', str(port))
+        self.startdaemon()
+
+        workers = []
+        for name in ['w1', 'w2']:
+            log = open(name + '.log', 'w')
+            workers.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'pyrasol.py'), 'worker',
+                                             'localhost:%d' % port, '2', name], stderr=log))
+            log.close()
+        try:
+            self.waitdaemon()
+            for w in workers:
+                self.assertEqual(w.wait(), 0)  # told to leave once the daemon is done
+        finally:
+            for w in workers:
+                if w.poll() is None:
+                    w.kill()
+
+        self.assertEqual([s for c, s in self.states()], ['completed'] * 20 + ['crashed', 'completed'])
+        self.assert_('out7' in self.pyra('log', 'unnamed:7')[1])
+        sb = superbatch()
+        sb.read()
+        for b in sb.batches:
+            for j in b.jobs:
+                # the worker's times of each job, within what the daemon saw
+                self.assert_(j.start - 0.001 <= j.began <= j.stop <= j.reaped, (j.cmd, j.start, j.began))
+
+if __name__ == '__main__':
+    unittest.main()